@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Gunicorn Configuration Benchmark
+
+Starts the service under several gunicorn configurations, loads it with
+concurrent clients reading products and prints the throughput and latency
+of each one.
+
+Usage: python bin/benchmark.py [--clients 32] [--seconds 10] [--products 200]
+
+Set DATABASE_URI to benchmark against PostgreSQL, otherwise a temporary
+SQLite file is used. The gevent configuration needs requirements-gevent.txt.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CPUS = os.cpu_count() or 1
+
+# name -> environment for gunicorn.conf.py
+CONFIGURATIONS = {
+    "sync x1 (old Procfile)": {"GUNICORN_WORKER_CLASS": "sync", "GUNICORN_WORKERS": "1", "GUNICORN_PRELOAD": "False"},
+    "sync auto": {"GUNICORN_WORKER_CLASS": "sync"},
+    "gthread auto": {"GUNICORN_WORKER_CLASS": "gthread"},
+    "gevent auto": {"GUNICORN_WORKER_CLASS": "gevent"},
+}
+
+
+def wait_until_ready(base_url: str, seconds: int = 30) -> bool:
+    """Polls the health check until the server answers"""
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{base_url}/health", timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def seed(base_url: str, count: int) -> list:
+    """Creates products and returns their ids"""
+    ids = []
+    for number in range(count):
+        body = json.dumps(
+            {
+                "name": f"product-{number}",
+                "description": "benchmark product",
+                "price": f"{random.uniform(1, 500):.2f}",
+                "available": number % 2 == 0,
+                "category": random.choice(["FOOD", "TOOLS", "CLOTHS", "HOUSEWARES", "AUTOMOTIVE"]),
+            }
+        ).encode()
+        request = urllib.request.Request(
+            f"{base_url}/products", data=body, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request) as response:
+            ids.append(json.loads(response.read())["id"])
+    return ids
+
+
+def client(base_url: str, ids: list, deadline: float) -> tuple:
+    """Issues requests until the deadline, returns (latencies, errors)"""
+    latencies, errors = [], 0
+    while time.time() < deadline:
+        if random.random() < 0.8:
+            url = f"{base_url}/products/{random.choice(ids)}"
+        else:
+            url = f"{base_url}/products?category=FOOD"
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=10) as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+        except OSError:
+            errors += 1
+    return latencies, errors
+
+
+def run(name: str, settings: dict, args, port: int) -> dict:
+    """Benchmarks one configuration"""
+    env = dict(os.environ, PORT=str(port), **settings)
+    env.setdefault("DATABASE_URI", f"sqlite:///{args.database}")
+    server = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, "-m", "gunicorn", "--log-level=warning", "service:app"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        if not wait_until_ready(base_url):
+            return {"name": name, "error": "did not start (is the worker class installed?)"}
+        ids = seed(base_url, args.products)
+        deadline = time.time() + args.seconds
+        with ThreadPoolExecutor(args.clients) as pool:
+            results = list(pool.map(lambda _: client(base_url, ids, deadline), range(args.clients)))
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    if not latencies:
+        return {"name": name, "error": "no successful requests"}
+    return {
+        "name": name,
+        "rps": len(latencies) / args.seconds,
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "errors": sum(result[1] for result in results),
+    }
+
+
+def main():
+    """Runs every configuration and prints a comparison"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=int, default=10)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    print(f"{CPUS} CPUs, {args.clients} clients, {args.seconds}s per configuration")
+    print(f"{'configuration':<24}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, settings in CONFIGURATIONS.items():
+        with tempfile.TemporaryDirectory() as folder:
+            args.database = os.path.join(folder, "benchmark.db")
+            result = run(name, settings, args, args.port)
+        if "error" in result:
+            print(f"{name:<24}  {result['error']}")
+        else:
+            print(
+                f"{name:<24}{result['rps']:>10.1f}{result['p50']:>10.2f}{result['p99']:>10.2f}{result['errors']:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+######################################################################
+# Copyright 2016, 2022 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Gunicorn Configuration
+
+Gunicorn reads this file from the working directory. Workers and threads
+are sized from the CPU count unless GUNICORN_WORKERS / GUNICORN_THREADS are
+set, and GUNICORN_WORKER_CLASS selects sync, gthread (default) or gevent.
+The gevent worker needs the packages in requirements-gevent.txt.
+
+The app is preloaded in the master so that imported code, the static
+asset pipeline and other read-only state are shared with the workers via
+copy-on-write. Each worker then resets what must not be shared across a
+fork: database connections, the logging and shard query threads and the
+readiness warm-up.
+"""
+# pylint: disable=invalid-name
+import multiprocessing
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+
+if worker_class == "gevent":
+    # must happen before the app and its drivers are imported by preload_app
+    from gevent import monkey
+
+    monkey.patch_all()
+
+cpu_count = multiprocessing.cpu_count()
+
+
+def default_workers() -> int:
+    """Returns the number of workers for the selected worker class"""
+    if worker_class == "gevent":
+        # one event loop per core serves many connections each
+        return cpu_count
+    if worker_class == "gthread":
+        # threads cover blocking I/O so fewer processes are needed
+        return cpu_count + 1
+    return cpu_count * 2 + 1
+
+
+def default_threads() -> int:
+    """Returns the number of threads per gthread worker"""
+    return 4 if worker_class == "gthread" else 1
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("GUNICORN_WORKERS", str(default_workers())))
+threads = int(os.getenv("GUNICORN_THREADS", str(default_threads())))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "True").lower() == "true"
+
+# Recycle workers to bound memory growth, with jitter so they do not all restart at once
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", str(max_requests // 10)))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+accesslog = os.getenv("GUNICORN_ACCESS_LOG")
+
+
+######################################################################
+# Server hooks
+######################################################################
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Resets the state a worker must not share with the master"""
+    if not preload_app:
+        return
+    # pylint: disable=import-outside-toplevel
+    from service import app
+    from service.models import db
+    from service.common import log_handlers, readiness
+    from service.common.replicas import replica_set
+    from service.common.sharding import shard_set
+
+    # connections opened by the master must not be used by two processes,
+    # close=False leaves them open for the master instead of closing them
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    replica_set.dispose(close=False)
+    shard_set.after_fork()
+    if log_handlers.listener:
+        log_handlers.start_listener()
+    readiness.probe.after_fork()
+
+    if worker_class == "gevent":
+        try:
+            from psycogreen.gevent import patch_psycopg
+
+            patch_psycopg()
+        except ImportError:
+            server.log.warning("psycogreen is not installed, database calls will block the event loop")
+    server.log.info("Worker %s reset its database connections", worker.pid)
+
+
+def post_worker_init(worker):  # pylint: disable=unused-argument
+    """Bounds the event streams by the threads that serve requests"""
+    # pylint: disable=import-outside-toplevel
+    from service.common import events
+
+    # a gevent stream is a greenlet, sync and gthread streams hold a thread
+    events.broadcaster.threads = None if worker_class == "gevent" else threads
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Fails the background jobs the worker can no longer finish"""
+    # pylint: disable=import-outside-toplevel
+    from service.common import jobs
+
+    jobs.runner.shutdown()
@@ -24,7 +24,10 @@ and SQL database
 import sys
 from flask import Flask
 from service import config
-from service.common import log_handlers
+from service.common import (
+    log_handlers, compression, assets, idempotency, admission, coalescing, events, readmodel, snapshots,
+    archival, jobs, readiness, counts, resultcache, suggest,
+)
 
 # NOTE: Do not change the order of this code
 # The Flask app must be created
@@ -44,12 +47,50 @@ from service.common import error_handlers, cli_commands  # noqa: F401, E402
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
 
+# Refuse or shed requests that exceed the admission limits
+admission.init_admission(app)
+
+# Compress responses for clients that accept it
+compression.init_compression(app)
+
+# Fingerprint and precompress the static files
+assets.init_assets(app)
+
+# Replay the responses of requests sent with an Idempotency-Key
+idempotency.store.init_app(app)
+
+# Share the results of identical concurrent reads
+coalescing.flights.init_app(app)
+
+# Push the Product change log to event stream subscribers
+events.broadcaster.init_app(app)
+
+# Move long unavailable Products to the archive in the background
+archival.archiver.init_app(app)
+
+# Run bulk operations in a pool of background threads
+jobs.runner.init_app(app)
+
+# Report to load balancers whether to send traffic to this worker
+readiness.probe.init_app(app)
+
+# Count the Products of list requests in the mode the client asks for
+counts.counter.init_app(app)
+
+# Keep the serialized results of repeated list requests
+resultcache.cache.init_app(app)
+
+# Suggest Product names as the client types, from an in-process index if enabled
+suggest.index.init_app(app)
+
 app.logger.info(70 * "*")
 app.logger.info("  P E T   S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
 try:
     models.init_db(app)  # make our sqlalchemy tables
+    readmodel.catalog.init_app(app)  # load the in-memory read model if enabled
+    snapshots.store.init_app(app)  # map the shared catalog snapshot if enabled
 except Exception as error:  # pylint: disable=broad-except
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -0,0 +1,158 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admission Control
+
+Every request is checked before it reaches the routes:
+
+- a per-client token bucket refills at ADMISSION_RATE_LIMIT requests per
+  second up to ADMISSION_BURST, an empty bucket is answered with 429 Too
+  Many Requests and a Retry-After of when the next token is due
+- the number of requests in flight in the worker is capped at
+  ADMISSION_MAX_INFLIGHT and the share of checked out database connections
+  at ADMISSION_MAX_POOL_SATURATION, excess load is shed with 503 Service
+  Unavailable instead of queuing until everything times out
+
+A limit of 0 turns that check off.
+
+The pool check stands in for the time requests wait for a connection,
+which is not measured: SQLAlchemy has no event before a checkout starts
+waiting. Once every connection is checked out the next request waits, so
+shedding below a saturation of 1.0 keeps the wait from building up.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+# Endpoints that are always admitted so probes and the UI keep working
+EXEMPT_ENDPOINTS = {"healthcheck", "readycheck", "metrics", "index", "get_asset", "static"}
+
+
+class TokenBuckets:
+    """Token buckets per client, the least recently seen are evicted"""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()  # client -> [tokens, last refill]
+        self.lock = threading.Lock()
+
+    def take(self, client: str) -> float:
+        """Takes a token for the client
+
+        :return: 0 if the request is admitted, otherwise the seconds until
+            a token is available
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                bucket = self.buckets[client] = [self.burst, now]
+                if len(self.buckets) > self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(client)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+
+class ConcurrencyLimiter:
+    """Counts the requests in flight and refuses more than the limit"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.inflight = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Admits a request if there is room for it"""
+        with self.lock:
+            if self.limit and self.inflight >= self.limit:
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self):
+        """Marks an admitted request as finished"""
+        with self.lock:
+            self.inflight -= 1
+
+
+def pool_saturation(engine) -> float:
+    """Returns the share of the engine's connections that are checked out
+
+    Pools without a fixed size, such as the ones used for SQLite, report 0.
+    """
+    pool = engine.pool
+    if not hasattr(pool, "checkedout") or not hasattr(pool, "size"):
+        return 0.0
+    capacity = pool.size() + max(pool._max_overflow, 0)  # pylint: disable=protected-access
+    if capacity <= 0:
+        return 0.0
+    return pool.checkedout() / capacity
+
+
+def client_id(header: str = None) -> str:
+    """Identifies the client of the current request
+
+    :param header: a request header that holds the client identity, such as
+        X-Forwarded-For behind a trusted proxy
+    """
+    if header and header in request.headers:
+        return request.headers[header].split(",")[0].strip()
+    return request.remote_addr or "unknown"
+
+
+######################################################################
+# Install the admission hooks on the app
+######################################################################
+def init_admission(app):
+    """Checks the rate, concurrency and database limits before each request"""
+    rate = app.config["ADMISSION_RATE_LIMIT"]
+    buckets = TokenBuckets(rate, app.config["ADMISSION_BURST"] or max(1, 2 * rate)) if rate else None
+    limiter = ConcurrencyLimiter(app.config["ADMISSION_MAX_INFLIGHT"])
+    app.extensions["admission"] = limiter
+
+    @app.before_request
+    def admit_request():
+        """Refuses the request when a limit is exceeded"""
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return
+        if buckets:
+            wait = buckets.take(client_id(app.config["ADMISSION_CLIENT_HEADER"]))
+            if wait:
+                raise TooManyRequests("Rate limit exceeded, slow down.", retry_after=math.ceil(wait))
+        max_saturation = app.config["ADMISSION_MAX_POOL_SATURATION"]
+        if max_saturation and pool_saturation(app.extensions["sqlalchemy"].engine) >= max_saturation:
+            raise ServiceUnavailable("Database is saturated, try again later.", retry_after=1)
+        if not limiter.acquire():
+            raise ServiceUnavailable("Too many requests in flight, try again later.", retry_after=1)
+        g.admitted = True
+
+    @app.teardown_request
+    def release_request(_error):
+        """Frees the slot of an admitted request"""
+        if g.pop("admitted", False):
+            limiter.release()
@@ -0,0 +1,99 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Product Archival
+
+Moves the Products that have been unavailable for ARCHIVE_AFTER_DAYS out
+of the products table into product_archive, see ProductArchive. Passes
+run every ARCHIVE_INTERVAL_SECONDS in a background thread of each worker,
+or on demand with flask db-archive. A pass works in batches of
+ARCHIVE_BATCH_SIZE committed one by one, and on PostgreSQL the rows of a
+batch are locked with SKIP LOCKED, so the passes of several workers share
+the work instead of blocking each other or the requests.
+"""
+import logging
+import threading
+from datetime import timedelta
+from service.models import ProductArchive, db
+
+logger = logging.getLogger("flask.app")
+
+
+class Archiver:
+    """Runs the archival passes in a background thread"""
+
+    def __init__(self):
+        self.app = None
+        self.interval = 0
+        self.after_days = 90
+        self.batch_size = 500
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def init_app(self, app):
+        """Reads the settings and starts the passes with the first request"""
+        self.app = app
+        self.interval = app.config.get("ARCHIVE_INTERVAL_SECONDS", self.interval)
+        self.after_days = app.config.get("ARCHIVE_AFTER_DAYS", self.after_days)
+        self.batch_size = app.config.get("ARCHIVE_BATCH_SIZE", self.batch_size)
+        if self.interval:
+            # started lazily so that a preloading master never forks with
+            # an archival thread that the workers lack
+            app.before_request(self.start)
+
+    def start(self):
+        """Starts the background passes in this process if they are not running"""
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="product-archival", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops the background passes"""
+        thread = self.thread
+        if thread:
+            self.stopping.set()
+            thread.join()
+            self.thread = None
+
+    def run_pass(self) -> int:
+        """Archives the Products that have been unavailable for long enough
+
+        :return: the number of Products archived
+        """
+        with self.app.app_context():
+            try:
+                return ProductArchive.archive_unavailable(timedelta(days=self.after_days), self.batch_size)
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _run(self):
+        """Runs a pass every interval until stopped"""
+        while not self.stopping.wait(self.interval):
+            try:
+                self.run_pass()
+            except Exception:  # pylint: disable=broad-except
+                # try again next time, the thread must keep running
+                logger.exception("Product archival pass failed")
+
+
+# The archiver of this process
+archiver = Archiver()
@@ -0,0 +1,132 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Static Asset Pipeline
+
+At startup every file in the static folder is content hashed and
+precompressed once. The files are served under fingerprinted names such
+as css/cerulean_bootstrap.min.3f2a9c1b4d5e.css with immutable far-future
+cache headers, and index.html is rewritten to reference them.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+from flask import Response, request
+from service.common import compression
+
+ASSETS_URL = "/assets/"
+INDEX_FILE = "index.html"
+
+# Long cached assets never change because their name changes with them
+IMMUTABLE = "public, max-age=31536000, immutable"
+# The index page must be revalidated so that new fingerprints are picked up
+REVALIDATE = "no-cache"
+
+STATIC_REFERENCE = re.compile(r'(?P<prefix>(?:href|src)\s*=\s*")/?static/(?P<path>[^"]+)"')
+
+
+class Asset:
+    """A static file with its content hash and precompressed bodies"""
+
+    def __init__(self, data: bytes, mimetype: str, bodies: dict):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        # maps a Content-Encoding (or None) to the body to send
+        self.bodies = {None: data}
+        self.bodies.update(bodies)
+
+
+class AssetPipeline:
+    """Fingerprints, precompresses and serves the static files"""
+
+    def __init__(self):
+        self.manifest = {}  # logical path -> fingerprinted path
+        self.assets = {}  # fingerprinted path -> Asset
+        self.index = None
+        self.encodings = {}
+
+    def build(self, static_folder: str, encodings: dict):
+        """Reads, hashes and precompresses every file in the static folder
+
+        :param static_folder: the folder to read the files from
+        :param encodings: maps a Content-Encoding to (compressor, level)
+        """
+        self.manifest = {}
+        self.assets = {}
+        self.encodings = encodings
+        for root, _, files in os.walk(static_folder):
+            for name in sorted(files):
+                path = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, "/")
+                if path == INDEX_FILE:
+                    continue
+                with open(os.path.join(root, name), "rb") as file:
+                    asset = self.load(path, file.read())
+                stem, extension = os.path.splitext(path)
+                fingerprinted = f"{stem}.{asset.digest}{extension}"
+                self.manifest[path] = fingerprinted
+                self.assets[fingerprinted] = asset
+
+        with open(os.path.join(static_folder, INDEX_FILE), "rb") as file:
+            html = file.read().decode("utf-8")
+        self.index = self.load(INDEX_FILE, self.rewrite(html).encode("utf-8"))
+
+    def load(self, path: str, data: bytes) -> Asset:
+        """Creates an Asset keeping only the encodings that make it smaller"""
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        bodies = {}
+        for encoding, (compressor_class, level) in self.encodings.items():
+            compressor = compressor_class(level)
+            body = compressor.compress(data) + compressor.finish()
+            if len(body) < len(data):
+                bodies[encoding] = body
+        return Asset(data, mimetype, bodies)
+
+    def url_for(self, path: str) -> str:
+        """Returns the fingerprinted URL of a static file"""
+        return ASSETS_URL + self.manifest.get(path, path)
+
+    def rewrite(self, html: str) -> str:
+        """Points static references in an html page at their fingerprinted URLs"""
+        return STATIC_REFERENCE.sub(
+            lambda match: f'{match.group("prefix")}{self.url_for(match.group("path"))}"', html
+        )
+
+    def send(self, asset: Asset, cache_control: str) -> Response:
+        """Returns the asset in the best accepted encoding, or 304 if unchanged"""
+        encoding = compression.negotiate({key: None for key in asset.bodies if key})
+        response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+        response.set_etag(f"{asset.digest}-{encoding}" if encoding else asset.digest)
+        response.headers["Cache-Control"] = cache_control
+        response.vary.add("Accept-Encoding")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        return response.make_conditional(request)
+
+
+# The pipeline used by the routes, built by init_assets()
+pipeline = AssetPipeline()
+
+
+def init_assets(app):
+    """Builds the asset pipeline from the app's static folder"""
+    encodings = {
+        encoding: (compressor_class, app.config["ASSETS_COMPRESSION_LEVELS"][encoding])
+        for encoding, (compressor_class, _) in compression.available_encodings(app).items()
+    }
+    pipeline.build(app.static_folder, encodings)
+    app.logger.info("Static assets fingerprinted: %d files", len(pipeline.assets))
@@ -1,8 +1,12 @@
 """
 Flask CLI Command Extensions
 """
+from datetime import timedelta
+import click
 from service import app
-from service.models import db
+from service.models import db, CategorySummary, DataValidationError, IdempotencyKey, Product, ProductArchive, ProductChange
+from service.common import snapshots
+from service.common.sharding import shard_set
 
 
 ######################################################################
@@ -18,3 +22,132 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to partition the products table by category
+# Usage: flask db-partition
+######################################################################
+@app.cli.command("db-partition")
+def db_partition():
+    """
+    Partitions the products table by category on PostgreSQL, migrating
+    its rows, or adds the partitions of new categories
+    """
+    engines = [db.engine] + shard_set.engines
+    if any(engine.dialect.name != "postgresql" for engine in engines):
+        raise click.ClickException("Partitioning requires PostgreSQL")
+    for engine in engines:
+        statements = Product.partition_by_category(engine)
+        print(f"Ran {len(statements)} statements on {engine.url.render_as_string(hide_password=True)}")
+
+
+######################################################################
+# Command to convert the stored prices to or from integer minor units
+# Usage: flask db-price-storage [--numeric]
+######################################################################
+@app.cli.command("db-price-storage")
+@click.option("--numeric", is_flag=True, help="Convert back from minor units to NUMERIC")
+def db_price_storage(numeric):
+    """
+    Converts the price columns to a BIGINT count of minor units on
+    PostgreSQL, or back to NUMERIC. Run it with the current
+    PRICE_CENTS_ENABLED and then restart the service with the new one.
+    """
+    engines = [db.engine] + shard_set.engines
+    if any(engine.dialect.name != "postgresql" for engine in engines):
+        raise click.ClickException("Converting the price storage requires PostgreSQL")
+    for engine in engines:
+        try:
+            statements = Product.migrate_price_storage(engine, not numeric, app.config["PRICE_MINOR_DIGITS"])
+        except DataValidationError as error:
+            raise click.ClickException(str(error)) from error
+        print(f"Ran {len(statements)} statements on {engine.url.database}")
+
+
+######################################################################
+# Command to rebuild the category statistics summary
+# Usage: flask db-stats-rebuild
+######################################################################
+@app.cli.command("db-stats-rebuild")
+def db_stats_rebuild():
+    """
+    Recomputes the category statistics summary from the products table
+    """
+    CategorySummary.rebuild()
+
+
+######################################################################
+# Command to remove expired idempotency keys
+# Usage: flask db-idempotency-purge
+######################################################################
+@app.cli.command("db-idempotency-purge")
+def db_idempotency_purge():
+    """
+    Deletes the idempotency keys whose replay window has expired
+    """
+    count = IdempotencyKey.purge()
+    print(f"Purged {count} expired idempotency keys")
+
+
+######################################################################
+# Command to remove the Product changes past their retention
+# Usage: flask db-changes-purge
+######################################################################
+@app.cli.command("db-changes-purge")
+@click.option("--days", type=float, help="Days a change is kept, defaults to CHANGES_RETENTION_DAYS")
+@click.option("--batch-size", default=1000, show_default=True, help="Changes deleted per batch")
+def db_changes_purge(days, batch_size):
+    """
+    Deletes the Product changes older than the retention period
+    """
+    days = app.config["CHANGES_RETENTION_DAYS"] if days is None else days
+    count = ProductChange.purge(timedelta(days=days), batch_size)
+    print(f"Purged {count} Product changes")
+
+
+######################################################################
+# Command to move Products to the shard their id hashes to
+# Usage: flask db-shards-rebalance
+######################################################################
+@app.cli.command("db-shards-rebalance")
+@click.option("--batch-size", default=500, show_default=True, help="Products moved per batch")
+def db_shards_rebalance(batch_size):
+    """
+    Moves Products between shards after SQLALCHEMY_SHARD_URIS changed
+    """
+    count = Product.rebalance(batch_size)
+    print(f"Moved {count} Products to their shards")
+
+
+######################################################################
+# Command to move long unavailable Products to the archive
+# Usage: flask db-archive
+######################################################################
+@app.cli.command("db-archive")
+@click.option("--days", type=float, help="Days unavailable before archival, defaults to ARCHIVE_AFTER_DAYS")
+@click.option("--batch-size", type=int, help="Products moved per batch, defaults to ARCHIVE_BATCH_SIZE")
+def db_archive(days, batch_size):
+    """
+    Moves the Products that have been unavailable for long to the archive
+    """
+    days = app.config["ARCHIVE_AFTER_DAYS"] if days is None else days
+    batch_size = batch_size or app.config["ARCHIVE_BATCH_SIZE"]
+    count = ProductArchive.archive_unavailable(timedelta(days=days), batch_size)
+    print(f"Archived {count} Products")
+
+
+######################################################################
+# Command to write a new generation of the shared catalog snapshot
+# Usage: flask snapshot-build
+######################################################################
+@app.cli.command("snapshot-build")
+def snapshot_build():
+    """
+    Rebuilds the catalog snapshot that the workers map from SNAPSHOT_PATH
+    """
+    path = app.config["SNAPSHOT_PATH"]
+    if snapshots.build(app, path):
+        print(f"Built catalog snapshot {path}")
+    else:
+        print(f"Catalog snapshot {path} is being built by another process")
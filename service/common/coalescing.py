@@ -0,0 +1,127 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Coalescing
+
+Identical reads that arrive while the same query is already running in
+the worker wait for it and share its serialized result instead of running
+the query again. Only the serialized (plain JSON) result is shared, never
+ORM instances, because those belong to the session of the request that
+loaded them. A caller waits at most COALESCING_WAIT_SECONDS for the call
+in progress and then runs its own, so a stuck query does not hold every
+identical request with it. The counters report how many calls shared a
+result and how many gave up waiting and ran their own.
+"""
+import threading
+
+
+class Flight:
+    """A call in progress and the result it will produce"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time and shares its result"""
+
+    def __init__(self):
+        self.flights = {}  # key -> Flight in progress
+        self.lock = threading.Lock()
+        self.joined = threading.Condition(self.lock)  # notified when a caller starts waiting
+        self.enabled = True
+        self.wait_seconds = 30.0
+        self.leaders = 0
+        self.coalesced = 0
+        self.timed_out = 0
+        self.waiting = 0
+
+    def init_app(self, app):
+        """Reads the settings from the app configuration"""
+        self.enabled = app.config.get("COALESCING_ENABLED", self.enabled)
+        self.wait_seconds = app.config.get("COALESCING_WAIT_SECONDS", self.wait_seconds)
+        self.reset()
+
+    def reset(self):
+        """Zeroes the counters"""
+        with self.lock:
+            self.leaders = 0
+            self.coalesced = 0
+            self.timed_out = 0
+
+    def do(self, key, call):
+        """Returns call(), or the result of an identical call in progress
+
+        :param key: identifies calls that produce the same result
+        :param call: returns the serialized result, it is only run by the
+            first caller for a key, later callers share its result or error
+            unless it takes longer than wait_seconds
+        """
+        if not self.enabled:
+            return call()
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.waiting += 1
+                self.joined.notify_all()
+        if not leader:
+            shared = flight.done.wait(self.wait_seconds)
+            with self.lock:
+                self.waiting -= 1
+                if shared:
+                    self.coalesced += 1
+                else:
+                    self.timed_out += 1
+            if not shared:
+                return call()
+            if flight.error:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = call()
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def metrics(self) -> dict:
+        """Returns the call counters and the share of coalesced calls"""
+        with self.lock:
+            calls = self.leaders + self.coalesced + self.timed_out
+            return {
+                "calls": calls,
+                "executed": self.leaders + self.timed_out,
+                "coalesced": self.coalesced,
+                "timed_out": self.timed_out,
+                "in_flight": len(self.flights),
+                "waiting": self.waiting,
+                "coalescing_ratio": round(self.coalesced / calls, 4) if calls else 0.0,
+            }
+
+
+# The single-flight group used by the routes
+flights = SingleFlight()
@@ -0,0 +1,184 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Response Compression
+
+This module negotiates a Content-Encoding with the client and compresses
+responses after the request has been handled. Buffered responses smaller
+than COMPRESSION_MIN_SIZE are sent as they are, streamed responses are
+compressed chunk by chunk without buffering the whole body. The ETag of
+a compressed response gets the encoding appended, like the static assets,
+because its bytes differ from the uncompressed ones.
+
+gzip is always available, br and zstd are offered when the optional
+brotli and zstandard packages are installed.
+"""
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+######################################################################
+# Streaming compressors with a common compress() / flush() / finish()
+######################################################################
+class GzipCompressor:
+    """gzip compressor"""
+
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk"""
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """Flushes what has been compressed so far to the client"""
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """Ends the stream"""
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    """brotli compressor"""
+
+    def __init__(self, level: int):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk"""
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        """Flushes what has been compressed so far to the client"""
+        return self.compressor.flush()
+
+    def finish(self) -> bytes:
+        """Ends the stream"""
+        return self.compressor.finish()
+
+
+class ZstdCompressor:
+    """zstandard compressor"""
+
+    def __init__(self, level: int):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk"""
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """Flushes what has been compressed so far to the client"""
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        """Ends the stream"""
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+def available_encodings(app) -> dict:
+    """Returns the supported encodings mapped to (compressor, level) in order of preference"""
+    encodings = {}
+    if zstandard:
+        encodings["zstd"] = (ZstdCompressor, app.config["COMPRESSION_ZSTD_LEVEL"])
+    if brotli:
+        encodings["br"] = (BrotliCompressor, app.config["COMPRESSION_BROTLI_LEVEL"])
+    encodings["gzip"] = (GzipCompressor, app.config["COMPRESSION_LEVEL"])
+    return encodings
+
+
+def negotiate(encodings: dict):
+    """Returns the encoding the client accepts with the best quality, or None"""
+    accepted = request.accept_encodings
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = accepted[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress_stream(chunks, compressor):
+    """Compresses an iterable of chunks one chunk at a time"""
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+######################################################################
+# Install the compression hook on the app
+######################################################################
+def init_compression(app):
+    """Compresses responses that the client accepts an encoding for"""
+    encodings = available_encodings(app)
+
+    @app.after_request
+    def compress_response(response):
+        """Compresses the response body if it is worth it"""
+        if not should_compress(app, response):
+            return response
+        encoding = negotiate(encodings)
+        if not encoding:
+            return response
+        compressor_class, level = encodings[encoding]
+        compressor = compressor_class(level)
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, compressor)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config["COMPRESSION_MIN_SIZE"]:
+                return response
+            response.set_data(compressor.compress(data) + compressor.finish())
+
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+        return response
+
+    app.logger.info("Response compression established with %s", ", ".join(encodings))
+
+
+def should_compress(app, response) -> bool:
+    """Checks whether a response may be compressed at all"""
+    return (
+        app.config["COMPRESSION_ENABLED"]
+        and request.method != "HEAD"
+        and 200 <= response.status_code < 300
+        and response.status_code != 204
+        and not response.direct_passthrough
+        and "Content-Encoding" not in response.headers
+        and response.mimetype in app.config["COMPRESSION_MIMETYPES"]
+    )
@@ -0,0 +1,88 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Total Counts
+
+The X-Total-Count of a list request is computed in the mode the client
+asks for with ?count=, a GET without it has no count and a HEAD counts
+exactly:
+
+- exact counts the matching Products
+- estimate takes the row estimate of the PostgreSQL planner, which costs
+  a plan instead of a scan but can be off by the staleness of the table
+  statistics, other databases fall back to exact
+- cached keeps the exact count of each filter until the change log
+  moves, so it is refreshed by the next request after any worker writes
+"""
+import threading
+from collections import OrderedDict
+from service.models import Product, ProductChange
+
+MODES = ("exact", "estimate", "cached")
+
+
+class TotalCounter:
+    """Counts the Products of a filter in the requested mode"""
+
+    def __init__(self):
+        self.counts = OrderedDict()  # filter -> (change seq, count)
+        self.lock = threading.Lock()
+        self.size = 1000
+
+    def init_app(self, app):
+        """Reads the cache size from the app configuration"""
+        self.size = app.config.get("TOTAL_COUNT_CACHE_SIZE", self.size)
+        self.clear()
+
+    def clear(self):
+        """Forgets the cached counts"""
+        with self.lock:
+            self.counts.clear()
+
+    def count(self, filters: dict, mode: str = "exact") -> int:
+        """Returns the number of Products that match the filters
+
+        :param filters: the name, category or available filter of the list
+        :param mode: exact, estimate or cached
+        """
+        if mode == "estimate":
+            return Product.count(**filters, estimate=True)
+        if mode == "cached":
+            return self._cached(filters)
+        return Product.count(**filters)
+
+    def _cached(self, filters: dict) -> int:
+        """Returns the cached count, or counts again if anything changed since"""
+        key = tuple(sorted(filters.items()))
+        # read before counting, a change in between only causes a recount
+        seq = ProductChange.latest()
+        with self.lock:
+            entry = self.counts.get(key)
+            if entry and entry[0] == seq:
+                self.counts.move_to_end(key)
+                return entry[1]
+        total = Product.count(**filters)
+        with self.lock:
+            self.counts[key] = (seq, total)
+            self.counts.move_to_end(key)
+            while len(self.counts) > self.size:
+                self.counts.popitem(last=False)
+        return total
+
+
+# The counter used by the routes
+counter = TotalCounter()
@@ -0,0 +1,204 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Product Change Events
+
+Pushes the entries of the Product change log to Server-Sent Events
+subscribers. One poller thread per worker tails the product_change table,
+so changes committed by any worker are seen, and is woken right away when
+this worker commits a change. New entries go into a bounded buffer shared
+by every subscriber and a condition wakes them: a subscriber holds no
+queue and no thread of its own, only the generator that writes its
+response. Under the gevent worker that makes thousands of idle
+subscribers per process cheap. With the sync and gthread workers each
+open stream holds a request thread for its whole life, so the gunicorn
+configuration tells the broadcaster how many threads the worker has and
+streams are refused once only EVENTS_RESERVED_THREADS are left for the
+other requests, whatever EVENTS_MAX_SUBSCRIBERS says.
+
+A subscriber resumes from the Last-Event-ID it reconnects with, reading
+the entries that are no longer buffered back from the change log.
+"""
+import json
+import logging
+import threading
+from collections import deque
+from service.models import ProductChange
+
+logger = logging.getLogger("flask.app")
+
+
+def format_event(change: dict) -> str:
+    """Formats a serialized change as a Server-Sent Event"""
+    data = json.dumps({"id": change["id"], "product": change["product"], "changed_at": change["changed_at"]})
+    return f"id: {change['seq']}\nevent: {change['op']}\ndata: {data}\n\n"
+
+
+class ChangeBroadcaster:
+    """Tails the change log and fans the entries out to subscribers"""
+
+    def __init__(self):
+        self.app = None
+        self.buffer = deque()  # (seq, event text) of the latest changes
+        self.head = 0  # seq of the latest change seen
+        self.floor = 0  # the buffer holds every change after this seq
+        self.subscribers = 0
+        self.condition = threading.Condition()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.buffer_size = 1000
+        self.poll_interval = 1.0
+        self.heartbeat = 15.0
+        self.max_subscribers = 1000
+        self.threads = None  # request threads of the worker, None if streams hold none
+        self.reserved_threads = 1
+        self.page_size = 500
+
+    def init_app(self, app):
+        """Reads the settings and wakes the poller when a change commits"""
+        self.app = app
+        self.buffer_size = app.config.get("EVENTS_BUFFER_SIZE", self.buffer_size)
+        self.poll_interval = app.config.get("EVENTS_POLL_INTERVAL", self.poll_interval)
+        self.heartbeat = app.config.get("EVENTS_HEARTBEAT", self.heartbeat)
+        self.max_subscribers = app.config.get("EVENTS_MAX_SUBSCRIBERS", self.max_subscribers)
+        self.reserved_threads = app.config.get("EVENTS_RESERVED_THREADS", self.reserved_threads)
+        if self.wakeup.set not in ProductChange.listeners:
+            ProductChange.listeners.append(self.wakeup.set)
+
+    def start(self):
+        """Starts the poller in this process if it is not running
+
+        It is started lazily by the first subscriber so that a preloading
+        master never forks with a poller thread that the workers lack.
+        """
+        with self.condition:
+            if self.thread and self.thread.is_alive():
+                return
+            self.head = self.floor = self._latest()
+            self.buffer.clear()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="product-events", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops the poller, open streams only receive keep-alives after"""
+        thread = self.thread
+        if thread:
+            self.stopping.set()
+            self.wakeup.set()
+            thread.join()
+            self.thread = None
+
+    def capacity(self) -> int:
+        """Returns the number of streams this worker can hold open"""
+        if self.threads is None:
+            return self.max_subscribers
+        return min(self.max_subscribers, max(self.threads - self.reserved_threads, 0))
+
+    def subscribe(self, last_event_id: int = None):
+        """Takes a subscriber slot and returns the seq to start after
+
+        The slot must be given back with unsubscribe() when the response
+        is closed, whether or not the stream was ever read.
+
+        :param last_event_id: the last seq the subscriber has seen, or None
+            to receive only the changes from now on
+        :return: the seq to stream after, or None if there is no free slot
+        """
+        self.start()
+        with self.condition:
+            if self.subscribers >= self.capacity():
+                return None
+            self.subscribers += 1
+            return self.head if last_event_id is None else last_event_id
+
+    def unsubscribe(self):
+        """Gives back the slot of a closed stream"""
+        with self.condition:
+            self.subscribers -= 1
+
+    def stream(self, cursor: int):
+        """Yields the events after cursor and then the new ones as they come
+
+        Comment lines are sent every EVENTS_HEARTBEAT seconds so that idle
+        connections are not closed by proxies.
+        """
+        yield f"retry: {int(self.poll_interval * 1000) + 1000}\n\n"
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.head > cursor, timeout=self.heartbeat  # pylint: disable=cell-var-from-loop
+                )
+                floor = self.floor
+                events = [] if cursor < floor else [item for item in self.buffer if item[0] > cursor]
+            if cursor < floor:
+                events = self._read(cursor)
+                if not events:
+                    # nothing left in the log before the buffer
+                    cursor = floor
+                    continue
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            cursor = events[-1][0]
+            yield "".join(text for _, text in events)
+
+    def _run(self):
+        """Polls the change log and notifies the subscribers"""
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                break
+            try:
+                self._poll()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not poll the product change log")
+
+    def _poll(self):
+        """Buffers the changes committed since the last poll"""
+        events = self._read(self.head)
+        if not events:
+            return
+        with self.condition:
+            self.buffer.extend(item for item in events if item[0] > self.head)
+            while len(self.buffer) > self.buffer_size:
+                self.floor = self.buffer.popleft()[0]
+            self.head = max(self.head, events[-1][0])
+            self.condition.notify_all()
+
+    def _read(self, seq: int) -> list:
+        """Reads the next page of (seq, event text) from the change log
+
+        Runs in its own app context so the database session is released
+        as soon as the page is read.
+        """
+        with self.app.app_context():
+            return [
+                (change.seq, format_event(change.serialize()))
+                for change in ProductChange.since(seq, self.page_size)
+            ]
+
+    def _latest(self) -> int:
+        """Returns the seq of the latest change in the log"""
+        with self.app.app_context():
+            return ProductChange.latest()
+
+
+# The broadcaster used by the routes
+broadcaster = ChangeBroadcaster()
@@ -0,0 +1,164 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Idempotency Keys
+
+Runs a request at most once per Idempotency-Key and replays its response
+to retries. Completed responses are kept in an in-memory LRU tier in front
+of the idempotency_key table, and concurrent duplicates inside a worker
+wait for the first one instead of running again. Across workers the
+primary key of the table decides who runs the request; the others get a
+409 Conflict until it has completed.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from flask import abort
+from sqlalchemy import event
+from service.models import IdempotencyKey, db
+from service.common import status
+
+HEADER = "Idempotency-Key"
+REPLAYED = "Idempotent-Replayed"
+
+
+def fingerprint(payload) -> str:
+    """Returns a hash that identifies a request payload"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """Memory tier and in-flight tracking in front of IdempotencyKey"""
+
+    def __init__(self):
+        self.cache = OrderedDict()  # key -> (expires, fingerprint, response)
+        self.inflight = {}  # key -> threading.Event set when the leader is done
+        self.lock = threading.Lock()
+        self.size = 10000
+        self.ttl = 86400
+        self.lock_seconds = 30
+
+    def init_app(self, app):
+        """Reads the limits from the app configuration"""
+        self.size = app.config.get("IDEMPOTENCY_CACHE_SIZE", self.size)
+        self.ttl = app.config.get("IDEMPOTENCY_TTL_SECONDS", self.ttl)
+        self.lock_seconds = app.config.get("IDEMPOTENCY_LOCK_SECONDS", self.lock_seconds)
+        self.clear()
+
+    def clear(self):
+        """Forgets the memory tier"""
+        with self.lock:
+            self.cache.clear()
+
+    def run(self, key: str, payload, write, respond) -> tuple:
+        """Runs a request once for its key, or replays the stored response
+
+        :param key: the Idempotency-Key of the request
+        :param payload: the request body used to detect a reused key
+        :param write: performs the request and commits its changes
+        :param respond: returns (body, status, headers), called just before
+            write() commits so the response is stored in the same transaction
+        :return: a tuple of (body, status, headers, replayed)
+        :rtype: tuple
+        """
+        request_fingerprint = fingerprint(payload)
+        cached = self._cached(key)
+        if cached:
+            return self._replay(request_fingerprint, *cached)
+
+        with self.lock:
+            done = self.inflight.get(key)
+            leader = done is None
+            if leader:
+                done = self.inflight[key] = threading.Event()
+        if not leader:
+            done.wait(self.lock_seconds)
+            cached = self._cached(key)
+            if cached:
+                return self._replay(request_fingerprint, *cached)
+        try:
+            return self._run_once(key, request_fingerprint, write, respond)
+        finally:
+            if leader:
+                with self.lock:
+                    self.inflight.pop(key, None)
+                done.set()
+
+    def _run_once(self, key, request_fingerprint, write, respond) -> tuple:
+        """Claims the key in the database and runs the request"""
+        record, claimed = IdempotencyKey.claim(key, request_fingerprint, self.ttl, self.lock_seconds)
+        if not claimed:
+            if record.status is None:
+                abort(status.HTTP_409_CONFLICT, f"A request with {HEADER} '{key}' is in progress.")
+            response = record.response()
+            self._remember(key, record.fingerprint, response)
+            return self._replay(request_fingerprint, record.fingerprint, response)
+
+        session = db.session()
+        recorded = []
+
+        def record_response(_session):
+            body, code, headers = respond()
+            recorded.append((json.dumps(body), code, headers))
+            record.complete(*recorded[0])
+
+        event.listen(session, "before_commit", record_response, once=True)
+        try:
+            write()
+        except Exception:
+            record.release()
+            raise
+        finally:
+            if event.contains(session, "before_commit", record_response):
+                event.remove(session, "before_commit", record_response)
+        self._remember(key, request_fingerprint, recorded[0])
+        return (*recorded[0], False)
+
+    def _replay(self, request_fingerprint, stored_fingerprint, response) -> tuple:
+        """Returns a stored response if the key is reused for the same payload"""
+        if request_fingerprint != stored_fingerprint:
+            abort(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                f"{HEADER} has already been used with a different request body.",
+            )
+        return (*response, True)
+
+    def _cached(self, key):
+        """Returns (fingerprint, response) from the memory tier"""
+        with self.lock:
+            entry = self.cache.get(key)
+            if not entry:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry[1:]
+
+    def _remember(self, key, request_fingerprint, response):
+        """Keeps a completed response in the memory tier"""
+        with self.lock:
+            self.cache[key] = (time.monotonic() + self.ttl, request_fingerprint, response)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+
+# The store used by the routes
+store = IdempotencyStore()
@@ -0,0 +1,258 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Background Jobs
+
+Runs bulk operations outside of the request that asked for them: POST
+/jobs stores a queued Job and answers 202 Accepted right away, a bounded
+pool of JOBS_MAX_WORKERS threads per worker runs it, and GET /jobs/<id>
+reports its progress and result from the job table. At most
+JOBS_MAX_PENDING jobs are queued or running across all workers, more are
+refused with 503.
+
+A job reports its progress between batches of JOBS_BATCH_SIZE Products
+and stops there when it has been cancelled. Jobs run in threads because
+they wait on the database, not the CPU, and each one gets its own app
+context and session.
+
+The jobs of a worker live in its pool, so a worker that exits fails the
+jobs it still has: gunicorn's worker_exit hook calls shutdown(), which
+stops the running jobs at their next progress report. The jobs of a
+worker that died without shutting down stop sending heartbeats and are
+failed JOBS_STALE_SECONDS later by the next submission or status check.
+"""
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from service.models import Category, DataValidationError, Job, Product, ProductArchive, db
+
+logger = logging.getLogger("flask.app")
+
+
+class JobCancelled(Exception):
+    """Raised in a job when it has been cancelled"""
+
+
+class JobInterrupted(Exception):
+    """Raised in a job when its worker is shutting down"""
+
+
+class JobProgress:
+    """Passed to a running job to report its progress"""
+
+    def __init__(self, job_id: int, stopping: threading.Event):
+        self.job_id = job_id
+        self.stopping = stopping
+
+    def report(self, done: int, total: int = None):
+        """Records the progress and raises if the job must stop
+
+        :raises JobCancelled: the job was cancelled
+        :raises JobInterrupted: the worker is shutting down
+        """
+        if self.stopping.is_set():
+            raise JobInterrupted()
+        if Job.report(self.job_id, done, total):
+            raise JobCancelled()
+
+
+class JobRunner:
+    """The pool of threads that runs the jobs of this process"""
+
+    def __init__(self):
+        self.app = None
+        self.kinds = {}  # name -> function(progress, params) returning the result
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.max_workers = 2
+        self.max_pending = 10
+        self.batch_size = 100
+        self.stale_seconds = 600
+
+    def init_app(self, app):
+        """Reads the limits from the app configuration"""
+        self.app = app
+        self.max_workers = app.config.get("JOBS_MAX_WORKERS", self.max_workers)
+        self.max_pending = app.config.get("JOBS_MAX_PENDING", self.max_pending)
+        self.batch_size = app.config.get("JOBS_BATCH_SIZE", self.batch_size)
+        self.stale_seconds = app.config.get("JOBS_STALE_SECONDS", self.stale_seconds)
+
+    @staticmethod
+    def owner() -> str:
+        """Returns the name of this process as the owner of its jobs"""
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def kind(self, name: str):
+        """Registers a function as the job of a kind"""
+
+        def register(function):
+            self.kinds[name] = function
+            return function
+
+        return register
+
+    def submit(self, kind: str, params: dict):
+        """Queues a job
+
+        :return: the queued Job, or None when too many jobs are active
+        """
+        Job.abandon(stale_seconds=self.stale_seconds)
+        job = Job.create(kind, params, self.owner(), self.max_pending)
+        if job is not None:
+            self._executor().submit(self._run, job.id, kind, params)
+        return job
+
+    def find(self, job_id: int):
+        """Returns a Job, failed first if its owner stopped sending heartbeats"""
+        job = Job.find(job_id)
+        if job and job.status in Job.ACTIVE and job.heartbeat_at < datetime.utcnow() - timedelta(seconds=self.stale_seconds):
+            Job.abandon(stale_seconds=self.stale_seconds)
+            job = Job.find(job_id)
+        return job
+
+    def shutdown(self):
+        """Stops the running jobs at their next report and fails the others
+
+        Called when the worker exits, the jobs it owns could not finish.
+        """
+        if self.executor and self.pid == os.getpid():
+            self.stopping.set()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            with self.app.app_context():
+                Job.abandon(owner=self.owner())
+        self.executor = None
+        self.stopping.clear()
+
+    def _executor(self) -> ThreadPoolExecutor:
+        """Returns the pool, started lazily as its threads do not survive a fork"""
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="job")
+                self.pid = os.getpid()
+            return self.executor
+
+    def _run(self, job_id: int, kind: str, params: dict):
+        """Runs a job and records its outcome"""
+        try:
+            with self.app.app_context():
+                if Job.start(job_id) is None:
+                    return
+                try:
+                    result = self.kinds[kind](JobProgress(job_id, self.stopping), params)
+                except JobCancelled:
+                    db.session.rollback()
+                    Job.finish(job_id, Job.CANCELLED)
+                except JobInterrupted:
+                    db.session.rollback()
+                    Job.finish(job_id, Job.FAILED, error="The worker running the job stopped")
+                except Exception as error:  # pylint: disable=broad-except
+                    logger.exception("Job %s failed", job_id)
+                    db.session.rollback()
+                    Job.finish(job_id, Job.FAILED, error=str(error))
+                else:
+                    Job.finish(job_id, Job.SUCCEEDED, result)
+        except Exception:  # pylint: disable=broad-except
+            # nothing to report to, the pool thread must keep running
+            logger.exception("Job %s could not be recorded", job_id)
+
+
+# The job runner of this process
+runner = JobRunner()
+
+
+######################################################################
+# J O B S
+######################################################################
+def batches(items: list, size: int):
+    """Yields the slices of items with at most size elements"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+@runner.kind("import")
+def import_products(progress: JobProgress, params: dict) -> dict:
+    """Creates the Products listed in params["products"]"""
+    rows = params.get("products")
+    if not isinstance(rows, list):
+        raise DataValidationError("products must be a list of Products")
+    created, errors = [], {}
+    for number, batch in enumerate(batches(rows, runner.batch_size)):
+        products, batch_errors = Product.bulk_create(batch)
+        created += [product.id for product in products]
+        offset = number * runner.batch_size
+        errors.update({str(offset + index): messages for index, messages in batch_errors.items()})
+        progress.report(offset + len(batch), len(rows))
+    return {"created": created, "errors": errors}
+
+
+@runner.kind("export")
+def export_products(progress: JobProgress, _params: dict) -> dict:
+    """Writes every Product of the catalog to the output of the Job
+
+    Each batch is stored as a page of the output, GET /jobs/<id>/output
+    reads them back as one JSON array.
+    """
+    exported, last_id, page = 0, None, 0
+    while True:
+        criteria = [Product.id > last_id] if last_id is not None else []
+        batch = Product.gather(*criteria, limit=runner.batch_size)
+        Job.write_output(progress.job_id, page, [product.serialize() for product in batch])
+        exported += len(batch)
+        page += 1
+        # commits the page with the progress
+        progress.report(exported)
+        if len(batch) < runner.batch_size:
+            return {"exported": exported, "pages": page}
+        last_id = batch[-1].id
+
+
+@runner.kind("delete")
+def delete_products(progress: JobProgress, params: dict) -> dict:
+    """Deletes the Products of params["category"] or params["available"]"""
+    if "category" in params:
+        if params["category"] not in Category.__members__:
+            raise DataValidationError(f"Invalid category: {params['category']}")
+        products = Product.find_by_category(Category[params["category"]])
+    elif isinstance(params.get("available"), bool):
+        products = Product.find_by_availability(params["available"])
+    else:
+        raise DataValidationError("Select the Products to delete with category or available")
+    ids = [product.id for product in products]
+    deleted = 0
+    for number, batch in enumerate(batches(ids, runner.batch_size)):
+        for product_id in batch:
+            product = Product.find(product_id)
+            if product:
+                product.delete()
+                deleted += 1
+        progress.report(number * runner.batch_size + len(batch), len(ids))
+    return {"deleted": deleted}
+
+
+@runner.kind("archive")
+def archive_products(_progress: JobProgress, params: dict) -> dict:
+    """Moves the Products unavailable for params["days"] days to the archive"""
+    days = params.get("days", runner.app.config["ARCHIVE_AFTER_DAYS"])
+    if not isinstance(days, (int, float)) or isinstance(days, bool):
+        raise DataValidationError("days must be a number")
+    archived = ProductArchive.archive_unavailable(timedelta(days=days), runner.batch_size)
+    return {"archived": archived}
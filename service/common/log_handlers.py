@@ -19,19 +19,194 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+Records are put on a queue by the request thread and formatted and written
+by a QueueListener thread, so handler I/O never blocks a request. The
+request thread only merges the arguments into the message, as the
+standard QueueHandler does, since they may change or be unsafe to read
+once the call returns. INFO and DEBUG records can be sampled per logger
+before they are queued, and large arguments such as request payloads are
+truncated when they are merged.
 """
+import atexit
+import copy
+import itertools
+import json
 import logging
+import queue
+import reprlib
+from logging.handlers import QueueHandler, QueueListener
+
+FORMAT_STRING = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+# The listener that writes queued records and the handler that feeds it
+listener = None  # pylint: disable=invalid-name
+queue_handler = None  # pylint: disable=invalid-name
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    handlers = list(gunicorn_logger.handlers)
     # Make all log formats consistent
-    format_string = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
-    formatter = logging.Formatter(format_string, "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    max_payload = app.config.get("LOG_MAX_PAYLOAD")
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter(DATE_FORMAT, max_payload=max_payload)
+    else:
+        formatter = PayloadFormatter(FORMAT_STRING, DATE_FORMAT, max_payload=max_payload)
+    for handler in handlers:
         handler.setFormatter(formatter)
+
+    if handlers and app.config.get("LOG_QUEUE_ENABLED"):
+        handlers = [start_listener(handlers)]
+        handlers[0].setFormatter(formatter)
+    for handler in handlers:
+        # the handlers outlive the app, replace the filter of an earlier call
+        for sampling in [item for item in handler.filters if isinstance(item, SamplingFilter)]:
+            handler.removeFilter(sampling)
+        handler.addFilter(SamplingFilter(app.config.get("LOG_SAMPLE_RATES", {})))
+    app.logger.handlers = handlers
+    app.logger.setLevel(gunicorn_logger.level)
+    if handlers:
+        # the models log to "flask.app" which should be written the same way
+        model_logger = logging.getLogger("flask.app")
+        model_logger.propagate = False
+        model_logger.handlers = handlers
+        model_logger.setLevel(gunicorn_logger.level)
     app.logger.info("Logging handler established")
+
+
+def start_listener(handlers: list = None) -> QueueHandler:
+    """Starts the listener thread that writes queued records
+
+    Must be called again in a forked worker because the listener thread of
+    the parent process does not exist in the child.
+
+    :param handlers: the handlers to write to, defaults to the ones of the
+        current listener
+    :return: the handler that puts records on the queue
+    """
+    global listener, queue_handler  # pylint: disable=global-statement,invalid-name
+    if listener:
+        handlers = handlers or list(listener.handlers)
+        stop_listener()
+    log_queue = queue.SimpleQueue()
+    if queue_handler:
+        queue_handler.queue = log_queue
+    else:
+        queue_handler = DeferredQueueHandler(log_queue)
+        atexit.register(stop_listener)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return queue_handler
+
+
+def stop_listener():
+    """Writes the queued records and stops the listener thread"""
+    # pylint: disable=protected-access
+    if listener and listener._thread and listener._thread.is_alive():
+        listener.stop()
+
+
+######################################################################
+# Handlers, filters and formatters
+######################################################################
+class DeferredQueueHandler(QueueHandler):
+    """Queues records with their message merged but not yet formatted"""
+
+    def prepare(self, record):
+        """Merges the arguments and the exception into text in the calling thread
+
+        Unlike QueueHandler.prepare the time, level and layout are left to
+        the formatter of the listener, which runs in its own thread.
+        """
+        record = copy.copy(record)
+        if isinstance(self.formatter, PayloadFormatter):
+            self.formatter.truncate_args(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or (self.formatter or logging.Formatter()).formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in every 1/rate INFO or DEBUG records of each logger
+
+    Warnings and errors are never sampled.
+
+    :param rates: maps a logger name to the fraction of records to keep
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.intervals = {name: max(1, round(1 / rate)) if rate > 0 else 0 for name, rate in rates.items()}
+        self.counters = {name: itertools.count() for name in rates}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or record.name not in self.intervals:
+            return True
+        interval = self.intervals[record.name]
+        return interval > 0 and next(self.counters[record.name]) % interval == 0
+
+
+class PayloadFormatter(logging.Formatter):
+    """Formatter that truncates large arguments such as request payloads
+
+    :param max_payload: the maximum length of each formatted argument
+    """
+
+    def __init__(self, fmt=None, datefmt=None, max_payload: int = None):
+        super().__init__(fmt, datefmt)
+        self.repr = None
+        if max_payload:
+            self.repr = reprlib.Repr()
+            self.repr.maxstring = self.repr.maxother = max_payload
+            self.repr.maxdict = self.repr.maxlist = max(1, max_payload // 16)
+            self.repr.maxlevel = 3
+
+    def truncate(self, arg):
+        """Returns a bounded representation of a log argument"""
+        if isinstance(arg, (bool, int, float)):
+            return arg
+        if isinstance(arg, str):
+            if len(arg) <= self.repr.maxstring:
+                return arg
+            return arg[: self.repr.maxstring] + "..."
+        return self.repr.repr(arg)
+
+    def truncate_args(self, record):
+        """Replaces the arguments of a record with bounded representations"""
+        if self.repr and record.args:
+            if isinstance(record.args, tuple):
+                record.args = tuple(self.truncate(arg) for arg in record.args)
+            elif "%(" not in str(record.msg):
+                # logging unpacks a single dict argument such as a request payload
+                record.args = (self.truncate(record.args),)
+
+    def format(self, record):
+        self.truncate_args(record)
+        return super().format(record)
+
+
+class JsonFormatter(PayloadFormatter):
+    """Formats records as one JSON object per line"""
+
+    def __init__(self, datefmt=None, max_payload: int = None):
+        super().__init__(None, datefmt, max_payload)
+
+    def format(self, record):
+        super().format(record)
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.message,
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
@@ -0,0 +1,161 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Readiness Probe
+
+/health only tells that the process is alive, /ready tells a load
+balancer whether to send traffic to this worker. A background thread
+connects to the primary and every shard each READY_PROBE_INTERVAL
+seconds, so /ready answers from the last result and never waits on the
+database itself. The worker is unready:
+
+- until the first probe has succeeded and READY_WARMUP_SECONDS have passed
+- while the last probe failed, or is older than three intervals because
+  the probe is stuck on an unreachable database
+- while the connection pool saturation or the share of ADMISSION_MAX_INFLIGHT
+  in use is at READY_MAX_POOL_SATURATION / READY_MAX_INFLIGHT_RATIO, so
+  traffic moves away before admission control has to shed it
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import text
+from service.models import db
+from service.common.admission import pool_saturation
+from service.common.sharding import shard_set
+
+logger = logging.getLogger("flask.app")
+
+
+class ReadinessProbe:
+    """Probes the database in the background and reports readiness"""
+
+    def __init__(self):
+        self.app = None
+        self.interval = 2.0
+        self.warmup = 0.0
+        self.max_pool_saturation = 0.8
+        self.max_inflight_ratio = 0.8
+        self.started = time.monotonic()
+        self.result = None  # (ok, latency, error, monotonic time, datetime) of the last probe
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def init_app(self, app):
+        """Reads the thresholds from the app configuration"""
+        self.app = app
+        self.interval = app.config.get("READY_PROBE_INTERVAL", self.interval)
+        self.warmup = app.config.get("READY_WARMUP_SECONDS", self.warmup)
+        self.max_pool_saturation = app.config.get("READY_MAX_POOL_SATURATION", self.max_pool_saturation)
+        self.max_inflight_ratio = app.config.get("READY_MAX_INFLIGHT_RATIO", self.max_inflight_ratio)
+        self.started = time.monotonic()
+        self.result = None
+
+    def after_fork(self):
+        """Starts the warm-up again in a worker forked from a preloading master
+
+        The master imported the app long before the fork, so the warm-up
+        would already be over and a result could be inherited that this
+        worker never probed itself.
+        """
+        self.started = time.monotonic()
+        self.result = None
+        self.thread = None
+        self.stopping.clear()
+
+    def start(self):
+        """Starts the probe thread in this process if it is not running
+
+        It is started lazily by the first /ready request so that a
+        preloading master never forks with a thread the workers lack.
+        """
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="readiness-probe", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops the probe thread"""
+        thread = self.thread
+        if thread:
+            self.stopping.set()
+            thread.join()
+            self.thread = None
+
+    def probe(self):
+        """Connects to every database once and records the outcome"""
+        begin = time.monotonic()
+        try:
+            with self.app.app_context():
+                for engine in [db.engine] + shard_set.engines:
+                    with engine.connect() as connection:
+                        connection.execute(text("SELECT 1"))
+            ok, error = True, None
+        except Exception as exception:  # pylint: disable=broad-except
+            logger.warning("Readiness probe failed: %s", exception)
+            ok, error = False, str(exception)
+        now = time.monotonic()
+        self.result = (ok, now - begin, error, now, datetime.utcnow())
+
+    def report(self) -> tuple:
+        """Returns (ready, report) from the last probe without blocking"""
+        now = time.monotonic()
+        result = self.result
+        warming_up = result is None or now - self.started < self.warmup
+        database = {"ok": False, "checked_at": None}
+        if result:
+            ok, latency, error, checked, checked_at = result
+            stale = now - checked > 3 * self.interval
+            database = {
+                "ok": ok and not stale,
+                "latency_ms": round(latency * 1000, 1),
+                "checked_at": checked_at.isoformat(),
+                "error": "probe is stale" if stale and ok else error,
+            }
+        saturation = pool_saturation(self.app.extensions["sqlalchemy"].engine)
+        limiter = self.app.extensions.get("admission")
+        inflight = limiter.inflight / limiter.limit if limiter and limiter.limit else 0.0
+        overloaded = (self.max_pool_saturation and saturation >= self.max_pool_saturation) or (
+            self.max_inflight_ratio and inflight >= self.max_inflight_ratio
+        )
+        ready = database["ok"] and not warming_up and not overloaded
+        if ready:
+            state = "ready"
+        else:
+            state = "warming_up" if warming_up else "overloaded" if overloaded else "unready"
+        return ready, {
+            "status": state,
+            "database": database,
+            "pool_saturation": round(saturation, 3),
+            "inflight_ratio": round(inflight, 3),
+            "warming_up": warming_up,
+        }
+
+    def _run(self):
+        """Probes every interval until stopped"""
+        while True:
+            self.probe()
+            if self.stopping.wait(self.interval):
+                return
+
+
+# The readiness probe of this process
+probe = ReadinessProbe()
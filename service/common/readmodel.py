@@ -0,0 +1,228 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+In-Memory Read Model
+
+An optional in-process copy of the catalog that answers the list and
+search routes without a database round trip. Products are kept as rows
+by id with interned names, and every filterable value maps to the set of
+ids that have it. A filter intersects the sets of the values asked for,
+smallest first, so a query costs the size of its smallest set.
+
+The rows are not split into columns: a write touches one row and one
+entry per index instead of a position in every column, and the routes
+only ever filter on one value and return whole Products.
+
+The model is loaded at startup. A background thread per worker then
+applies the Product change log every READ_MODEL_REFRESH_SECONDS and
+right after this worker commits a change. Until the thread has read that
+change the worker serves every read from the database, so it still reads
+its own writes while the writing request does no more than set a flag.
+"""
+import itertools
+import logging
+import os
+import sys
+import threading
+from service.models import Category, Product, ProductChange
+
+logger = logging.getLogger("flask.app")
+
+
+class ReadModel:
+    """The Products with an id set per filterable value, kept current from the change log"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.refresh_seconds = 1.0
+        self.page_size = 1000
+        self.marks = itertools.count(1)
+        self.marked = 0  # bumped when this worker commits a change
+        self.applied = 0  # the last mark the refresh has caught up with
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.clear()
+
+    def clear(self):
+        """Empties every index"""
+        self.rows = {}  # product id -> serialized Product
+        self.by_available = {}  # availability -> ids
+        self.by_category = {}  # category code -> ids
+        self.by_name = {}  # name -> ids
+        self.seq = 0
+        self.loaded = False
+
+    def init_app(self, app):
+        """Loads the catalog when READ_MODEL_ENABLED is set"""
+        self.stop()
+        self.app = app
+        self.enabled = app.config.get("READ_MODEL_ENABLED", False)
+        self.refresh_seconds = app.config.get("READ_MODEL_REFRESH_SECONDS", self.refresh_seconds)
+        with self.refresh_lock, self.lock:
+            self.clear()
+        if not self.enabled:
+            return
+        if self.mark not in ProductChange.listeners:
+            ProductChange.listeners.append(self.mark)
+        self.refresh()
+
+    def mark(self):
+        """Sends reads to the database until the refresh has seen a local commit"""
+        self.marked = next(self.marks)
+        self.wakeup.set()
+
+    def start(self):
+        """Starts the refresh thread in this process if it is not running
+
+        It is started lazily by the first search so that a preloading
+        master never forks with a thread that the workers lack.
+        """
+        if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.stopping.clear()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="readmodel-refresh", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops the refresh thread"""
+        thread = self.thread
+        if thread and self.pid == os.getpid():
+            self.stopping.set()
+            self.wakeup.set()
+            thread.join()
+        self.thread = None
+
+    def _run(self):
+        """Refreshes when woken by a commit or when the refresh is due"""
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.refresh_seconds)
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not refresh the read model")
+
+    def refresh(self):
+        """Loads the catalog the first time, then applies the changes since"""
+        mark = self.marked
+        if self.loaded:
+            self.catch_up()
+        else:
+            self.load()
+        self.applied = mark
+
+    def load(self):
+        """Reads every Product into new indexes"""
+        with self.refresh_lock:
+            with self.app.app_context():
+                # changes logged while loading are applied again by catch_up()
+                seq = ProductChange.latest()
+                products = [product.serialize() for product in Product.gather()]
+            with self.lock:
+                self.clear()
+                for product in products:
+                    self._upsert(product)
+                self.seq = seq
+                self.loaded = True
+        logger.info("Loaded %d Products into the read model", len(products))
+        self.catch_up()
+
+    def catch_up(self):
+        """Applies the changes logged since the last one applied"""
+        with self.refresh_lock:
+            while True:
+                with self.app.app_context():
+                    changes = [change.serialize() for change in ProductChange.since(self.seq, self.page_size)]
+                if not changes:
+                    break
+                self.apply(changes)
+
+    def apply(self, changes: list):
+        """Applies serialized ProductChange entries in seq order"""
+        with self.lock:
+            for change in changes:
+                if change["seq"] <= self.seq:
+                    continue
+                self._delete(change["id"])
+                if change["op"] != "delete":
+                    self._upsert(change["product"])
+                self.seq = change["seq"]
+
+    def search(self, name: str = None, category: Category = None, available: bool = None):
+        """Returns the serialized Products that match every filter given in id order
+
+        None if the database must be read.
+        """
+        self.start()
+        with self.lock:
+            if not self.loaded or self.applied != self.marked:
+                return None
+            filters = [
+                index.get(key, ()) for index, key in (
+                    (self.by_name, name),
+                    (self.by_category, category.value if category is not None else None),
+                    (self.by_available, available),
+                )
+                if key is not None
+            ]
+            if not filters:
+                ids = self.rows.keys()
+            else:
+                filters.sort(key=len)
+                ids = set(filters[0]).intersection(*filters[1:])
+            return [self.rows[product_id] for product_id in sorted(ids)]
+
+    def _keys(self, product: dict) -> tuple:
+        """Returns each index with the key a serialized Product has in it"""
+        return (
+            (self.by_available, product["available"]),
+            (self.by_category, Category[product["category"]].value),
+            (self.by_name, product["name"]),
+        )
+
+    def _upsert(self, product: dict):
+        """Adds a serialized Product that is not in the indexes"""
+        product = dict(product, name=sys.intern(product["name"]))
+        self.rows[product["id"]] = product
+        for index, key in self._keys(product):
+            index.setdefault(key, set()).add(product["id"])
+
+    def _delete(self, product_id: int):
+        """Removes a Product from every index"""
+        product = self.rows.pop(product_id, None)
+        if product is None:
+            return
+        for index, key in self._keys(product):
+            ids = index[key]
+            ids.discard(product_id)
+            if not ids:
+                del index[key]
+
+
+# The read model used by the routes
+catalog = ReadModel()
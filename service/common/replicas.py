@@ -0,0 +1,130 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read Replica Routing
+
+RoutingSession sends the sharded tables to the shard chosen with
+use_shard(), see sharding.py. Other reads go to the replicas listed in
+SQLALCHEMY_REPLICA_URIS in round-robin order and everything else to the
+primary. Once a session has written, or has been told to use_primary(),
+it keeps reading from the primary so a request always sees its own
+writes. A replica that raises a connection error is ejected for
+REPLICA_EJECT_SECONDS and then tried again.
+"""
+import itertools
+import logging
+import threading
+import time
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.sql.dml import UpdateBase
+from service.common.sharding import SHARD, ShardingError, shard_set
+
+logger = logging.getLogger("flask.app")
+
+# Session.info key that pins a session to the primary
+PRIMARY = "use_primary"
+
+
+class ReplicaSet:
+    """The replica engines with round-robin selection and ejection"""
+
+    def __init__(self):
+        self.engines = []
+        self.ejected = {}  # engine -> time it may be tried again
+        self.eject_seconds = 30
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """Creates an engine for every replica URI of the app"""
+        self.dispose()
+        self.eject_seconds = app.config.get("REPLICA_EJECT_SECONDS", 30)
+        self.engines = []
+        self.ejected = {}
+        for uri in app.config.get("SQLALCHEMY_REPLICA_URIS", []):
+            engine = create_engine(uri, pool_pre_ping=True)
+            event.listen(engine, "handle_error", self._on_error)
+            self.engines.append(engine)
+        if self.engines:
+            logger.info("Routing reads to %d replicas", len(self.engines))
+
+    def choose(self):
+        """Returns the next healthy replica engine, or None to use the primary"""
+        count = len(self.engines)
+        now = time.monotonic()
+        for _ in range(count):
+            engine = self.engines[next(self.counter) % count]
+            retry_at = self.ejected.get(engine)
+            if retry_at is None:
+                return engine
+            if retry_at <= now:
+                # give it another chance, a new error ejects it again
+                with self.lock:
+                    self.ejected.pop(engine, None)
+                return engine
+        return None
+
+    def eject(self, engine):
+        """Stops routing reads to a replica for a while"""
+        logger.warning("Ejecting replica %s for %s seconds", engine.url, self.eject_seconds)
+        with self.lock:
+            self.ejected[engine] = time.monotonic() + self.eject_seconds
+
+    def healthy(self) -> list:
+        """Returns the replica engines that are not ejected"""
+        return [engine for engine in self.engines if engine not in self.ejected]
+
+    def dispose(self, close: bool = True):
+        """Releases the pooled connections of every replica"""
+        for engine in self.engines:
+            engine.dispose(close=close)
+
+    def _on_error(self, context):
+        """Ejects the replica when the database cannot be reached"""
+        if context.is_disconnect or context.connection is None:
+            engine = context.engine
+            if engine in self.engines:
+                self.eject(engine)
+
+
+# The replicas used by every RoutingSession
+replica_set = ReplicaSet()
+
+
+def use_primary(session):
+    """Makes a session read from the primary for the rest of its life"""
+    session.info[PRIMARY] = True
+
+
+class RoutingSession(Session):
+    """A session that reads from the replicas and writes to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        primary = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is None and shard_set.tables and mapper is not None and inspect(mapper).local_table in shard_set.tables:
+            if self.info.get(SHARD) is None:
+                raise ShardingError(f"No shard chosen for {inspect(mapper).class_.__name__}")
+            return shard_set.engines[self.info[SHARD]]
+        if bind is not None or not replica_set.engines:
+            return primary
+        if self._flushing or isinstance(clause, UpdateBase):
+            use_primary(self)
+            return primary
+        if self.info.get(PRIMARY):
+            return primary
+        return replica_set.choose() or primary
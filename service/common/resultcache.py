@@ -0,0 +1,185 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+List Result Cache
+
+Keeps the serialized JSON body of list requests answered from the
+database, keyed by their normalized filter, so a repeated listing costs
+a lookup instead of a query and a serialization.
+
+Every entry is stamped with a generation. Each Product change bumps the
+global generation, which expires the name, availability and unfiltered
+listings, and the generation of the categories it touches: the one the
+Product is in now and the ones whose cached listing holds it. A category
+listing therefore survives changes to other categories.
+
+Changes are read from the ProductChange log, so the writes of other
+workers are seen at most RESULT_CACHE_REFRESH_SECONDS later and the
+writes of this worker at once. The cache holds at most RESULT_CACHE_SIZE
+listings and RESULT_CACHE_MAX_BYTES of bodies and id sets, the least
+recently used are evicted first.
+"""
+import itertools
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from service.models import ProductChange
+
+
+class ResultCache:
+    """Serialized list results per filter, invalidated by generation"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.size = 1000
+        self.max_bytes = 64 * 1024 * 1024
+        self.refresh_seconds = 1.0
+        self.max_changes = 1000
+        self.entries = OrderedDict()  # filter -> (generation, body, count, ids, size)
+        self.bytes = 0
+        self.counter = itertools.count(1)
+        self.base = 0  # the generation of the categories not bumped since a reset
+        self.generation = 0  # bumped by every change
+        self.categories = {}  # category name -> generation
+        self.seq = 0  # the last change applied
+        self.due = 0.0  # when to read the change log again
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """Reads the limits from the app configuration"""
+        self.app = app
+        self.enabled = app.config.get("RESULT_CACHE_ENABLED", False)
+        self.size = app.config.get("RESULT_CACHE_SIZE", self.size)
+        self.max_bytes = app.config.get("RESULT_CACHE_MAX_BYTES", self.max_bytes)
+        self.refresh_seconds = app.config.get("RESULT_CACHE_REFRESH_SECONDS", self.refresh_seconds)
+        self.max_changes = app.config.get("RESULT_CACHE_MAX_CHANGES", self.max_changes)
+        self.clear()
+        if self.enabled and self.expire not in ProductChange.listeners:
+            ProductChange.listeners.append(self.expire)
+
+    def clear(self):
+        """Forgets every cached listing"""
+        with self.lock:
+            self._reset()
+            self.seq = 0
+            self.due = 0.0
+
+    def expire(self):
+        """Makes the next lookup read the change log, run after a local commit"""
+        self.due = 0.0
+
+    def fetch(self, filters: dict, find) -> tuple:
+        """Returns the JSON body and the length of a listing
+
+        :param filters: the name, category or available filter of the list
+        :param find: returns the serialized Products of the filters, called
+            when the cached body has expired
+        :return: a tuple of (body, count)
+        :rtype: tuple
+        """
+        self.sync()
+        key = tuple(sorted(filters.items()))
+        with self.lock:
+            generation = self._generation(filters)
+            entry = self.entries.get(key)
+            if entry and entry[0] == generation:
+                self.entries.move_to_end(key)
+                return entry[1], entry[2]
+            seq = self.seq
+        results = find(filters)
+        body = self.app.json.dumps(results).encode("utf-8")
+        # only category listings are expired by the ids they hold
+        ids = frozenset(product["id"] for product in results) if "category" in filters else None
+        with self.lock:
+            # a change applied while finding may have missed this listing
+            if seq == self.seq and generation == self._generation(filters):
+                self._store(key, (generation, body, len(results), ids, entry_size(body, ids)))
+        return body, len(results)
+
+    def sync(self):
+        """Applies the changes logged since the last sync when it is due"""
+        now = time.monotonic()
+        if now < self.due:
+            return
+        self.due = now + self.refresh_seconds
+        latest = ProductChange.latest()
+        if latest == self.seq:
+            return
+        changes = ProductChange.since(self.seq, self.max_changes) if latest > self.seq else []
+        with self.lock:
+            if not changes or changes[-1].seq < latest:
+                # the log was reset or too much changed to sort out
+                self._reset()
+                self.seq = latest
+                return
+            for change in changes:
+                if change.seq > self.seq:
+                    self._apply(change)
+                    self.seq = change.seq
+
+    def _generation(self, filters: dict) -> int:
+        """Returns the current generation of a filter"""
+        if "category" in filters:
+            return self.categories.get(filters["category"].name, self.base)
+        return self.generation
+
+    def _apply(self, change: ProductChange):
+        """Bumps the generations a change expires"""
+        self.generation = next(self.counter)
+        touched = {
+            key[0][1].name
+            for key, entry in self.entries.items()
+            if entry[3] is not None and change.product_id in entry[3]
+        }
+        if not change.deleted:
+            touched.add(json.loads(change.data)["category"])
+        for name in touched:
+            self.categories[name] = next(self.counter)
+
+    def _reset(self):
+        """Drops every entry and expires every generation"""
+        self.entries.clear()
+        self.bytes = 0
+        self.categories.clear()
+        self.base = self.generation = next(self.counter)
+
+    def _store(self, key: tuple, entry: tuple):
+        """Adds an entry and evicts the least recently used over the limits"""
+        if entry[4] > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous:
+            self.bytes -= previous[4]
+        self.entries[key] = entry
+        self.bytes += entry[4]
+        while len(self.entries) > self.size or self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted[4]
+
+
+def entry_size(body: bytes, ids: frozenset) -> int:
+    """Returns the bytes an entry holds: its body and the set of its ids"""
+    if ids is None:
+        return len(body)
+    return len(body) + sys.getsizeof(ids) + sum(sys.getsizeof(product_id) for product_id in ids)
+
+
+# The cache used by the routes
+cache = ResultCache()
@@ -0,0 +1,125 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Sharded Product Storage
+
+When SQLALCHEMY_SHARD_URIS lists databases, the sharded tables live on
+them instead of the primary. A row goes to the shard picked by a jump
+consistent hash of its id, so adding a shard only moves about 1/N of the
+rows. A session is pointed at the shard of the row it works on with
+use_shard(), and queries that are not about a single id run on every
+shard in parallel with gather().
+
+Everything else (the change log, idempotency keys, id allocation) stays
+on the primary. A transaction that writes a shard and the primary commits
+on each database in turn, so the two commits are not atomic.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, scoped_session
+
+logger = logging.getLogger("flask.app")
+
+# Session.info key that holds the shard a session works on
+SHARD = "shard"
+
+
+class ShardingError(Exception):
+    """Raised when a sharded table is used without choosing a shard"""
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Maps a key to one of buckets, moving few keys when buckets grows
+
+    The jump consistent hash of Lamping and Veach.
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+class ShardSet:
+    """The shard engines and the parallel scatter-gather"""
+
+    def __init__(self):
+        self.engines = []
+        self.tables = set()
+        self.executor = None
+
+    def init_app(self, app, tables: list):
+        """Creates an engine for every shard URI and the sharded tables on it"""
+        self.dispose()
+        self.engines = [create_engine(uri, pool_pre_ping=True) for uri in app.config.get("SQLALCHEMY_SHARD_URIS", [])]
+        self.tables = set(tables) if self.engines else set()
+        self._start_executor()
+        for engine in self.engines:
+            for table in self.tables:
+                table.create(engine, checkfirst=True)
+        if self.engines:
+            logger.info("Sharding %d tables across %d databases", len(self.tables), len(self.engines))
+
+    def shard_for(self, key: int) -> int:
+        """Returns the index of the shard that holds a key"""
+        return jump_hash(key, len(self.engines))
+
+    def gather(self, statement) -> list:
+        """Runs a SELECT on every shard in parallel
+
+        The returned ORM instances are detached from their sessions.
+
+        :return: a list with the rows of each shard
+        """
+        def run(engine):
+            with Session(engine) as session:
+                return session.execute(statement).all()
+
+        return list(self.executor.map(run, self.engines))
+
+    def after_fork(self):
+        """Drops the connections and threads inherited from the parent process"""
+        self.dispose(close=False)
+        self._start_executor()
+
+    def _start_executor(self):
+        """Starts the threads that query the shards in parallel"""
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(len(self.engines), "shard") if self.engines else None
+
+    def dispose(self, close: bool = True):
+        """Releases the pooled connections of every shard"""
+        for engine in self.engines:
+            engine.dispose(close=close)
+
+
+# The shards used by every RoutingSession
+shard_set = ShardSet()
+
+
+def use_shard(session, shard: int):
+    """Makes a session read and write sharded tables on one shard
+
+    Instances are not expired on commit any more, because refreshing one
+    would read from whichever shard the session is on by then.
+    """
+    session.info[SHARD] = shard
+    (session() if isinstance(session, scoped_session) else session).expire_on_commit = False
@@ -0,0 +1,311 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Shared Catalog Snapshot
+
+A read-only binary copy of the catalog in a memory-mapped file that every
+worker maps, so the page cache holds it once however many workers there
+are. The layout is a header, a fixed-size record per Product sorted by id
+and the JSON body of each Product:
+
+    header   magic, format, generation, seq, count
+    records  id, version, offset, length, category, available
+    bodies   the serialized Products as the API returns them
+
+GET by id is a binary search over the records and lists are the bodies
+joined, filtered by the category and availability in the records.
+
+A snapshot is never changed in place. A new generation is written to a
+temporary file and renamed over the old one, and workers map it the next
+time they check; requests still reading the old mapping are unaffected.
+The Products changed after the snapshot's seq in the change log are read
+from the database until a new generation covers them, and once there are
+more than SNAPSHOT_MAX_CHANGES of them one worker builds that generation.
+
+A background thread per worker reads the change log, maps new generations
+and builds them, every SNAPSHOT_REFRESH_SECONDS and right after this
+worker commits a change. Until the thread has read that change the worker
+serves every read from the database, so it still reads its own writes
+while the writing request does no more than set a flag.
+"""
+import bisect
+import fcntl
+import itertools
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from service.models import Category, Product, ProductChange
+
+logger = logging.getLogger("flask.app")
+
+MAGIC = b"PSNP"
+FORMAT = 1
+HEADER = struct.Struct("<4sIQQI4x")  # magic, format, generation, seq, count
+RECORD = struct.Struct("<qIIIBB2x")  # id, version, offset, length, category, available
+
+# What a request reads: a mapped snapshot and the ids changed since, which
+# must be read from the database instead
+View = namedtuple("View", ["snapshot", "changed"])
+
+
+class Snapshot:
+    """A mapped snapshot file"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.inode = os.fstat(file.fileno()).st_ino
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.generation, self.seq, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        self.bodies = HEADER.size + self.count * RECORD.size
+        self.ids = _RecordIds(self)
+
+    def record(self, index: int) -> tuple:
+        """Returns (id, version, offset, length, category, available)"""
+        return RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size)
+
+    def body(self, record: tuple) -> bytes:
+        """Returns the JSON body of a record"""
+        start = self.bodies + record[2]
+        return self.map[start:start + record[3]]
+
+    def find(self, product_id: int):
+        """Returns the record of a Product, or None"""
+        index = bisect.bisect_left(self.ids, product_id)
+        if index < self.count:
+            record = self.record(index)
+            if record[0] == product_id:
+                return record
+        return None
+
+
+class _RecordIds:
+    """A sequence view of the record ids for bisect"""
+
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.count
+
+    def __getitem__(self, index: int) -> int:
+        return RECORD.unpack_from(self.snapshot.map, HEADER.size + index * RECORD.size)[0]
+
+
+def build(app, path: str) -> bool:
+    """Writes a new generation of the snapshot from Product.all()
+
+    Only one process builds at a time, the others return False at once.
+    """
+    with open(f"{path}.lock", "a+b") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        with app.app_context():
+            seq = ProductChange.latest()
+            products = Product.gather()
+            records, bodies, offset = [], [], 0
+            for product in products:
+                body = app.json.dumps(product.serialize()).encode("utf-8")
+                records.append(
+                    RECORD.pack(product.id, product.version, offset, len(body), product.category.value, product.available)
+                )
+                bodies.append(body)
+                offset += len(body)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(HEADER.pack(MAGIC, FORMAT, time.time_ns(), seq, len(records)))
+            file.writelines(records)
+            file.writelines(bodies)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+        logger.info("Built catalog snapshot of %d Products at seq %d", len(records), seq)
+        return True
+
+
+class SnapshotStore:
+    """The snapshot mapped by this worker and the Products changed since"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.path = None
+        self.refresh_seconds = 5.0
+        self.max_changes = 1000
+        self.snapshot = None
+        self.changed = frozenset()  # ids changed after the snapshot's seq, replaced on change
+        self.seq = 0  # the last change read into changed
+        self.marks = itertools.count(1)
+        self.marked = 0  # bumped when this worker commits a change
+        self.applied = 0  # the last mark the refresh has caught up with
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def init_app(self, app):
+        """Builds the snapshot if needed and maps it when SNAPSHOT_ENABLED is set"""
+        self.app = app
+        self.enabled = app.config.get("SNAPSHOT_ENABLED", False)
+        self.path = app.config.get("SNAPSHOT_PATH")
+        self.refresh_seconds = app.config.get("SNAPSHOT_REFRESH_SECONDS", self.refresh_seconds)
+        self.max_changes = app.config.get("SNAPSHOT_MAX_CHANGES", self.max_changes)
+        self.stop()
+        with self.lock:
+            self.snapshot = None
+            self.changed = frozenset()
+        if not self.enabled:
+            return
+        if self.mark not in ProductChange.listeners:
+            ProductChange.listeners.append(self.mark)
+        if not os.path.exists(self.path):
+            build(app, self.path)
+        self.refresh()
+
+    def mark(self):
+        """Sends reads to the database until the refresh has seen a local commit"""
+        self.marked = next(self.marks)
+        self.wakeup.set()
+
+    def start(self):
+        """Starts the refresh thread in this process if it is not running
+
+        It is started lazily by the first read so that a preloading master
+        never forks with a thread that the workers lack.
+        """
+        if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.stopping.clear()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="snapshot-refresh", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops the refresh thread"""
+        thread = self.thread
+        if thread and self.pid == os.getpid():
+            self.stopping.set()
+            self.wakeup.set()
+            thread.join()
+        self.thread = None
+
+    def _run(self):
+        """Refreshes when woken by a commit or when the refresh is due"""
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.refresh_seconds)
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not refresh the catalog snapshot")
+
+    def refresh(self):
+        """Maps a new generation if there is one and reads the changes since"""
+        mark = self.marked
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode is None or self.snapshot is None or inode != self.snapshot.inode:
+            self._map()
+        if self.snapshot is not None:
+            with self.app.app_context():
+                changes = ProductChange.since(self.seq, self.max_changes + 1)
+            if changes:
+                with self.lock:
+                    # a new set, so a request reading the old one is unaffected
+                    self.changed = self.changed | {change.product_id for change in changes}
+                    self.seq = changes[-1].seq
+            if len(self.changed) > self.max_changes and build(self.app, self.path):
+                self._map()
+        self.applied = mark
+
+    def _map(self):
+        """Maps the current snapshot file"""
+        try:
+            snapshot = Snapshot(self.path)
+        except (FileNotFoundError, ValueError) as error:
+            logger.warning("Cannot map the catalog snapshot: %s", error)
+            snapshot = None
+        with self.lock:
+            self.snapshot = snapshot
+            self.changed = frozenset()
+            self.seq = snapshot.seq if snapshot else 0
+        if snapshot:
+            logger.info("Mapped catalog snapshot generation %d", snapshot.generation)
+
+    def view(self):
+        """Returns the View to read, or None if the database must be read"""
+        self.start()
+        with self.lock:
+            if self.snapshot is None or self.applied != self.marked:
+                return None
+            return View(self.snapshot, self.changed)
+
+    @staticmethod
+    def get(view: View, product_id: int):
+        """Returns (body, version) of a Product, or None if there is none
+
+        Only valid when product_id is not in view.changed.
+        """
+        record = view.snapshot.find(product_id)
+        if record is None:
+            return None
+        return view.snapshot.body(record), record[1]
+
+    def list(self, view: View, category: Category = None, available: bool = None) -> bytes:
+        """Returns the JSON array of the Products that match the filters"""
+        snapshot, changed = view
+        bodies = []
+        for index in range(snapshot.count):
+            record = snapshot.record(index)
+            if record[0] in changed:
+                continue
+            if category is not None and record[4] != category.value:
+                continue
+            if available is not None and record[5] != available:
+                continue
+            bodies.append((record[0], snapshot.body(record)))
+        if changed:
+            criteria = [Product.id.in_(changed)]
+            if category is not None:
+                criteria.append(Product.category == category)
+            if available is not None:
+                criteria.append(Product.available == available)
+            bodies.extend(
+                (product.id, self.app.json.dumps(product.serialize()).encode("utf-8"))
+                for product in Product.gather(*criteria)
+            )
+            bodies.sort(key=lambda item: item[0])
+        return b"[" + b",".join(body for _, body in bodies) + b"]"
+
+
+# The snapshot store used by the routes
+store = SnapshotStore()
@@ -0,0 +1,253 @@
+######################################################################
+# Copyright 2016, 2021 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Name Suggestions
+
+Type-ahead for the Product names, answered from an in-process index
+instead of a LIKE query per keystroke. The ranking puts available
+Products first, then the ones in the category the client is browsing,
+then shorter names. The database answers with the same ranking until the
+index has loaded, or always when SUGGEST_ENABLED is false.
+
+The index keeps a sorted run of (casefolded name, id) pairs for each
+availability and category, so the names that start with a prefix are a
+contiguous slice of every run, found with a binary search. The runs are
+scanned best weight first, at most SUGGEST_MAX_SCAN names of each, and
+the scan stops once a weight has found enough suggestions, so the
+ranking never depends on where a name falls in the whole catalog.
+
+A background thread, started by the first suggestion of each worker,
+loads the index and then applies the Product change log when this worker
+commits and at least every SUGGEST_REFRESH_SECONDS for the other workers.
+Writes only wake it.
+"""
+import bisect
+import heapq
+import logging
+import os
+import threading
+from service.models import Product, ProductChange
+
+logger = logging.getLogger("flask.app")
+
+
+def suggestion(product: dict) -> dict:
+    """Returns the fields of a serialized Product that a suggestion shows"""
+    return {
+        "id": product["id"],
+        "name": product["name"],
+        "category": product["category"],
+        "available": product["available"],
+    }
+
+
+class SuggestIndex:
+    """The Product names in sorted runs, kept current from the change log"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = True
+        self.refresh_seconds = 1.0
+        self.page_size = 1000
+        self.max_scan = 1000
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.clear()
+
+    def clear(self):
+        """Empties the index, the refresh thread loads it again"""
+        self.runs = {}  # (available, category name) -> sorted (casefolded name, id)
+        self.products = {}  # product id -> suggestion
+        self.seq = 0
+        self.loaded = False
+
+    def init_app(self, app):
+        """Reads the limits from the app configuration"""
+        self.stop()
+        self.app = app
+        self.enabled = app.config.get("SUGGEST_ENABLED", True)
+        self.refresh_seconds = app.config.get("SUGGEST_REFRESH_SECONDS", self.refresh_seconds)
+        self.max_scan = app.config.get("SUGGEST_MAX_SCAN", self.max_scan)
+        with self.refresh_lock, self.lock:
+            self.clear()
+        if self.enabled and self.mark not in ProductChange.listeners:
+            ProductChange.listeners.append(self.mark)
+
+    def mark(self):
+        """Wakes the refresh thread after a local commit"""
+        self.wakeup.set()
+
+    def start(self):
+        """Starts the refresh thread in this process if it is not running
+
+        It is started lazily by the first suggestion so that a preloading
+        master never forks with a thread that the workers lack.
+        """
+        if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.stopping.clear()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="suggest-refresh", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops the refresh thread"""
+        thread = self.thread
+        if thread and self.pid == os.getpid():
+            self.stopping.set()
+            self.wakeup.set()
+            thread.join()
+        self.thread = None
+
+    def _run(self):
+        """Loads the index, then refreshes when woken by a commit or when due"""
+        while not self.stopping.is_set():
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not refresh the suggestion index")
+            self.wakeup.wait(self.refresh_seconds)
+            self.wakeup.clear()
+
+    def refresh(self):
+        """Loads the index the first time, then applies the changes since"""
+        if self.loaded:
+            self.catch_up()
+        else:
+            self.load()
+
+    def load(self):
+        """Reads every Product name into a new index"""
+        with self.refresh_lock:
+            with self.app.app_context():
+                # changes logged while loading are applied again by catch_up()
+                seq = ProductChange.latest()
+                products = [product.serialize() for product in Product.gather()]
+            with self.lock:
+                self.clear()
+                for product in products:
+                    self._upsert(product)
+                for run in self.runs.values():
+                    run.sort()
+                self.seq = seq
+                self.loaded = True
+        logger.info("Loaded %d Product names into the suggestion index", len(products))
+        self.catch_up()
+
+    def catch_up(self):
+        """Applies the changes logged since the last one applied"""
+        with self.refresh_lock:
+            while True:
+                with self.app.app_context():
+                    changes = [change.serialize() for change in ProductChange.since(self.seq, self.page_size)]
+                if not changes:
+                    break
+                self.apply(changes)
+
+    def apply(self, changes: list):
+        """Applies serialized ProductChange entries in seq order"""
+        with self.lock:
+            for change in changes:
+                if change["seq"] <= self.seq:
+                    continue
+                self._delete(change["id"])
+                if change["op"] != "delete":
+                    self._upsert(change["product"], insort=True)
+                self.seq = change["seq"]
+
+    def suggest(self, prefix: str, category: str = None, limit: int = 10) -> list:
+        """Returns the best ranked Products whose name starts with prefix
+
+        :param prefix: the start of the name, case does not matter
+        :param category: the name of the category the client is browsing
+        :param limit: the most suggestions to return
+        """
+        if not self.enabled:
+            return self.find(prefix, category, limit)
+        self.start()
+        if not self.loaded:
+            return self.find(prefix, category, limit)
+        key = prefix.casefold()
+
+        def rank(product: dict) -> tuple:
+            return (len(product["name"]), product["name"], product["id"])
+
+        suggestions = []
+        with self.lock:
+            for runs in self._weights(category):
+                candidates = []
+                for run in runs:
+                    start = bisect.bisect_left(run, (key,))
+                    for name, product_id in run[start:start + self.max_scan]:
+                        if not name.startswith(key):
+                            break
+                        candidates.append(self.products[product_id])
+                suggestions += heapq.nsmallest(limit - len(suggestions), candidates, key=rank)
+                if len(suggestions) == limit:
+                    break
+        return suggestions
+
+    @staticmethod
+    def find(prefix: str, category: str, limit: int) -> list:
+        """Returns the suggestions from the database"""
+        return [suggestion(product.serialize()) for product in Product.find_by_name_prefix(prefix, category, limit)]
+
+    def _weights(self, category: str):
+        """Yields the runs of each ranking weight, the best first"""
+        for available in (True, False):
+            runs = [(run_category == category, run) for (run_available, run_category), run in self.runs.items()
+                    if run_available == available]
+            if category is None:
+                yield [run for _, run in runs]
+            else:
+                yield [run for browsed, run in runs if browsed]
+                yield [run for browsed, run in runs if not browsed]
+
+    def _upsert(self, product: dict, insort: bool = False):
+        """Adds a serialized Product, insort keeps its run sorted"""
+        entry = (product["name"].casefold(), product["id"])
+        run = self.runs.setdefault((product["available"], product["category"]), [])
+        if insort:
+            bisect.insort(run, entry)
+        else:
+            run.append(entry)
+        self.products[product["id"]] = suggestion(product)
+
+    def _delete(self, product_id: int):
+        """Removes a Product from the index"""
+        product = self.products.pop(product_id, None)
+        if product is None:
+            return
+        key = (product["available"], product["category"])
+        run = self.runs[key]
+        entry = (product["name"].casefold(), product_id)
+        index = bisect.bisect_left(run, entry)
+        if index < len(run) and run[index] == entry:
+            del run[index]
+        if not run:
+            del self.runs[key]
+
+
+# The index used by the routes
+index = SuggestIndex()
@@ -3,6 +3,7 @@ Global Configuration for Application
 """
 import os
 import logging
+import tempfile
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -13,8 +14,122 @@ DATABASE_URI = os.getenv(
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Read replicas as a comma separated list, reads stay on the primary if empty
+SQLALCHEMY_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+# Seconds a replica that failed to connect is left out of the rotation
+REPLICA_EJECT_SECONDS = int(os.getenv("REPLICA_EJECT_SECONDS", "30"))
+# Shards of the products table as a comma separated list, the primary holds them if empty
+SQLALCHEMY_SHARD_URIS = [uri for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri]
 # SQLALCHEMY_POOL_SIZE = 2
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
+
+# Logging is written by a background thread, as "text" or "json"
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "True").lower() == "true"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# Longest formatted log argument, e.g. a request payload
+LOG_MAX_PAYLOAD = int(os.getenv("LOG_MAX_PAYLOAD", "512"))
+# Fraction of INFO records kept per logger, e.g. "flask.app=0.1,service=0.5"
+LOG_SAMPLE_RATES = {
+    name: float(rate)
+    for name, rate in (
+        item.split("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if item
+    )
+}
+
+# Maintain the per-category statistics table on every write
+STATS_SUMMARY_ENABLED = os.getenv("STATS_SUMMARY_ENABLED", "False").lower() == "true"
+
+# Response compression
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "True").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+COMPRESSION_BROTLI_LEVEL = int(os.getenv("COMPRESSION_BROTLI_LEVEL", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+COMPRESSION_MIMETYPES = ["application/json", "text/html", "text/plain"]
+
+# Static assets are precompressed once at startup so use the best levels
+ASSETS_COMPRESSION_LEVELS = {"gzip": 9, "br": 11, "zstd": 19}
+
+# Responses to requests with an Idempotency-Key are replayed for this long
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# A claimed key whose request has not completed after this long is taken over
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "30"))
+# Completed responses kept in memory in front of the database
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+
+# Share the result of identical reads that run at the same time in a worker
+COALESCING_ENABLED = os.getenv("COALESCING_ENABLED", "True").lower() == "true"
+COALESCING_WAIT_SECONDS = float(os.getenv("COALESCING_WAIT_SECONDS", "30"))  # before running the call itself
+
+# Answer the list and search routes from an in-memory copy of the catalog
+READ_MODEL_ENABLED = os.getenv("READ_MODEL_ENABLED", "False").lower() == "true"
+# seconds between reads of the changes committed by other workers
+READ_MODEL_REFRESH_SECONDS = float(os.getenv("READ_MODEL_REFRESH_SECONDS", "1.0"))
+
+# Serve GET by id and lists from a catalog snapshot mapped by every worker
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "False").lower() == "true"
+SNAPSHOT_PATH = os.getenv(
+    "SNAPSHOT_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "product-catalog.snap"),
+)
+SNAPSHOT_REFRESH_SECONDS = float(os.getenv("SNAPSHOT_REFRESH_SECONDS", "5.0"))  # between checks for changes
+SNAPSHOT_MAX_CHANGES = int(os.getenv("SNAPSHOT_MAX_CHANGES", "1000"))  # changed Products before a rebuild
+
+# Server-Sent Events of the Product change log
+EVENTS_BUFFER_SIZE = int(os.getenv("EVENTS_BUFFER_SIZE", "1000"))  # latest changes kept in memory
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "1.0"))  # seconds, picks up other workers' changes
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15.0"))  # seconds between keep-alive comments
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "1000"))  # per worker
+EVENTS_RESERVED_THREADS = int(os.getenv("EVENTS_RESERVED_THREADS", "1"))  # kept from streams by sync/gthread workers
+
+# Retention of the Product change log, see flask db-changes-purge
+CHANGES_RETENTION_DAYS = float(os.getenv("CHANGES_RETENTION_DAYS", "7"))  # kept this long for the consumers
+
+# Admission control, a limit of 0 turns the check off
+ADMISSION_RATE_LIMIT = float(os.getenv("ADMISSION_RATE_LIMIT", "0"))  # requests per second per client
+ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", "0"))  # defaults to twice the rate
+ADMISSION_CLIENT_HEADER = os.getenv("ADMISSION_CLIENT_HEADER")  # e.g. X-Forwarded-For, else the peer address
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "0"))  # per worker
+ADMISSION_MAX_POOL_SATURATION = float(os.getenv("ADMISSION_MAX_POOL_SATURATION", "0"))  # checked out share, 0.0 - 1.0
+
+# Hot/cold archival of Products that left the catalog
+ARCHIVE_SOFT_DELETE = os.getenv("ARCHIVE_SOFT_DELETE", "False").lower() == "true"  # archive deleted Products
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))  # unavailable this long before archival
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))  # Products moved per transaction
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "0"))  # between background passes, 0 is off
+
+# Background jobs
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", "2"))  # jobs running at once per worker
+JOBS_MAX_PENDING = int(os.getenv("JOBS_MAX_PENDING", "10"))  # queued and running jobs of all workers before 503
+JOBS_BATCH_SIZE = int(os.getenv("JOBS_BATCH_SIZE", "100"))  # Products between progress reports
+JOBS_STALE_SECONDS = float(os.getenv("JOBS_STALE_SECONDS", "600"))  # without heartbeat before a job is failed
+
+# Store prices as a BIGINT count of minor units instead of NUMERIC,
+# convert an existing database first with flask db-price-storage
+PRICE_CENTS_ENABLED = os.getenv("PRICE_CENTS_ENABLED", "False").lower() == "true"
+PRICE_MINOR_DIGITS = int(os.getenv("PRICE_MINOR_DIGITS", "2"))  # decimal places of the minor unit
+
+# Readiness, /ready turns unready before admission control sheds load
+READY_PROBE_INTERVAL = float(os.getenv("READY_PROBE_INTERVAL", "2.0"))  # seconds between database probes
+READY_WARMUP_SECONDS = float(os.getenv("READY_WARMUP_SECONDS", "0"))  # after start before the first ready
+READY_MAX_POOL_SATURATION = float(os.getenv("READY_MAX_POOL_SATURATION", "0.8"))  # 0.0 - 1.0, 0 is off
+READY_MAX_INFLIGHT_RATIO = float(os.getenv("READY_MAX_INFLIGHT_RATIO", "0.8"))  # of ADMISSION_MAX_INFLIGHT, 0 is off
+
+# X-Total-Count of list requests: exact, estimate or cached, see counts.py
+TOTAL_COUNT_CACHE_SIZE = int(os.getenv("TOTAL_COUNT_CACHE_SIZE", "1000"))  # filters kept by the cached mode
+
+# Cache of the serialized list results, see resultcache.py
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "False").lower() == "true"
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1000"))  # listings kept per worker
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # of JSON bodies per worker
+RESULT_CACHE_REFRESH_SECONDS = float(os.getenv("RESULT_CACHE_REFRESH_SECONDS", "1.0"))  # between reads of the change log
+RESULT_CACHE_MAX_CHANGES = int(os.getenv("RESULT_CACHE_MAX_CHANGES", "1000"))  # changes applied before a reset
+
+# Name suggestions of GET /products/suggest, see suggest.py
+SUGGEST_ENABLED = os.getenv("SUGGEST_ENABLED", "True").lower() == "true"  # from an index, false for the database only
+SUGGEST_REFRESH_SECONDS = float(os.getenv("SUGGEST_REFRESH_SECONDS", "1.0"))  # between reads of the change log
+SUGGEST_MAX_SCAN = int(os.getenv("SUGGEST_MAX_SCAN", "1000"))  # names ranked per availability and category
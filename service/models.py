@@ -28,16 +28,28 @@ description (string) - the description the product belongs to (i.e., dog, cat)
 available (boolean) - True for products that are available for adoption
 
 """
+import heapq
+import json
 import logging
+from datetime import datetime, timedelta
 from enum import Enum
-from decimal import Decimal
+from itertools import chain, islice
+from decimal import Decimal, InvalidOperation
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, event, false, func, inspect, literal, or_, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.util import identity_key
+from service.common.replicas import RoutingSession, replica_set, use_primary
+from service.common.sharding import shard_set, use_shard
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Reads are routed to the replicas and writes to the primary
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
 def init_db(app):
@@ -60,6 +72,211 @@ class Category(Enum):
     TOOLS = 5
 
 
+class Price(TypeDecorator):  # pylint: disable=too-many-ancestors
+    """
+    The type of the price columns
+
+    Prices are stored as NUMERIC, or when PRICE_CENTS_ENABLED is set as a
+    BIGINT count of minor units (10 ** -PRICE_MINOR_DIGITS) so that range
+    queries, sorting and aggregates run on native integers. Both ways the
+    ORM reads and writes Decimals: the conversion is exact and prices with
+    more decimal places than the minor unit are refused.
+
+    A NUMERIC column gives back the scale the price was written with, or
+    the one of the driver, while minor units always come back with
+    PRICE_MINOR_DIGITS places. text() formats both the same way so the
+    JSON does not depend on the storage.
+    """
+
+    impl = db.Numeric
+    cache_ok = True
+
+    # decimal places of the minor unit, None when stored as NUMERIC
+    digits = None
+    # decimal places every price is formatted with at least
+    minor_digits = 2
+
+    def load_dialect_impl(self, dialect):
+        if Price.digits is None:
+            return dialect.type_descriptor(db.Numeric())
+        return dialect.type_descriptor(db.BigInteger())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or Price.digits is None:
+            return value
+        minor = Decimal(str(value)).scaleb(Price.digits)
+        if minor != minor.to_integral_value():
+            raise ValueError(f"Price {value} has more than {Price.digits} decimal places")
+        return int(minor)
+
+    def process_result_value(self, value, dialect):
+        if value is None or Price.digits is None:
+            return value
+        return Decimal(int(value)).scaleb(-Price.digits)
+
+    @classmethod
+    def text(cls, value: Decimal) -> str:
+        """Returns a price with the places of the minor unit, or more when they are not zero"""
+        value = Decimal(value).normalize()
+        if value.as_tuple().exponent > -cls.minor_digits:
+            value = value.quantize(Decimal(1).scaleb(-cls.minor_digits))
+        return str(value)
+
+    @classmethod
+    def exact(cls, value: Decimal) -> bool:
+        """Returns True if the price can be stored without rounding"""
+        if cls.digits is None:
+            return True
+        minor = value.scaleb(cls.digits)
+        return minor.is_finite() and minor == minor.to_integral_value()
+
+
+class ProductSchema:
+    """
+    Compiled validator for Product payloads
+
+    The field checks and the Category lookup table are built once so that
+    whole batches can be validated in a single pass without using
+    exceptions for control flow. Every error in a row is collected.
+    """
+
+    FIELDS = ("name", "description", "price", "available", "category")
+    # the sizes of the string columns
+    MAX_LENGTHS = {"name": 100, "description": 250}
+
+    def __init__(self):
+        self.categories = {category.name: category for category in Category}
+        self.checks = (
+            ("name", self._string_check("name")),
+            ("description", self._string_check("description")),
+            ("price", self._check_price),
+            ("available", self._check_boolean),
+            ("category", self._check_category),
+        )
+
+    ##################################################
+    # Field checks return (value, error message)
+    ##################################################
+
+    @classmethod
+    def _string_check(cls, field: str):
+        """Returns the check of a string column that fits its length"""
+        max_length = cls.MAX_LENGTHS[field]
+
+        def check(value):
+            if not isinstance(value, str):
+                return None, f"Invalid type for string [{field}]: " + str(type(value))
+            if len(value) > max_length:
+                return None, f"Invalid {field}: longer than {max_length} characters"
+            return value, None
+
+        return check
+
+    @staticmethod
+    def _check_price(value):
+        if isinstance(value, (Decimal, int, float, str)):
+            try:
+                price = Decimal(value)
+            except (InvalidOperation, ValueError):
+                return None, f"Invalid price: {value!r}"
+            if not Price.exact(price):
+                return None, f"Invalid price: {value!r} has more than {Price.digits} decimal places"
+            return price, None
+        return None, (
+            "Invalid product: body of request contained bad or no data "
+            f"conversion from {type(value).__name__} to Decimal is not supported"
+        )
+
+    @staticmethod
+    def _check_boolean(value):
+        if isinstance(value, bool):
+            return value, None
+        return None, "Invalid type for boolean [available]: " + str(type(value))
+
+    def _check_category(self, value):
+        if not isinstance(value, str):
+            return None, (
+                "Invalid product: body of request contained bad or no data "
+                f"attribute name must be string, not '{type(value).__name__}'"
+            )
+        category = self.categories.get(value)
+        if category is None:
+            return None, "Invalid attribute: " + value
+        return category, None
+
+    ##################################################
+    # Validation entry points
+    ##################################################
+
+    def validate(self, data) -> tuple:
+        """Validates a single payload
+
+        :param data: the dictionary to validate
+        :return: a tuple of (values, errors) where values is a dict of
+            converted column values and errors is a list of messages
+        :rtype: tuple
+        """
+        if not isinstance(data, dict):
+            return {}, [
+                "Invalid product: body of request contained bad or no data "
+                f"'{type(data).__name__}' object is not a dictionary"
+            ]
+        values = {}
+        errors = []
+        for field, check in self.checks:
+            if field not in data:
+                errors.append("Invalid product: missing " + field)
+                continue
+            value, error = check(data[field])
+            if error:
+                errors.append(error)
+            else:
+                values[field] = value
+        return values, errors
+
+    def validate_partial(self, data) -> tuple:
+        """Validates only the fields present in a payload
+
+        :param data: the dictionary to validate
+        :return: a tuple of (values, errors) like validate()
+        :rtype: tuple
+        """
+        if not isinstance(data, dict) or not data:
+            return {}, ["Invalid product: body of request contained bad or no data"]
+        values = {}
+        errors = ["Invalid attribute: " + str(field) for field in data if field not in self.FIELDS]
+        for field, check in self.checks:
+            if field in data:
+                value, error = check(data[field])
+                if error:
+                    errors.append(error)
+                else:
+                    values[field] = value
+        return values, errors
+
+    def validate_many(self, rows: list) -> tuple:
+        """Validates a list of payloads in one pass without raising
+
+        :param rows: the payloads to validate
+        :return: a tuple of (valid, errors) where valid is a list of
+            (index, values) and errors maps a row index to its messages
+        :rtype: tuple
+        """
+        valid = []
+        errors = {}
+        for index, data in enumerate(rows):
+            values, messages = self.validate(data)
+            if messages:
+                errors[index] = messages
+            else:
+                valid.append((index, values))
+        return valid, errors
+
+
+# Shared compiled schema used by Product.deserialize and bulk inserts
+product_schema = ProductSchema()
+
+
 class Product(db.Model):
     """
     Class that represents a Product
@@ -72,13 +289,32 @@ class Product(db.Model):
     # Table Schema
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    description = db.Column(db.String(250), nullable=False)
-    price = db.Column(db.Numeric, nullable=False)
+    name = db.Column(db.String(ProductSchema.MAX_LENGTHS["name"]), nullable=False)
+    description = db.Column(db.String(ProductSchema.MAX_LENGTHS["description"]), nullable=False)
+    price = db.Column(Price, nullable=False)
     available = db.Column(db.Boolean(), nullable=False, default=True)
     category = db.Column(
         db.Enum(Category), nullable=False, server_default=(Category.UNKNOWN.name)
     )
+    # Incremented on every update for optimistic concurrency control
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # When the Product was last made unavailable, None while it is available
+    unavailable_since = db.Column(db.DateTime, nullable=True, index=True)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    # The (table, column) of every stored price, see Price
+    PRICE_COLUMNS = (
+        ("product", "price"),
+        ("product_archive", "price"),
+        ("category_summary", "price_total"),
+        ("category_summary", "price_min"),
+        ("category_summary", "price_max"),
+    )
+    # Most ids bound to one query by find_many()
+    FIND_MANY_CHUNK = 1000
+    # Columns indexed on every category partition, see partition_by_category()
+    PARTITION_INDEXES = ("name", "available", "price", "unavailable_since")
 
     ##################################################
     # INSTANCE METHODS
@@ -92,33 +328,69 @@ class Product(db.Model):
         Creates a Product to the database
         """
         logger.info("Creating %s", self.name)
-        # id must be none to generate next primary key
-        self.id = None  # pylint: disable=invalid-name
+        if shard_set.engines:
+            # ids are allocated on the primary so they are unique across shards
+            self.id = ProductIdSequence.next_id()  # pylint: disable=invalid-name
+            self.route(self.id)
+        else:
+            # id must be none to generate next primary key
+            self.id = None  # pylint: disable=invalid-name
         db.session.add(self)
+        db.session.flush()
+        CategorySummary.apply(added=self.summary_key())
+        ProductChange.record(self)
         db.session.commit()
 
     def update(self):
         """
         Updates a Product to the database
         """
-        logger.info("Saving %s", self.name)
-        if not self.id:
-            raise DataValidationError("Update called with empty ID field")
+        use_primary(db.session)
+        # loading expired attributes must not flush the pending changes
+        # before the stored values have been read for the summary
+        with db.session.no_autoflush:
+            logger.info("Saving %s", self.name)
+            if not self.id:
+                raise DataValidationError("Update called with empty ID field")
+            self.route(self.id)
+            previous = CategorySummary.stored_key(self.id, for_update=True)
+        db.session.flush()
+        if previous and previous != self.summary_key():
+            CategorySummary.apply(removed=previous, added=self.summary_key())
+        ProductChange.record(self)
         db.session.commit()
 
     def delete(self):
         """Removes a Product from the data store"""
         logger.info("Deleting %s", self.name)
+        use_primary(db.session)
+        self.route(self.id)
+        previous = self.summary_key()
+        if ProductArchive.soft_delete:
+            ProductArchive.store([self], deleted=True)
         db.session.delete(self)
+        db.session.flush()
+        CategorySummary.apply(removed=previous)
+        ProductChange.record(self, deleted=True)
         db.session.commit()
 
+    @staticmethod
+    def route(product_id: int):
+        """Points the session at the shard of a Product when sharding is on"""
+        if shard_set.engines:
+            use_shard(db.session, shard_set.shard_for(product_id))
+
+    def summary_key(self) -> tuple:
+        """Returns the (category, available, price) used by the statistics"""
+        return (self.category, self.available, self.price)
+
     def serialize(self) -> dict:
         """Serializes a Product into a dictionary"""
         return {
             "id": self.id,
             "name": self.name,
             "description": self.description,
-            "price": str(self.price),
+            "price": Price.text(self.price),
             "available": self.available,
             "category": self.category.name  # convert enum to string
         }
@@ -129,26 +401,11 @@ class Product(db.Model):
         Args:
             data (dict): A dictionary containing the Product data
         """
-        try:
-            self.name = data["name"]
-            self.description = data["description"]
-            self.price = Decimal(data["price"])
-            if isinstance(data["available"], bool):
-                self.available = data["available"]
-            else:
-                raise DataValidationError(
-                    "Invalid type for boolean [available]: "
-                    + str(type(data["available"]))
-                )
-            self.category = getattr(Category, data["category"])  # create enum from string
-        except AttributeError as error:
-            raise DataValidationError("Invalid attribute: " + error.args[0]) from error
-        except KeyError as error:
-            raise DataValidationError("Invalid product: missing " + error.args[0]) from error
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid product: body of request contained bad or no data " + str(error)
-            ) from error
+        values, errors = product_schema.validate(data)
+        if errors:
+            raise DataValidationError(errors[0])
+        for field, value in values.items():
+            setattr(self, field, value)
         return self
 
     ##################################################
@@ -165,29 +422,160 @@ class Product(db.Model):
         """
         logger.info("Initializing database")
         # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
+        # (only once, an app cannot be set up again after serving requests)
+        if "sqlalchemy" not in app.extensions:
+            db.init_app(app)
         app.app_context().push()
+        # before any table is created or price converted
+        Price.minor_digits = app.config.get("PRICE_MINOR_DIGITS", 2)
+        Price.digits = Price.minor_digits if app.config.get("PRICE_CENTS_ENABLED") else None
         db.create_all()  # make our sqlalchemy tables
+        replica_set.init_app(app)
+        shard_set.init_app(app, [cls.__table__, ProductArchive.__table__])
+        cls.check_price_storage([db.engine] + shard_set.engines)
+        ProductArchive.soft_delete = app.config.get("ARCHIVE_SOFT_DELETE", False)
+        CategorySummary.enabled = app.config.get("STATS_SUMMARY_ENABLED", False)
+        if shard_set.engines:
+            if CategorySummary.enabled:
+                logger.warning("The category summary cannot be kept across shards, it is disabled")
+                CategorySummary.enabled = False
+            ProductIdSequence.advance(cls.highest_id())
+        if CategorySummary.enabled and not CategorySummary.query.first():
+            CategorySummary.rebuild()
+
+    @classmethod
+    def bulk_create(cls, rows: list) -> tuple:
+        """Validates a batch of payloads and inserts the valid ones
+
+        Invalid rows are skipped and reported instead of aborting the batch.
+
+        :param rows: a list of Product dictionaries
+        :type rows: list
+        :return: a tuple of (products, errors) where errors maps the index
+            of each rejected row to its list of messages
+        :rtype: tuple
+        """
+        logger.info("Processing bulk create of %d Products", len(rows))
+        valid, errors = product_schema.validate_many(rows)
+        products = [cls(**values) for _, values in valid]
+        if not products:
+            return products, errors
+        if shard_set.engines:
+            shards = {}
+            for product in products:
+                product.id = ProductIdSequence.next_id()
+                shards.setdefault(shard_set.shard_for(product.id), []).append(product)
+            # one shard per flush, the session writes Products to its current shard
+            for shard, group in shards.items():
+                use_shard(db.session, shard)
+                db.session.add_all(group)
+                db.session.flush()
+        else:
+            db.session.add_all(products)
+            db.session.flush()
+        for product in products:
+            CategorySummary.apply(added=product.summary_key())
+            ProductChange.record(product)
+        db.session.commit()
+        return products, errors
+
+    @classmethod
+    def patch(cls, product_id: int, data: dict, versions: set = None):
+        """Updates some fields of a Product with a single UPDATE statement
+
+        :param product_id: the id of the Product to update
+        :type product_id: int
+        :param data: the fields to change
+        :type data: dict
+        :param versions: only update if the stored version is one of these
+        :type versions: set
+        :return: the updated Product, or None if no row matched
+        :rtype: Product
+        """
+        logger.info("Processing patch for id %s ...", product_id)
+        values, errors = product_schema.validate_partial(data)
+        if errors:
+            raise DataValidationError(errors[0])
+        use_primary(db.session)
+        cls.route(product_id)
+        previous = None
+        if CategorySummary.enabled and values.keys() & {"category", "available", "price"}:
+            previous = CategorySummary.stored_key(product_id, for_update=True)
+        statement = (
+            update(cls)
+            .where(cls.id == product_id)
+            .values(version=cls.version + 1, **values)
+            .returning(cls)
+            .execution_options(populate_existing=True)
+        )
+        if "available" in values:
+            statement = statement.values(
+                unavailable_since=None if values["available"] else func.coalesce(cls.unavailable_since, datetime.utcnow())
+            )
+        if versions is not None:
+            statement = statement.where(cls.version.in_(versions))
+        product = db.session.execute(statement).scalar_one_or_none()
+        if product and previous and previous != product.summary_key():
+            CategorySummary.apply(removed=previous, added=product.summary_key())
+        if product:
+            ProductChange.record(product)
+        db.session.commit()
+        return product
 
     @classmethod
     def all(cls) -> list:
         """Returns all of the Products in the database"""
         logger.info("Processing all Products")
+        if shard_set.engines:
+            return cls.gather()
         return cls.query.all()
 
     @classmethod
-    def find(cls, product_id: int):
+    def find(cls, product_id: int, archived: bool = False):
         """Finds a Product by it's ID
 
         :param product_id: the id of the Product to find
         :type product_id: int
+        :param archived: also look in the archive if it is not in the catalog
+        :type archived: bool
 
         :return: an instance with the product_id, or None if not found
         :rtype: Product
 
         """
         logger.info("Processing lookup for id %s ...", product_id)
-        return cls.query.get(product_id)
+        cls.route(product_id)
+        product = cls.query.get(product_id)
+        if product is None and archived:
+            entry = db.session.get(ProductArchive, product_id)
+            product = entry.restore() if entry else None
+        return product
+
+    @classmethod
+    def find_many(cls, product_ids: list) -> list:
+        """Finds the Products of many ids with one IN query
+
+        Products already loaded in the session are not queried again, and
+        very long lists are split into queries of FIND_MANY_CHUNK ids.
+
+        :param product_ids: the ids of the Products to find
+        :type product_ids: list
+
+        :return: the Product of every id in the same order, or None if not found
+        :rtype: list
+
+        """
+        logger.info("Processing lookup for %d ids ...", len(product_ids))
+        found = {}
+        for product_id in product_ids:
+            product = db.session.identity_map.get(identity_key(cls, product_id))
+            if product is not None and not inspect(product).expired:
+                found[product_id] = product
+        missing = [product_id for product_id in dict.fromkeys(product_ids) if product_id not in found]
+        for start in range(0, len(missing), cls.FIND_MANY_CHUNK):
+            for product in cls.gather(cls.id.in_(missing[start:start + cls.FIND_MANY_CHUNK])):
+                found[product.id] = product
+        return [found.get(product_id) for product_id in product_ids]
 
     @classmethod
     def find_by_name(cls, name: str) -> list:
@@ -201,7 +589,31 @@ class Product(db.Model):
 
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.gather(cls.name == name)
+
+    @classmethod
+    def find_by_name_prefix(cls, prefix: str, category: str = None, limit: int = 10) -> list:
+        """Returns the best ranked Products whose name starts with prefix
+
+        Available Products come first, then the ones in the category, then
+        shorter names. This is what the suggestion index answers from memory.
+
+        :param prefix: the start of the name, case does not matter
+        :param category: the name of the category the client is browsing
+        :param limit: the most Products to return
+        :rtype: list
+        """
+        logger.info("Processing name prefix query for %s ...", prefix)
+        pattern = prefix.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        criteria = func.lower(cls.name).like(pattern, escape="\\")
+        if shard_set.engines:
+            return heapq.nsmallest(limit, cls.gather(criteria), key=lambda product: (
+                not product.available, product.category.name != category, len(product.name), product.name, product.id
+            ))
+        order = [cls.available.desc(), func.length(cls.name), cls.name, cls.id]
+        if category:
+            order.insert(1, case((cls.category == Category[category], 0), else_=1))
+        return db.session.scalars(select(cls).where(criteria).order_by(*order).limit(limit)).all()
 
     @classmethod
     def find_by_price(cls, price: Decimal) -> list:
@@ -218,7 +630,10 @@ class Product(db.Model):
         price_value = price
         if isinstance(price, str):
             price_value = Decimal(price.strip(' "'))
-        return cls.query.filter(cls.price == price_value)
+        if not Price.exact(Decimal(str(price_value))):
+            # no stored price has more decimal places than the minor unit
+            return cls.gather(false())
+        return cls.gather(cls.price == price_value)
 
     @classmethod
     def find_by_availability(cls, available: bool = True) -> list:
@@ -232,7 +647,7 @@ class Product(db.Model):
 
         """
         logger.info("Processing available query for %s ...", available)
-        return cls.query.filter(cls.available == available)
+        return cls.gather(cls.available == available)
 
     @classmethod
     def find_by_category(cls, category: Category = Category.UNKNOWN) -> list:
@@ -246,4 +661,1130 @@ class Product(db.Model):
 
         """
         logger.info("Processing category query for %s ...", category.name)
-        return cls.query.filter(cls.category == category)
+        return cls.gather(cls.category == category)
+
+    @classmethod
+    def gather(cls, *criteria, limit: int = None, offset: int = 0) -> list:
+        """Returns a page of the Products that match the criteria in id order
+
+        When sharding is on every shard is queried in parallel for its
+        first offset + limit rows and the results are merged.
+
+        :param limit: the maximum number of Products, None for all of them
+        :param offset: the number of Products to skip
+        :rtype: list
+        """
+        statement = select(cls).where(*criteria).order_by(cls.id)
+        if not shard_set.engines:
+            return db.session.scalars(statement.offset(offset).limit(limit)).all()
+        if limit is not None:
+            statement = statement.limit(offset + limit)
+        shards = [[row[0] for row in rows] for rows in shard_set.gather(statement)]
+        merged = heapq.merge(*shards, key=lambda product: product.id)
+        return list(islice(merged, offset, None if limit is None else offset + limit))
+
+    @classmethod
+    def count(cls, name: str = None, category: Category = None, available: bool = None, estimate: bool = False) -> int:
+        """Returns the number of Products that match the filters
+
+        :param estimate: return the row estimate of the PostgreSQL planner
+            instead of counting, other databases are always counted
+        :rtype: int
+        """
+        criteria = []
+        if name is not None:
+            criteria.append(cls.name == name)
+        if category is not None:
+            criteria.append(cls.category == category)
+        if available is not None:
+            criteria.append(cls.available.is_(available))
+        engines = shard_set.engines or [db.engine]
+        if estimate and all(engine.dialect.name == "postgresql" for engine in engines):
+            return sum(cls.estimate(engine, criteria) for engine in engines)
+        statement = select(func.count()).select_from(cls).where(*criteria)
+        if shard_set.engines:
+            return sum(rows[0][0] for rows in shard_set.gather(statement))
+        return db.session.execute(statement).scalar()
+
+    @classmethod
+    def estimate(cls, engine, criteria: list) -> int:
+        """Returns the planner's row estimate for the criteria on PostgreSQL
+
+        The planner scales reltuples by the current size of the table and
+        applies the column statistics of the filters, so it costs a plan
+        instead of a scan.
+        """
+        statement = select(cls.id).where(*criteria).compile(engine, compile_kwargs={"literal_binds": True})
+        with engine.connect() as connection:
+            plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {statement}")).scalar()
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    @classmethod
+    def highest_id(cls) -> int:
+        """Returns the largest Product id on the primary or any shard"""
+        statement = select(func.max(cls.id))
+        highest = db.session.execute(statement, bind_arguments={"bind": db.engine}).scalar() or 0
+        if shard_set.engines:
+            highest = max([highest] + [rows[0][0] or 0 for rows in shard_set.gather(statement)])
+        return highest
+
+    @classmethod
+    def aggregate(cls) -> list:
+        """Returns per-Category statistics computed with a GROUP BY
+
+        When sharding is on the rows of every shard are merged.
+
+        :return: rows of (category, count, available_count, price_total,
+            price_min, price_max)
+        :rtype: list
+        """
+        logger.info("Processing category aggregate query ...")
+        statement = select(
+            cls.category,
+            func.count(cls.id),
+            func.sum(case((cls.available.is_(True), 1), else_=0)),
+            func.sum(cls.price),
+            func.min(cls.price),
+            func.max(cls.price),
+        ).group_by(cls.category)
+        if not shard_set.engines:
+            return db.session.execute(statement).all()
+        merged = {}
+        for row in chain.from_iterable(shard_set.gather(statement)):
+            category, count, available, total, low, high = row
+            if category in merged:
+                _, count_sum, available_sum, total_sum, low_min, high_max = merged[category]
+                row = (category, count_sum + count, available_sum + available, total_sum + total,
+                       min(low_min, low), max(high_max, high))
+            merged[category] = tuple(row)
+        return list(merged.values())
+
+    @classmethod
+    def partition_ddl(cls, partitioned: bool, existing: set) -> list:
+        """Returns the PostgreSQL statements that list partition the table by Category
+
+        :param partitioned: True if the table is already partitioned, then
+            only the partitions of new Categories are created
+        :param existing: the names of the partitions that exist
+        :rtype: list
+        """
+        table = cls.__tablename__
+        parent = table if partitioned else f"{table}_partitioned"
+        statements = []
+        if not partitioned:
+            # the primary key of a partitioned table must hold the partition key
+            statements += [
+                f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE",
+                f"CREATE TABLE {parent} (LIKE {table} INCLUDING DEFAULTS, PRIMARY KEY (id, category)) "
+                "PARTITION BY LIST (category)",
+            ]
+        for category in Category:
+            partition = f"{table}_{category.name.lower()}"
+            if partition not in existing:
+                statements.append(f"CREATE TABLE {partition} PARTITION OF {parent} FOR VALUES IN ('{category.name}')")
+        if not partitioned:
+            # indexes on the parent are created on every partition, they are
+            # named after the parent until the old table and its indexes are gone
+            statements += [f"CREATE INDEX ix_{parent}_{column} ON {parent} ({column})" for column in cls.PARTITION_INDEXES]
+            statements += [
+                f"INSERT INTO {parent} SELECT * FROM {table}",
+                f"ALTER SEQUENCE {table}_id_seq OWNED BY {parent}.id",
+                f"DROP TABLE {table}",
+                f"ALTER TABLE {parent} RENAME TO {table}",
+            ]
+            statements += [
+                f"ALTER INDEX ix_{parent}_{column} RENAME TO ix_{table}_{column}" for column in cls.PARTITION_INDEXES
+            ]
+        return statements
+
+    @classmethod
+    def partition_by_category(cls, engine) -> list:
+        """Partitions the products table of a PostgreSQL database by Category
+
+        The rows are copied into the partitioned table in one transaction,
+        so the table is locked while it is migrated. Running it again only
+        adds the partitions of new Categories. Queries that filter on the
+        category, like find_by_category(), then only scan its partition.
+
+        :return: the statements that were run
+        :rtype: list
+        """
+        table = cls.__tablename__
+        with engine.begin() as connection:
+            partitioned = connection.execute(
+                text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = CAST(:table AS regclass))"),
+                {"table": table},
+            ).scalar()
+            existing = set(
+                connection.execute(
+                    text(
+                        "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                        "WHERE pg_inherits.inhparent = CAST(:table AS regclass)"
+                    ),
+                    {"table": table},
+                ).scalars()
+            )
+            statements = cls.partition_ddl(partitioned, existing)
+            for statement in statements:
+                connection.execute(text(statement))
+        logger.info("Ran %d statements to partition %s by category", len(statements), table)
+        return statements
+
+    @staticmethod
+    def stored_price_type(connection) -> str:
+        """Returns the type of the stored price column on PostgreSQL, else None"""
+        if connection.dialect.name != "postgresql":
+            return None
+        return connection.execute(
+            text(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_name = :table AND column_name = 'price'"
+            ),
+            {"table": Product.__tablename__},
+        ).scalar()
+
+    @classmethod
+    def check_price_storage(cls, engines: list):
+        """Refuses to start when PRICE_CENTS_ENABLED disagrees with the stored prices
+
+        Reading minor units as NUMERIC, or the other way around, would be
+        off by a factor of 10 ** PRICE_MINOR_DIGITS.
+        """
+        for engine in engines:
+            with engine.connect() as connection:
+                stored = cls.stored_price_type(connection)
+            if stored and (stored == "bigint") != (Price.digits is not None):
+                raise DataValidationError(
+                    f"Prices are stored as {stored} on {engine.url.database}, "
+                    "run flask db-price-storage or change PRICE_CENTS_ENABLED"
+                )
+
+    @classmethod
+    def price_storage_ddl(cls, to_cents: bool, digits: int, columns: tuple = PRICE_COLUMNS) -> list:
+        """Returns the PostgreSQL statements that convert the price columns
+
+        :param to_cents: True to store BIGINT minor units, False for NUMERIC
+        :param digits: the decimal places of the minor unit
+        :param columns: the (table, column) to convert
+        :rtype: list
+        """
+        factor = 10 ** digits
+        statements = []
+        for table, column in columns:
+            if to_cents:
+                using = f"TYPE BIGINT USING round({column} * {factor})::bigint"
+            else:
+                using = f"TYPE NUMERIC USING round({column}::numeric / {factor}, {digits})"
+            statements.append(f"ALTER TABLE {table} ALTER COLUMN {column} {using}")
+        return statements
+
+    @classmethod
+    def migrate_price_storage(cls, engine, to_cents: bool, digits: int) -> list:
+        """Converts the stored prices of a PostgreSQL database in one transaction
+
+        Running it again does nothing. Prices with more decimal places than
+        the minor unit cannot be converted exactly and abort the migration.
+
+        :return: the statements that were run
+        """
+        with engine.begin() as connection:
+            if (cls.stored_price_type(connection) == "bigint") == to_cents:
+                return []
+            # shards only hold the product tables
+            existing = set(
+                connection.execute(text("SELECT table_name, column_name FROM information_schema.columns")).all()
+            )
+            columns = [column for column in cls.PRICE_COLUMNS if column in existing]
+            for table, column in columns if to_cents else []:
+                inexact = connection.execute(
+                    text(f"SELECT count(*) FROM {table} WHERE {column} <> round({column}, {digits})")
+                ).scalar()
+                if inexact:
+                    raise DataValidationError(f"{inexact} prices in {table} have more than {digits} decimal places")
+            statements = cls.price_storage_ddl(to_cents, digits, columns)
+            for statement in statements:
+                connection.execute(text(statement))
+        logger.info("Converted the prices of %s to %s", engine.url.database, "cents" if to_cents else "numeric")
+        return statements
+
+    @classmethod
+    def rebalance(cls, batch_size: int = 500) -> int:
+        """Moves every Product to the shard its id hashes to
+
+        Run after changing SQLALCHEMY_SHARD_URIS, it also moves the
+        Products of the primary into the shards when sharding is turned
+        on, and the archive entries with them. A batch is written to its
+        new shard before it is deleted from the old one so a Product is
+        never lost, and running it again finishes an interrupted run.
+
+        :return: the number of Products moved
+        """
+        if not shard_set.engines:
+            return 0
+        moved = 0
+        sources = [(None, db.engine)] + list(enumerate(shard_set.engines))
+        for table in (cls.__table__, ProductArchive.__table__):
+            for source, engine in sources:
+                last = 0
+                while True:
+                    with engine.connect() as connection:
+                        rows = connection.execute(
+                            select(table).where(table.c.id > last).order_by(table.c.id).limit(batch_size)
+                        ).mappings().all()
+                    if not rows:
+                        break
+                    last = rows[-1]["id"]
+                    targets = {}
+                    for row in rows:
+                        target = shard_set.shard_for(row["id"])
+                        if target != source:
+                            targets.setdefault(target, []).append(dict(row))
+                    for target, batch in targets.items():
+                        ids = [row["id"] for row in batch]
+                        with shard_set.engines[target].begin() as connection:
+                            connection.execute(table.delete().where(table.c.id.in_(ids)))
+                            connection.execute(table.insert(), batch)
+                        with engine.begin() as connection:
+                            connection.execute(table.delete().where(table.c.id.in_(ids)))
+                        moved += len(batch)
+        logger.info("Moved %d Products to their shards", moved)
+        return moved
+
+    @classmethod
+    def statistics(cls) -> list:
+        """Returns the per-Category statistics of the catalog
+
+        Reads the incrementally maintained summary table when it is enabled,
+        otherwise aggregates over the products table.
+
+        :return: a list of statistics dictionaries ordered by Category
+        :rtype: list
+        """
+        if CategorySummary.enabled:
+            rows = [summary.as_row() for summary in CategorySummary.query.filter(CategorySummary.count > 0)]
+        else:
+            rows = cls.aggregate()
+        stats = []
+        for category, count, available, total, low, high in sorted(rows, key=lambda row: row[0].value):
+            total = Decimal(total)
+            stats.append(
+                {
+                    "category": category.name,
+                    "count": count,
+                    "available": available,
+                    "availability_ratio": round(available / count, 4),
+                    "price": {
+                        "min": Price.text(low),
+                        "avg": str(round(total / count, 2)),
+                        "max": Price.text(high),
+                    },
+                }
+            )
+        return stats
+
+
+class CategorySummary(db.Model):
+    """
+    Incrementally maintained per-Category statistics
+
+    Rows are updated with relative SQL expressions in the same transaction
+    as Product.create/update/delete so that reading the statistics costs
+    O(number of categories) instead of O(catalog).
+    """
+
+    __tablename__ = "category_summary"
+
+    # Set from STATS_SUMMARY_ENABLED by Product.init_db()
+    enabled = False
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    category = db.Column(db.Enum(Category), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    available_count = db.Column(db.Integer, nullable=False, default=0)
+    price_total = db.Column(Price, nullable=False, default=0)
+    price_min = db.Column(Price, nullable=True)
+    price_max = db.Column(Price, nullable=True)
+
+    def __repr__(self):
+        return f"<CategorySummary {self.category.name} count=[{self.count}]>"
+
+    def as_row(self) -> tuple:
+        """Returns the summary in the same shape as Product.aggregate()"""
+        return (
+            self.category,
+            self.count,
+            self.available_count,
+            self.price_total,
+            self.price_min,
+            self.price_max,
+        )
+
+    @classmethod
+    def stored_key(cls, product_id: int, for_update: bool = False):
+        """Returns the stored (category, available, price) of a Product
+
+        Pending changes are not flushed so the values are the ones that the
+        summary currently accounts for.
+
+        :param for_update: lock the row until the transaction ends
+        :return: the stored key, or None when the summary is disabled
+        """
+        if not cls.enabled:
+            return None
+        with db.session.no_autoflush:
+            query = db.session.query(Product.category, Product.available, Product.price).filter(
+                Product.id == product_id
+            )
+            if for_update:
+                query = query.with_for_update()
+            row = query.first()
+        return tuple(row) if row else None
+
+    @classmethod
+    def apply(cls, removed: tuple = None, added: tuple = None):
+        """Applies a Product change to the summary without committing
+
+        Must be called after the change has been flushed so that min/max
+        can be recomputed from the products table when a bound is removed.
+
+        :param removed: the (category, available, price) that was removed
+        :param added: the (category, available, price) that was added
+        """
+        if not cls.enabled:
+            return
+        if removed:
+            category, available, price = removed
+            remaining = Product.query.filter(Product.category == category)
+            db.session.execute(
+                update(cls)
+                .where(cls.category == category)
+                .values(
+                    count=cls.count - 1,
+                    available_count=cls.available_count - (1 if available else 0),
+                    price_total=cls.price_total - price,
+                    price_min=case(
+                        (cls.price_min >= price, remaining.with_entities(func.min(Product.price)).scalar_subquery()),
+                        else_=cls.price_min,
+                    ),
+                    price_max=case(
+                        (cls.price_max <= price, remaining.with_entities(func.max(Product.price)).scalar_subquery()),
+                        else_=cls.price_max,
+                    ),
+                )
+            )
+        if added:
+            category, available, price = added
+            # typed so that case() stores it like the price columns
+            price = literal(price, Price)
+            # the first Product of a category may be added by two transactions at once
+            insert = postgresql.insert if db.session.get_bind(cls).dialect.name == "postgresql" else sqlite.insert
+            db.session.execute(
+                insert(cls)
+                .values(category=category, count=0, available_count=0, price_total=0)
+                .on_conflict_do_nothing(index_elements=[cls.category])
+            )
+            db.session.execute(
+                update(cls)
+                .where(cls.category == category)
+                .values(
+                    count=cls.count + 1,
+                    available_count=cls.available_count + (1 if available else 0),
+                    price_total=cls.price_total + price,
+                    price_min=case(
+                        (cls.price_min.is_(None), price), (cls.price_min > price, price), else_=cls.price_min
+                    ),
+                    price_max=case(
+                        (cls.price_max.is_(None), price), (cls.price_max < price, price), else_=cls.price_max
+                    ),
+                )
+            )
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes the whole summary from the products table"""
+        logger.info("Rebuilding category summary")
+        db.session.query(cls).delete()
+        for category, count, available, total, low, high in Product.aggregate():
+            db.session.add(
+                cls(
+                    category=category,
+                    count=count,
+                    available_count=available,
+                    price_total=total,
+                    price_min=low,
+                    price_max=high,
+                )
+            )
+        db.session.commit()
+
+
+@event.listens_for(Product, "before_insert")
+@event.listens_for(Product, "before_update")
+def track_unavailable_since(_mapper, _connection, target):
+    """Stamps when a Product became unavailable for the archival passes"""
+    if target.available:
+        target.unavailable_since = None
+    elif target.unavailable_since is None:
+        target.unavailable_since = datetime.utcnow()
+
+
+class ProductArchive(db.Model):
+    """
+    The cold storage of Products that left the catalog
+
+    Products that have been unavailable for a long time are moved here in
+    batches by archive_unavailable(), and deleted Products as well when
+    soft deletion is on, so the products table and its indexes only hold
+    the live catalog. Product.find(id, archived=True) falls back to this
+    table. The table is sharded with the products table so a Product and
+    its archive entry are always moved in one transaction.
+    """
+
+    __tablename__ = "product_archive"
+
+    # Move deleted Products here instead of dropping them
+    soft_delete = False
+    # The Product columns that are kept
+    COLUMNS = ("id", "name", "description", "price", "available", "category", "version", "unavailable_since")
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # pylint: disable=invalid-name
+    name = db.Column(db.String(ProductSchema.MAX_LENGTHS["name"]), nullable=False)
+    description = db.Column(db.String(ProductSchema.MAX_LENGTHS["description"]), nullable=False)
+    price = db.Column(Price, nullable=False)
+    available = db.Column(db.Boolean(), nullable=False)
+    category = db.Column(db.Enum(Category), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    unavailable_since = db.Column(db.DateTime, nullable=True)
+    deleted = db.Column(db.Boolean(), nullable=False, default=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<ProductArchive {self.name} id=[{self.id}]>"
+
+    def restore(self) -> Product:
+        """Returns the archived Product as a transient instance"""
+        return Product(**{column: getattr(self, column) for column in self.COLUMNS})
+
+    @classmethod
+    def store(cls, products: list, deleted: bool = False):
+        """Adds the Products to the archive in the current transaction
+
+        An earlier entry with the same id is replaced.
+        """
+        ids = [product.id for product in products]
+        cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        archived_at = datetime.utcnow()
+        db.session.add_all(
+            cls(
+                deleted=deleted,
+                archived_at=archived_at,
+                **{column: getattr(product, column) for column in cls.COLUMNS},
+            )
+            for product in products
+        )
+
+    @classmethod
+    def archive_unavailable(cls, older_than: timedelta, batch_size: int = 500) -> int:
+        """Moves the Products unavailable for longer than older_than to the archive
+
+        Every batch is committed on its own so locks are held briefly, and
+        the change log gets a tombstone for each archived Product.
+
+        Products that were unavailable before unavailable_since existed
+        have none, they are stamped with the time of this pass first so
+        they are archived once older_than has passed from now.
+
+        :return: the number of Products archived
+        """
+        now = datetime.utcnow()
+        cutoff = now - older_than
+        archived = 0
+        for shard in range(len(shard_set.engines)) or [None]:
+            cls.stamp_unavailable(shard, now, batch_size)
+            while True:
+                use_primary(db.session)
+                if shard is not None:
+                    use_shard(db.session, shard)
+                batch = (
+                    Product.query.filter(Product.available.is_(False), Product.unavailable_since <= cutoff)
+                    .order_by(Product.id)
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True)
+                    .all()
+                )
+                if not batch:
+                    break
+                cls.store(batch)
+                for product in batch:
+                    db.session.delete(product)
+                db.session.flush()
+                for product in batch:
+                    CategorySummary.apply(removed=product.summary_key())
+                    ProductChange.record(product, deleted=True)
+                db.session.commit()
+                archived += len(batch)
+                if len(batch) < batch_size:
+                    break
+        logger.info("Archived %d unavailable Products", archived)
+        return archived
+
+    @staticmethod
+    def stamp_unavailable(shard: int, now: datetime, batch_size: int):
+        """Sets unavailable_since to now where an unavailable Product has none
+
+        :param shard: the shard to stamp, None when not sharded
+        """
+        while True:
+            use_primary(db.session)
+            if shard is not None:
+                use_shard(db.session, shard)
+            ids = db.session.scalars(
+                select(Product.id)
+                .where(Product.available.is_(False), Product.unavailable_since.is_(None))
+                .limit(batch_size)
+            ).all()
+            if not ids:
+                return
+            db.session.execute(update(Product).where(Product.id.in_(ids)).values(unavailable_since=now))
+            db.session.commit()
+            logger.info("Stamped %d unavailable Products without unavailable_since", len(ids))
+
+
+class ProductIdSequence(db.Model):
+    """
+    Allocates Product ids on the primary when Products are sharded
+
+    Each shard has its own products table, so their autoincrement ids
+    would collide.
+    """
+
+    __tablename__ = "product_id_sequence"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # pylint: disable=invalid-name
+
+    @classmethod
+    def next_id(cls) -> int:
+        """Returns a new Product id, allocated in the current transaction
+
+        On PostgreSQL the id comes from the sequence of the table without
+        writing a row. Elsewhere the row that allocated it is deleted again,
+        the autoincrement never reuses its id, so the table stays empty.
+        """
+        use_primary(db.session)
+        if db.session.get_bind(cls).dialect.name == "postgresql":
+            return db.session.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:table, 'id'))"), {"table": cls.__tablename__}
+            ).scalar()
+        allocated = cls()
+        db.session.add(allocated)
+        db.session.flush()
+        db.session.delete(allocated)
+        return allocated.id
+
+    @classmethod
+    def advance(cls, value: int):
+        """Makes sure the next id allocated is larger than value"""
+        if value <= 0:
+            return
+        if db.session.get_bind(cls).dialect.name == "postgresql":
+            db.session.execute(
+                text(
+                    "SELECT setval(seq, greatest(:value, coalesce(pg_sequence_last_value(seq), 0)))"
+                    " FROM pg_get_serial_sequence(:table, 'id') AS seq"
+                ),
+                {"table": cls.__tablename__, "value": value},
+            )
+        else:
+            # an autoincrement never goes back below an id it has seen
+            db.session.query(cls).delete()
+            allocated = cls(id=value)
+            db.session.add(allocated)
+            db.session.flush()
+            db.session.delete(allocated)
+        db.session.commit()
+
+
+class ProductChange(db.Model):
+    """
+    An entry of the Product change log
+
+    A row is written in the same transaction as every Product
+    create/update/delete, so the log never disagrees with the catalog.
+    Consumers read the entries after the last seq they have applied:
+    upserts carry the serialized Product and tombstones only its id.
+
+    Entries older than CHANGES_RETENTION_DAYS are removed by flask
+    db-changes-purge, the newest one is always kept so the seq never goes
+    back. A consumer that fell further behind must read the catalog again.
+
+    On PostgreSQL the writers of the log do not wait for each other, so
+    entries can commit out of seq order. latest() and since() stop before
+    the first entry stamped after the horizon(), the start of the oldest
+    transaction still writing: every entry before it has committed or
+    never will, so a consumer never skips one that commits late. A long
+    writing transaction holds the log back for as long as it runs. The log
+    is read from the primary because a replica shows it as of its last
+    replayed commit.
+    """
+
+    __tablename__ = "product_change"
+    # never reuse the seq of a removed row
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    # Session.info key set while a transaction has logged changes
+    PENDING = "product_changes_pending"
+    # Callables run in this process after a transaction that logged
+    # changes commits, e.g. to wake the event stream
+    listeners = []
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    product_id = db.Column(db.Integer, nullable=False, index=True)
+    deleted = db.Column(db.Boolean(), nullable=False, default=False)
+    data = db.Column(db.Text, nullable=True)
+    changed_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<ProductChange {self.seq} id=[{self.product_id}]>"
+
+    def serialize(self) -> dict:
+        """Serializes a change into a dictionary"""
+        return {
+            "seq": self.seq,
+            "op": "delete" if self.deleted else "upsert",
+            "id": self.product_id,
+            "product": None if self.deleted else json.loads(self.data),
+            "changed_at": self.changed_at.isoformat(),
+        }
+
+    @classmethod
+    def record(cls, product: Product, deleted: bool = False):
+        """Adds a change of the Product to the current transaction
+
+        On PostgreSQL the transaction takes its id before the seq and the
+        seq before changed_at is stamped with the database clock, so the
+        entry is never stamped before the horizon() of a transaction that
+        holds a lower seq.
+        """
+        use_primary(db.session)
+        db.session.info[cls.PENDING] = True
+        change = cls(
+            product_id=product.id,
+            deleted=deleted,
+            data=None if deleted else json.dumps(product.serialize()),
+            changed_at=datetime.utcnow(),
+        )
+        if db.session.get_bind(cls).dialect.name == "postgresql":
+            db.session.execute(text("SELECT txid_current()"))
+            change.seq = db.session.execute(text("SELECT nextval(pg_get_serial_sequence('product_change', 'seq'))")).scalar()
+            change.changed_at = func.timezone("UTC", func.clock_timestamp())
+        db.session.add(change)
+
+    @classmethod
+    def horizon(cls):
+        """Returns the time before which every logged change has committed
+
+        That is the start of the oldest other transaction on the primary that
+        has written, or now when there is none. pg_stat_activity only shows
+        the transactions of other roles to pg_read_all_stats, every writer
+        must use the role of the app. None on SQLite where the writers
+        commit one at a time.
+        """
+        if db.engine.dialect.name != "postgresql":
+            return None
+        statement = text(
+            "SELECT coalesce(min(xact_start), clock_timestamp()) AT TIME ZONE 'UTC' FROM pg_stat_activity"
+            " WHERE datname = current_database() AND backend_xid IS NOT NULL AND pid <> pg_backend_pid()"
+        )
+        return db.session.execute(statement, bind_arguments={"bind": db.engine}).scalar()
+
+    @classmethod
+    def since(cls, seq: int, limit: int) -> list:
+        """Returns up to limit changes after seq up to latest() in order"""
+        logger.info("Processing changes since %s ...", seq)
+        statement = select(cls).where(cls.seq > seq, cls.seq <= cls.latest()).order_by(cls.seq).limit(limit)
+        return db.session.scalars(statement, bind_arguments={"bind": db.engine}).all()
+
+    @classmethod
+    def latest(cls) -> int:
+        """Returns the seq of the latest change a consumer may read, 0 if the log is empty"""
+        statement = select(func.max(cls.seq))
+        horizon = cls.horizon()
+        if horizon is not None:
+            late = select(func.min(cls.seq)).where(cls.changed_at >= horizon).scalar_subquery()
+            statement = statement.where(or_(late.is_(None), cls.seq < late))
+        return db.session.execute(statement, bind_arguments={"bind": db.engine}).scalar() or 0
+
+    @classmethod
+    def purge(cls, older_than: timedelta, batch_size: int) -> int:
+        """Deletes the changes older than a retention period in batches
+
+        The latest change is kept whatever its age.
+
+        :param older_than: how old a change must be to be deleted
+        :param batch_size: changes deleted per transaction
+        :return: the number of changes deleted
+        """
+        logger.info("Purging Product changes older than %s", older_than)
+        cutoff = datetime.utcnow() - older_than
+        latest = cls.latest()
+        count = 0
+        while True:
+            seqs = db.session.scalars(
+                select(cls.seq).where(cls.changed_at < cutoff, cls.seq < latest).order_by(cls.seq).limit(batch_size)
+            ).all()
+            if not seqs:
+                return count
+            db.session.execute(cls.__table__.delete().where(cls.seq.in_(seqs)))
+            db.session.commit()
+            count += len(seqs)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def notify_change_listeners(session):
+    """Tells the ProductChange listeners that logged changes committed"""
+    if session.info.pop(ProductChange.PENDING, False):
+        for listener in ProductChange.listeners:
+            try:
+                listener()
+            except Exception:  # pylint: disable=broad-except
+                # the transaction has committed, the caller must not fail
+                logger.exception("Product change listener %r failed", listener)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def forget_pending_changes(session):
+    """Forgets the changes of a transaction that was rolled back"""
+    session.info.pop(ProductChange.PENDING, None)
+
+
+class IdempotencyKey(db.Model):
+    """
+    The stored outcome of a request sent with an Idempotency-Key header
+
+    A row is claimed (status is None) before the request is processed and
+    completed with the response in the same transaction as its writes.
+    """
+
+    __tablename__ = "idempotency_key"
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    headers = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} status=[{self.status}]>"
+
+    def complete(self, body: str, status: int, headers: dict):
+        """Records the response, committed with the caller's transaction"""
+        self.body = body
+        self.status = status
+        self.headers = json.dumps(headers)
+
+    def response(self) -> tuple:
+        """Returns the stored (body, status, headers)"""
+        return self.body, self.status, json.loads(self.headers)
+
+    def release(self):
+        """Removes a claim whose request failed so that it can be retried"""
+        db.session.rollback()
+        db.session.query(IdempotencyKey).filter(
+            IdempotencyKey.key == self.key, IdempotencyKey.created_at == self.created_at
+        ).delete()
+        db.session.commit()
+
+    @classmethod
+    def claim(cls, key: str, fingerprint: str, ttl: int, lock_seconds: int) -> tuple:
+        """Claims a key for the current request
+
+        A claim that expired, or that has been in progress for longer than
+        lock_seconds because its request died, is taken over.
+
+        :return: a tuple of (record, claimed) where record is the existing
+            row when the key is held by another request
+        :rtype: tuple
+        """
+        now = datetime.utcnow()
+        values = {"fingerprint": fingerprint, "created_at": now, "expires_at": now + timedelta(seconds=ttl)}
+        record = cls(key=key, **values)
+        db.session.add(record)
+        try:
+            db.session.commit()
+            return record, True
+        except IntegrityError:
+            db.session.rollback()
+
+        use_primary(db.session)
+        existing = db.session.get(cls, key, populate_existing=True)
+        if existing is None:
+            # purged in the meantime
+            return cls.claim(key, fingerprint, ttl, lock_seconds)
+        abandoned = existing.status is None and existing.created_at <= now - timedelta(seconds=lock_seconds)
+        if existing.expires_at > now and not abandoned:
+            return existing, False
+        taken = db.session.execute(
+            update(cls)
+            .where(cls.key == key, cls.created_at == existing.created_at)
+            .values(status=None, body=None, headers=None, **values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if taken:
+            return db.session.get(cls, key, populate_existing=True), True
+        return db.session.get(cls, key, populate_existing=True), False
+
+    @classmethod
+    def purge(cls) -> int:
+        """Deletes the expired keys and returns how many were removed"""
+        logger.info("Purging expired idempotency keys")
+        count = cls.query.filter(cls.expires_at <= datetime.utcnow()).delete()
+        db.session.commit()
+        return count
+
+
+class Job(db.Model):
+    """
+    A long running operation run in the background, see jobs.py
+
+    The row holds the state, progress and result of the job so any worker
+    can report on it, and a cancellation requested through any worker is
+    seen by the one running it at its next progress report. The process
+    that runs the job is its owner and refreshes heartbeat_at while it has
+    jobs, so the jobs of a worker that died can be told apart and failed.
+    """
+
+    __tablename__ = "job"
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    ACTIVE = (QUEUED, RUNNING)
+
+    # the PostgreSQL advisory lock that makes the check of the job limit
+    # and the insert of a new Job atomic across workers
+    LOCK_KEY = 4243
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    id = db.Column(db.Integer, primary_key=True)  # pylint: disable=invalid-name
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, index=True)
+    params = db.Column(db.Text, nullable=False)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    cancel_requested = db.Column(db.Boolean(), nullable=False, default=False)
+    owner = db.Column(db.String(100), nullable=True, index=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<Job {self.kind} id=[{self.id}] status=[{self.status}]>"
+
+    def serialize(self) -> dict:
+        """Serializes a Job into a dictionary"""
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": {"done": self.done, "total": self.total},
+            "result": None if self.result is None else json.loads(self.result),
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    @classmethod
+    def create(cls, kind: str, params: dict, owner: str, max_active: int):
+        """Stores a new queued Job and commits it
+
+        :param owner: the process that will run the Job
+        :param max_active: the most queued and running Jobs of all workers
+        :return: the Job, or None if max_active Jobs are already active
+        """
+        logger.info("Queuing %s job", kind)
+        use_primary(db.session)
+        if db.session.get_bind(cls).dialect.name == "postgresql":
+            db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": cls.LOCK_KEY})
+        active = db.session.execute(select(func.count(cls.id)).where(cls.status.in_(cls.ACTIVE))).scalar()
+        if active >= max_active:
+            db.session.rollback()
+            return None
+        now = datetime.utcnow()
+        job = cls(kind=kind, status=cls.QUEUED, params=json.dumps(params), owner=owner, heartbeat_at=now, created_at=now)
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    @classmethod
+    def find(cls, job_id: int):
+        """Finds a Job by its id, read from the primary to see its latest state"""
+        use_primary(db.session)
+        return db.session.get(cls, job_id, populate_existing=True)
+
+    @classmethod
+    def start(cls, job_id: int):
+        """Marks a queued Job as running
+
+        :return: the Job, or None if it was cancelled or failed while queued
+        """
+        now = datetime.utcnow()
+        started = db.session.execute(
+            update(cls)
+            .where(cls.id == job_id, cls.status == cls.QUEUED)
+            .values(status=cls.RUNNING, started_at=now, heartbeat_at=now)
+        ).rowcount
+        db.session.commit()
+        return cls.find(job_id) if started else None
+
+    @classmethod
+    def report(cls, job_id: int, done: int, total: int = None) -> bool:
+        """Records the progress of a running Job and the heartbeat of its owner
+
+        The heartbeat also covers the queued Jobs of the owner, they wait
+        for the ones that report.
+
+        :return: True if the Job must stop, because a cancellation has
+            been requested or it is no longer running
+        """
+        values = {"done": done} if total is None else {"done": done, "total": total}
+        db.session.execute(update(cls).where(cls.id == job_id).values(**values))
+        owner = select(cls.owner).where(cls.id == job_id).scalar_subquery()
+        db.session.execute(
+            update(cls)
+            .where(cls.owner == owner, cls.status.in_(cls.ACTIVE))
+            .values(heartbeat_at=datetime.utcnow())
+        )
+        db.session.commit()
+        row = db.session.execute(select(cls.cancel_requested, cls.status).where(cls.id == job_id)).first()
+        return row is None or row.cancel_requested or row.status != cls.RUNNING
+
+    @classmethod
+    def finish(cls, job_id: int, status: str, result=None, error: str = None):
+        """Records the outcome of a running Job"""
+        db.session.execute(
+            update(cls)
+            .where(cls.id == job_id, cls.status == cls.RUNNING)
+            .values(
+                status=status,
+                result=None if result is None else json.dumps(result),
+                error=error,
+                finished_at=datetime.utcnow(),
+            )
+        )
+        db.session.commit()
+
+    @classmethod
+    def cancel(cls, job_id: int):
+        """Requests the cancellation of a Job
+
+        A queued Job is cancelled right away, a running one stops at its
+        next progress report and a finished one is left as it is.
+
+        :return: the Job, or None if not found
+        """
+        logger.info("Cancelling job %s", job_id)
+        use_primary(db.session)
+        db.session.execute(
+            update(cls)
+            .where(cls.id == job_id, cls.status.in_(cls.ACTIVE))
+            .values(cancel_requested=True)
+        )
+        db.session.execute(
+            update(cls)
+            .where(cls.id == job_id, cls.status == cls.QUEUED)
+            .values(status=cls.CANCELLED, finished_at=datetime.utcnow())
+        )
+        db.session.commit()
+        return cls.find(job_id)
+
+    @classmethod
+    def abandon(cls, owner: str = None, stale_seconds: float = None) -> int:
+        """Fails the active Jobs whose owner has stopped
+
+        :param owner: fail every active Job of this owner, it is shutting down
+        :param stale_seconds: fail the active Jobs whose owner has not
+            sent a heartbeat for this long, it has died
+        :return: the number of Jobs failed
+        """
+        use_primary(db.session)
+        criteria = [cls.status.in_(cls.ACTIVE)]
+        if owner is not None:
+            criteria.append(cls.owner == owner)
+        if stale_seconds is not None:
+            criteria.append(cls.heartbeat_at < datetime.utcnow() - timedelta(seconds=stale_seconds))
+        failed = db.session.execute(
+            update(cls)
+            .where(*criteria)
+            .values(status=cls.FAILED, error="The worker running the job stopped", finished_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        if failed:
+            logger.warning("Failed %d jobs of stopped workers", failed)
+        return failed
+
+    @classmethod
+    def write_output(cls, job_id: int, page: int, rows: list):
+        """Stores a page of the output of a Job"""
+        db.session.add(JobOutput(job_id=job_id, page=page, data=json.dumps(rows)))
+
+    @classmethod
+    def output(cls, job_id: int):
+        """Yields the output of a Job as one JSON array, a page at a time"""
+        yield "["
+        page, separator = 0, ""
+        while True:
+            data = db.session.execute(
+                select(JobOutput.data).where(JobOutput.job_id == job_id, JobOutput.page == page)
+            ).scalar()
+            if data is None:
+                break
+            if data != "[]":
+                yield separator + data[1:-1]
+                separator = ", "
+            page += 1
+        yield "]"
+
+
+class JobOutput(db.Model):
+    """
+    A page of the output of a Job, such as the Products of an export
+
+    The output is written and read a page at a time so that neither the
+    job nor the request that downloads it holds all of it in memory.
+    """
+
+    __tablename__ = "job_output"
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    page = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f"<JobOutput job=[{self.job_id}] page=[{self.page}]>"
@@ -18,12 +18,48 @@
 """
 Product Store Service with UI
 """
-from flask import jsonify, request, abort
+import json
+import time
+from flask import Response, jsonify, request, abort, stream_with_context
 from flask import url_for  # noqa: F401 pylint: disable=unused-import
-from service.models import Product
+from service.models import Job, Product, ProductChange, db, product_schema
 from service.common import status  # HTTP Status Codes
+from werkzeug.exceptions import ServiceUnavailable
+from service.common import assets, coalescing, counts, events, idempotency, jobs, readiness, readmodel, resultcache
+from service.common import snapshots, suggest
+from service.common.replicas import use_primary
 from . import app
 
+# Page sizes of the change feed
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_PAGE_SIZE = 1000
+
+# Most ids looked up by GET /products?ids= and POST /products/lookup
+IDS_MAX_GET = 100
+IDS_MAX_POST = 5000
+
+# Suggestions returned by GET /products/suggest by default and at most
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+
+# Methods that only read, and the read-only endpoints of other methods
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+READ_ENDPOINTS = {"lookup_products"}
+
+
+######################################################################
+# R E A D   Y O U R   W R I T E S
+######################################################################
+@app.before_request
+def pin_writes_to_primary():
+    """Makes a write request read from the primary
+
+    A lagging replica could miss a new Product or hold an old version,
+    which would fail the If-Match check or the versioned UPDATE.
+    """
+    if request.method not in READ_METHODS and request.endpoint not in READ_ENDPOINTS:
+        use_primary(db.session)
+
 
 ######################################################################
 # H E A L T H   C H E C K
@@ -34,13 +70,47 @@ def healthcheck():
     return jsonify(status=200, message="OK"), status.HTTP_200_OK
 
 
+######################################################################
+# R E A D I N E S S   C H E C K
+######################################################################
+@app.route("/ready")
+def readycheck():
+    """Let the load balancer know if this worker should get traffic"""
+    readiness.probe.start()
+    ready, report = readiness.probe.report()
+    if ready:
+        return jsonify(report), status.HTTP_200_OK
+    return jsonify(report), status.HTTP_503_SERVICE_UNAVAILABLE, {"Retry-After": str(max(1, round(readiness.probe.interval)))}
+
+
+######################################################################
+# M E T R I C S
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """Returns the counters of this worker"""
+    return jsonify(coalescing=coalescing.flights.metrics()), status.HTTP_200_OK
+
+
 ######################################################################
 # H O M E   P A G E
 ######################################################################
 @app.route("/")
 def index():
     """Base URL for our service"""
-    return app.send_static_file("index.html")
+    return assets.pipeline.send(assets.pipeline.index, assets.REVALIDATE)
+
+
+######################################################################
+# S T A T I C   A S S E T S
+######################################################################
+@app.route(f"{assets.ASSETS_URL}<path:filename>")
+def get_asset(filename):
+    """Serves a fingerprinted static file with immutable cache headers"""
+    asset = assets.pipeline.assets.get(filename)
+    if not asset:
+        abort(status.HTTP_404_NOT_FOUND, f"Asset '{filename}' was not found.")
+    return assets.pipeline.send(asset, assets.IMMUTABLE)
 
 
 ######################################################################
@@ -65,6 +135,22 @@ def check_content_type(content_type):
     )
 
 
+def etag_header(product) -> dict:
+    """Returns the ETag header holding the version of a Product"""
+    return {"ETag": f'"{product.version}"'}
+
+
+def if_match_versions():
+    """Returns the versions listed in If-Match, or None when any version matches
+
+    The ETag of a compressed response has the encoding after the version.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = [etag.partition("-")[0] for etag in request.if_match.as_set()]
+    return {int(version) for version in versions if version.isdigit()}
+
+
 ######################################################################
 # C R E A T E   A   N E W   P R O D U C T
 ######################################################################
@@ -81,48 +167,456 @@ def create_products():
     app.logger.info("Processing: %s", data)
     product = Product()
     product.deserialize(data)
-    product.create()
-    app.logger.info("Product with new id [%s] saved!", product.id)
 
-    message = product.serialize()
+    def respond():
+        location_url = url_for("get_products", product_id=product.id, _external=True)
+        return product.serialize(), status.HTTP_201_CREATED, {"Location": location_url, **etag_header(product)}
 
-    #
-    # Uncomment this line of code once you implement READ A PRODUCT
-    #
-    # location_url = url_for("get_products", product_id=product.id, _external=True)
-    location_url = "/"  # delete once READ is implemented
-    return jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
+    key = request.headers.get(idempotency.HEADER)
+    if not key:
+        product.create()
+        app.logger.info("Product with new id [%s] saved!", product.id)
+        message, code, headers = respond()
+        return jsonify(message), code, headers
+
+    body, code, headers, replayed = idempotency.store.run(key, data, product.create, respond)
+    if replayed:
+        app.logger.info("Replaying response for %s [%s]", idempotency.HEADER, key)
+        headers = {**headers, idempotency.REPLAYED: "true"}
+    else:
+        app.logger.info("Product with new id [%s] saved!", product.id)
+    return app.response_class(body, status=code, headers=headers, mimetype="application/json")
+
+
+######################################################################
+# P R O D U C T   S T A T I S T I C S
+######################################################################
+@app.route("/products/stats", methods=["GET"])
+def get_product_stats():
+    """
+    Returns per-Category statistics
+
+    This endpoint returns the counts, availability ratio and min/avg/max
+    price of every Category that has Products
+    """
+    app.logger.info("Request for Product statistics...")
+    stats = Product.statistics()
+    app.logger.info("Returning statistics for %d categories", len(stats))
+    return jsonify(stats), status.HTTP_200_OK
+
+
+######################################################################
+# C H A N G E   F E E D
+######################################################################
+@app.route("/products/changes", methods=["GET"])
+def list_product_changes():
+    """
+    Returns the Product changes after a sequence number
+
+    Consumers pass the "next" value of the previous page as since= and
+    apply the upserts and tombstones in order. Changes are kept for
+    CHANGES_RETENTION_DAYS, a consumer further behind reads the catalog again
+    """
+    app.logger.info("Request for Product changes...")
+    since = request.args.get("since", 0, type=int)
+    limit = request.args.get("limit", CHANGES_PAGE_SIZE, type=int)
+    if since < 0 or not 0 < limit <= CHANGES_MAX_PAGE_SIZE:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"since must be positive and limit between 1 and {CHANGES_MAX_PAGE_SIZE}",
+        )
+    changes = [change.serialize() for change in ProductChange.since(since, limit)]
+    app.logger.info("Returning %d changes", len(changes))
+    return jsonify(changes=changes, next=changes[-1]["seq"] if changes else since), status.HTTP_200_OK
+
+
+######################################################################
+# C H A N G E   E V E N T S
+######################################################################
+@app.route("/products/events", methods=["GET"])
+def stream_product_events():
+    """
+    Streams Product changes as Server-Sent Events
+
+    Each event has the change seq as its id, so a client that reconnects
+    with Last-Event-ID (or ?last_event_id=) receives what it missed
+    """
+    app.logger.info("Request for a Product event stream...")
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
+    if last_event_id is not None:
+        if not last_event_id.isdigit():
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid Last-Event-ID: {last_event_id}")
+        last_event_id = int(last_event_id)
+    cursor = events.broadcaster.subscribe(last_event_id)
+    if cursor is None:
+        raise ServiceUnavailable("Too many event subscribers, try again later.", retry_after=5)
+    response = Response(
+        events.broadcaster.stream(cursor),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(events.broadcaster.unsubscribe)
+    return response
 
 
 ######################################################################
 # L I S T   A L L   P R O D U C T S
 ######################################################################
+@app.route("/products", methods=["GET"])
+def list_products():
+    """
+    Returns a list of Products
+
+    The list can be filtered by name, category or availability, or
+    ?ids=1,2,3 returns the Products of those ids in that order.
+    With ?count=exact|estimate|cached the X-Total-Count header holds the
+    number of matching Products, HEAD only returns that header.
+    """
+    app.logger.info("Request to list Products...")
+    if "ids" in request.args:
+        ids = parse_ids(request.args["ids"].split(","), IDS_MAX_GET)
+        return jsonify(products_by_id(ids)), status.HTTP_200_OK
+    filters = product_filters()
+    app.logger.info("Find by %s", filters or "all")
+    mode = request.args.get("count")
+    if mode is not None and mode not in counts.MODES:
+        abort(status.HTTP_400_BAD_REQUEST, f"count must be one of {', '.join(counts.MODES)}")
+    if request.method == "HEAD":
+        return "", status.HTTP_200_OK, {"X-Total-Count": str(counts.counter.count(filters, mode or "exact"))}
+
+    results = readmodel.catalog.search(**filters) if readmodel.catalog.enabled else None
+    body = None if results is not None else snapshot_list(filters)
+    if body is not None:
+        return app.response_class(body, mimetype="application/json"), status.HTTP_200_OK, total_count(filters, mode)
+    if results is None and resultcache.cache.enabled:
+        body, total = resultcache.cache.fetch(filters, find_products)
+        app.logger.info("[%s] Products returned", total)
+        return app.response_class(body, mimetype="application/json"), status.HTTP_200_OK, total_count(filters, mode, total)
+    if results is None:
+        results = find_products(filters)
+
+    app.logger.info("[%s] Products returned", len(results))
+    return jsonify(results), status.HTTP_200_OK, total_count(filters, mode, len(results))
+
+
+def snapshot_list(filters: dict):
+    """Returns the JSON body of a list from the catalog snapshot, or None if it cannot serve it"""
+    if not snapshots.store.enabled or "name" in filters:
+        return None
+    view = snapshots.store.view()
+    return snapshots.store.list(view, **filters) if view else None
+
+
+def total_count(filters: dict, mode: str, listed: int = None) -> dict:
+    """Returns the X-Total-Count header of a list request if it asked for one
+
+    :param listed: the number of Products in the response, when known
+    """
+    if not mode:
+        return {}
+    if mode == "exact" and listed is not None:
+        # the whole list is returned, so the exact count is free
+        return {"X-Total-Count": str(listed)}
+    return {"X-Total-Count": str(counts.counter.count(filters, mode))}
+
+
+######################################################################
+# S U G G E S T   P R O D U C T   N A M E S
+######################################################################
+@app.route("/products/suggest", methods=["GET"])
+def suggest_products():
+    """
+    Returns the Products whose name starts with ?prefix= for type-ahead
+
+    Available Products come first, then the ones in ?category= if given.
+    The Server-Timing header holds the time the lookup took.
+    """
+    prefix = request.args.get("prefix", "")
+    if not prefix.strip():
+        abort(status.HTTP_400_BAD_REQUEST, "prefix is required")
+    limit = request.args.get("limit", SUGGEST_LIMIT, type=int)
+    if not 0 < limit <= SUGGEST_MAX_LIMIT:
+        abort(status.HTTP_400_BAD_REQUEST, f"limit must be between 1 and {SUGGEST_MAX_LIMIT}")
+    category = request.args.get("category")
+    if category and category.upper() not in product_schema.categories:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid category: {category}")
+    start = time.perf_counter()
+    results = suggest.index.suggest(prefix, category.upper() if category else None, limit)
+    elapsed = time.perf_counter() - start
+    return jsonify(results), status.HTTP_200_OK, {"Server-Timing": f"suggest;dur={elapsed * 1000:.3f}"}
+
+
+######################################################################
+# L O O K   U P   M A N Y   P R O D U C T S
+######################################################################
+@app.route("/products/lookup", methods=["POST"])
+def lookup_products():
+    """
+    Returns the Products of the ids posted as {"ids": [1, 2, 3]}
+
+    The POST form of GET /products?ids= for id sets too large for a URL
+    """
+    app.logger.info("Request to look up Products...")
+    check_content_type("application/json")
+    data = request.get_json()
+    ids = data.get("ids") if isinstance(data, dict) else None
+    if not isinstance(ids, list):
+        abort(status.HTTP_400_BAD_REQUEST, "ids must be a list of Product ids")
+    return jsonify(products_by_id(parse_ids(ids, IDS_MAX_POST))), status.HTTP_200_OK
+
+
+def parse_ids(values: list, limit: int) -> list:
+    """Returns the Product ids of a batch request, or aborts with 400"""
+    if len(values) > limit:
+        abort(status.HTTP_400_BAD_REQUEST, f"At most {limit} ids can be requested at once")
+    ids = []
+    for value in values:
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if not isinstance(value, int) or isinstance(value, bool):
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid Product id: {value!r}")
+        ids.append(value)
+    return ids
+
+
+def products_by_id(ids: list) -> list:
+    """Returns the serialized Product of every id in order
+
+    Products the catalog snapshot is current for are read from it, the
+    others with one query. Missing Products are marked with a 404 entry.
+    """
+    found = {}
+    view = snapshots.store.view() if snapshots.store.enabled else None
+    if view:
+        for product_id in ids:
+            if product_id not in view.changed:
+                entry = snapshots.store.get(view, product_id)
+                found[product_id] = json.loads(entry[0]) if entry else None
+    missing = [product_id for product_id in dict.fromkeys(ids) if product_id not in found]
+    for product_id, product in zip(missing, Product.find_many(missing)):
+        found[product_id] = product.serialize() if product else None
+    app.logger.info("Found %d of %d Products", sum(1 for product in found.values() if product), len(found))
+    return [
+        found[product_id] or {"id": product_id, "status": status.HTTP_404_NOT_FOUND, "error": "Not Found"}
+        for product_id in ids
+    ]
+
+
+def product_filters() -> dict:
+    """Returns the filter of the list request, name, category or available"""
+    name = request.args.get("name")
+    category = request.args.get("category")
+    available = request.args.get("available")
+    if name:
+        return {"name": name}
+    if category:
+        category_value = product_schema.categories.get(category.upper())
+        if category_value is None:
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid category: {category}")
+        return {"category": category_value}
+    if available:
+        return {"available": available.lower() in ["true", "yes", "1"]}
+    return {}
+
+
+def find_products(filters: dict) -> list:
+    """Returns the serialized Products that match the filter from the database"""
+    if "name" in filters:
+        products = Product.find_by_name(filters["name"])
+    elif "category" in filters:
+        category = filters["category"]
+        return coalescing.flights.do(
+            ("category", category.name),
+            lambda: [product.serialize() for product in Product.find_by_category(category)],
+        )
+    elif "available" in filters:
+        products = Product.find_by_availability(filters["available"])
+    else:
+        products = Product.all()
+    return [product.serialize() for product in products]
 
-#
-# PLACE YOUR CODE TO LIST ALL PRODUCTS HERE
-#
 
 ######################################################################
 # R E A D   A   P R O D U C T
 ######################################################################
+@app.route("/products/<int:product_id>", methods=["GET"])
+def get_products(product_id):
+    """
+    Retrieve a single Product
+
+    This endpoint will return a Product based on it's id, with
+    ?archived=true it is also looked up in the archive
+    """
+    app.logger.info("Request to Retrieve a product with id [%s]", product_id)
+    archived = request.args.get("archived", "").lower() in ["true", "yes", "1"]
+    view = snapshots.store.view() if snapshots.store.enabled and not archived else None
+    if view and product_id not in view.changed:
+        found = snapshots.store.get(view, product_id)
+        if not found:
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        body, version = found
+        return app.response_class(body, mimetype="application/json"), status.HTTP_200_OK, {"ETag": f'"{version}"'}
+
+    def load_product():
+        product = Product.find(product_id, archived=archived)
+        return (product.serialize(), etag_header(product)) if product else None
+
+    found = coalescing.flights.do(("product", product_id, archived), load_product)
+    if not found:
+        abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+
+    app.logger.info("Returning product: %s", found[0]["name"])
+    return jsonify(found[0]), status.HTTP_200_OK, found[1]
 
-#
-# PLACE YOUR CODE HERE TO READ A PRODUCT
-#
 
 ######################################################################
 # U P D A T E   A   P R O D U C T
 ######################################################################
+@app.route("/products/<int:product_id>", methods=["PUT"])
+def update_products(product_id):
+    """
+    Update a Product
+
+    This endpoint will update a Product based the body that is posted
+    """
+    app.logger.info("Request to Update a product with id [%s]", product_id)
+    check_content_type("application/json")
+
+    product = Product.find(product_id)
+    if not product:
+        abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+    versions = if_match_versions()
+    if versions is not None and product.version not in versions:
+        abort(status.HTTP_412_PRECONDITION_FAILED, f"Product with id '{product_id}' has been modified.")
+
+    product.deserialize(request.get_json())
+    product.id = product_id
+    product.update()
+    return jsonify(product.serialize()), status.HTTP_200_OK, etag_header(product)
+
+
+######################################################################
+# P A T C H   A   P R O D U C T
+######################################################################
+@app.route("/products/<int:product_id>", methods=["PATCH"])
+def patch_products(product_id):
+    """
+    Partially update a Product
+
+    This endpoint changes only the fields in the body with one conditional
+    UPDATE. Send the ETag of the Product in If-Match to make sure that no
+    one else has changed it in the meantime.
+    """
+    app.logger.info("Request to Patch a product with id [%s]", product_id)
+    check_content_type("application/json")
+
+    product = Product.patch(product_id, request.get_json(), if_match_versions())
+    if not product:
+        if Product.find(product_id):
+            abort(status.HTTP_412_PRECONDITION_FAILED, f"Product with id '{product_id}' has been modified.")
+        abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+
+    return jsonify(product.serialize()), status.HTTP_200_OK, etag_header(product)
 
-#
-# PLACE YOUR CODE TO UPDATE A PRODUCT HERE
-#
 
 ######################################################################
 # D E L E T E   A   P R O D U C T
 ######################################################################
+@app.route("/products/<int:product_id>", methods=["DELETE"])
+def delete_products(product_id):
+    """
+    Delete a Product
 
+    This endpoint will delete a Product based the id specified in the path
+    """
+    app.logger.info("Request to Delete a product with id [%s]", product_id)
+    product = Product.find(product_id)
+    if not product:
+        abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
 
-#
-# PLACE YOUR CODE TO DELETE A PRODUCT HERE
-#
+    product.delete()
+    app.logger.info("Product with id [%s] deleted", product_id)
+    return "", status.HTTP_204_NO_CONTENT
+
+
+######################################################################
+# S T A R T   A   B A C K G R O U N D   J O B
+######################################################################
+@app.route("/jobs", methods=["POST"])
+def create_jobs():
+    """
+    Starts a bulk operation in the background
+
+    The body names the kind of job (import, export, delete or archive) and
+    its params. The Job is answered with 202 Accepted before it runs, its
+    Location reports the progress and result.
+    """
+    app.logger.info("Request to start a Job...")
+    check_content_type("application/json")
+    data = request.get_json()
+    kind = data.get("kind") if isinstance(data, dict) else None
+    params = data.get("params", {}) if isinstance(data, dict) else None
+    if kind not in jobs.runner.kinds:
+        abort(status.HTTP_400_BAD_REQUEST, f"kind must be one of {', '.join(sorted(jobs.runner.kinds))}")
+    if not isinstance(params, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "params must be an object")
+
+    job = jobs.runner.submit(kind, params)
+    if job is None:
+        raise ServiceUnavailable("Too many jobs in progress, try again later.", retry_after=5)
+    app.logger.info("Job with new id [%s] queued", job.id)
+    location_url = url_for("get_jobs", job_id=job.id, _external=True)
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED, {"Location": location_url}
+
+
+######################################################################
+# R E A D   A   J O B
+######################################################################
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+def get_jobs(job_id):
+    """
+    Retrieve the state, progress and result of a Job
+    """
+    app.logger.info("Request to Retrieve a job with id [%s]", job_id)
+    job = jobs.runner.find(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+    return jsonify(job.serialize()), status.HTTP_200_OK
+
+
+######################################################################
+# D O W N L O A D   T H E   O U T P U T   O F   A   J O B
+######################################################################
+@app.route("/jobs/<int:job_id>/output", methods=["GET"])
+def get_job_output(job_id):
+    """
+    Stream the output of a finished Job, such as the Products of an export
+
+    The output is read a page at a time, so large exports are not loaded
+    into memory.
+    """
+    app.logger.info("Request for the output of job with id [%s]", job_id)
+    job = jobs.runner.find(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+    if job.status != Job.SUCCEEDED:
+        abort(status.HTTP_409_CONFLICT, f"Job with id '{job_id}' has not succeeded.")
+    return Response(stream_with_context(Job.output(job_id)), mimetype="application/json")
+
+
+######################################################################
+# C A N C E L   A   J O B
+######################################################################
+@app.route("/jobs/<int:job_id>", methods=["DELETE"])
+def cancel_jobs(job_id):
+    """
+    Cancel a Job
+
+    A queued Job is cancelled at once and a running one at its next
+    progress report, so the Job is returned with 202 Accepted
+    """
+    app.logger.info("Request to Cancel a job with id [%s]", job_id)
+    job = Job.cancel(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED
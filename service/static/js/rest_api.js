@@ -181,6 +181,31 @@ $(function () {
         clear_form_data()
     });
 
+    // ****************************************
+    // Suggest Product names while typing
+    // ****************************************
+
+    let suggestTimer = null;
+
+    $("#product_name").on("input", function () {
+        let prefix = $(this).val();
+        clearTimeout(suggestTimer);
+        if (!prefix.trim()) {
+            $("#product_suggestions").empty();
+            return;
+        }
+        suggestTimer = setTimeout(function () {
+            let category = $("#product_category").val();
+            $.getJSON("/products/suggest", category ? {prefix: prefix, category: category} : {prefix: prefix})
+                .done(function(res){
+                    let names = [...new Set(res.map(product => product.name))];
+                    $("#product_suggestions").empty().append(
+                        names.map(name => $("<option>").attr("value", name))
+                    );
+                });
+        }, 100);
+    });
+
     // ****************************************
     // Search for a Product
     // ****************************************
@@ -0,0 +1,105 @@
+"""
+Admission Control Test Suite
+"""
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from flask import Flask
+from service import config
+from service.common import status
+from service.common.admission import ConcurrencyLimiter, TokenBuckets, init_admission, pool_saturation
+
+
+class TestAdmission(TestCase):
+    """Test Cases for rate limiting and load shedding"""
+
+    def _app(self, **settings) -> Flask:
+        """Creates an app with the admission hooks and the given limits"""
+        app = Flask(__name__)
+        app.config.from_object(config)
+        app.config.update(settings)
+        app.add_url_rule("/health", "healthcheck", lambda: "OK")
+        app.add_url_rule("/products", "list_products", lambda: self.handler())
+        init_admission(app)
+        return app
+
+    def handler(self):
+        """The protected route"""
+        return "[]"
+
+    def test_rate_limit(self):
+        """It should return 429 with Retry-After once the bucket is empty"""
+        client = self._app(ADMISSION_RATE_LIMIT=0.5, ADMISSION_BURST=2).test_client()
+        self.assertEqual(client.get("/products").status_code, status.HTTP_200_OK)
+        self.assertEqual(client.get("/products").status_code, status.HTTP_200_OK)
+        response = client.get("/products")
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response.headers["Retry-After"], "2")
+        self.assertEqual(client.get("/health").status_code, status.HTTP_200_OK)
+
+    def test_rate_limit_per_client(self):
+        """It should keep a bucket per client"""
+        client = self._app(ADMISSION_RATE_LIMIT=1, ADMISSION_BURST=1, ADMISSION_CLIENT_HEADER="X-Forwarded-For").test_client()
+        self.assertEqual(client.get("/products", headers={"X-Forwarded-For": "1.1.1.1"}).status_code, 200)
+        self.assertEqual(client.get("/products", headers={"X-Forwarded-For": "1.1.1.1"}).status_code, 429)
+        self.assertEqual(client.get("/products", headers={"X-Forwarded-For": "2.2.2.2, 10.0.0.1"}).status_code, 200)
+
+    def test_token_bucket_refill(self):
+        """It should refill the bucket over time"""
+        buckets = TokenBuckets(rate=10, burst=1)
+        with patch("service.common.admission.time.monotonic", side_effect=[0.0, 0.0, 0.05, 0.2]):
+            self.assertEqual(buckets.take("a"), 0)
+            self.assertAlmostEqual(buckets.take("a"), 0.1)
+            self.assertAlmostEqual(buckets.take("a"), 0.05)
+            self.assertEqual(buckets.take("a"), 0)
+
+    def test_shed_inflight(self):
+        """It should shed requests over the in-flight limit with 503"""
+        app = self._app(ADMISSION_MAX_INFLIGHT=1)
+        inside, release = threading.Event(), threading.Event()
+
+        def slow():
+            inside.set()
+            release.wait(5)
+            return "[]"
+
+        self.handler = slow
+        first = threading.Thread(target=app.test_client().get, args=("/products",))
+        first.start()
+        inside.wait(5)
+        self.handler = lambda: "[]"
+        response = app.test_client().get("/products")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        release.set()
+        first.join()
+        self.assertEqual(app.test_client().get("/products").status_code, status.HTTP_200_OK)
+        self.assertEqual(app.extensions["admission"].inflight, 0)
+
+    def test_shed_on_pool_saturation(self):
+        """It should shed requests when the database pool is saturated"""
+        app = self._app(ADMISSION_MAX_POOL_SATURATION=0.9)
+        app.extensions["sqlalchemy"] = MagicMock()
+        with patch("service.common.admission.pool_saturation", return_value=1.0):
+            self.assertEqual(app.test_client().get("/products").status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        with patch("service.common.admission.pool_saturation", return_value=0.5):
+            self.assertEqual(app.test_client().get("/products").status_code, status.HTTP_200_OK)
+
+    def test_pool_saturation(self):
+        """It should compute the share of checked out connections"""
+        engine = MagicMock()
+        engine.pool.size.return_value = 5
+        engine.pool._max_overflow = 5  # pylint: disable=protected-access
+        engine.pool.checkedout.return_value = 8
+        self.assertEqual(pool_saturation(engine), 0.8)
+        engine.pool = object()
+        self.assertEqual(pool_saturation(engine), 0.0)
+
+    def test_limiter(self):
+        """It should count the requests in flight"""
+        limiter = ConcurrencyLimiter(2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
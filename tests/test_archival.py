@@ -0,0 +1,72 @@
+"""
+Product Archival Test Suite
+"""
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+from service import app
+from service.common.archival import archiver
+from service.models import Product, ProductArchive, db
+from tests.factories import ProductFactory
+
+
+class TestArchiver(TestCase):
+    """Test Cases for the background archival passes"""
+
+    def setUp(self):
+        """Runs before each test"""
+        db.session.query(Product).delete()
+        db.session.query(ProductArchive).delete()
+        db.session.commit()
+        archiver.after_days = 30
+        archiver.batch_size = 10
+
+    def tearDown(self):
+        """Runs after each test"""
+        archiver.stop()
+        archiver.interval = app.config["ARCHIVE_INTERVAL_SECONDS"]
+        archiver.after_days = app.config["ARCHIVE_AFTER_DAYS"]
+        archiver.batch_size = app.config["ARCHIVE_BATCH_SIZE"]
+        db.session.remove()
+
+    def _create(self, days_ago: int) -> int:
+        product = ProductFactory(available=False)
+        product.id = None
+        product.create()
+        product.unavailable_since = datetime.utcnow() - timedelta(days=days_ago)
+        product.update()
+        return product.id
+
+    def test_run_pass(self):
+        """It should archive the Products unavailable for longer than ARCHIVE_AFTER_DAYS"""
+        old_id = self._create(days_ago=31)
+        recent_id = self._create(days_ago=1)
+        self.assertEqual(archiver.run_pass(), 1)
+        self.assertEqual([product.id for product in Product.all()], [recent_id])
+        self.assertIsNotNone(Product.find(old_id, archived=True))
+
+    def test_background_passes(self):
+        """It should run the passes in a thread until stopped"""
+        old_id = self._create(days_ago=31)
+        archiver.interval = 0.05
+        archiver.start()
+        archiver.start()  # already running
+        deadline = time.monotonic() + 5
+        while Product.find(old_id) and time.monotonic() < deadline:
+            db.session.remove()
+            time.sleep(0.05)
+        self.assertIsNone(Product.find(old_id))
+        archiver.stop()
+        self.assertIsNone(archiver.thread)
+
+    def test_failed_pass(self):
+        """It should keep running after a pass fails"""
+        archiver.interval = 0.05
+        with patch.object(ProductArchive, "archive_unavailable", side_effect=RuntimeError("boom")) as archive_mock:
+            archiver.start()
+            deadline = time.monotonic() + 5
+            while archive_mock.call_count < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        self.assertGreaterEqual(archive_mock.call_count, 2)
+        self.assertTrue(archiver.thread.is_alive())
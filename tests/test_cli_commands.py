@@ -2,10 +2,15 @@
 CLI Command Extensions for Flask
 """
 import os
+from datetime import timedelta
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service.models import DataValidationError
+from service.common.cli_commands import (
+    db_create, db_partition, db_stats_rebuild, db_idempotency_purge, db_shards_rebalance, db_archive, snapshot_build,
+    db_price_storage, db_changes_purge,
+)
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +26,105 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.Product')
+    @patch('service.common.cli_commands.db')
+    def test_db_partition(self, db_mock, product_mock):
+        """It should call the db-partition command"""
+        db_mock.engine.dialect.name = "postgresql"
+        product_mock.partition_by_category.return_value = ["CREATE TABLE product_food"]
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_partition)
+            self.assertEqual(result.exit_code, 0)
+            product_mock.partition_by_category.assert_called_once_with(db_mock.engine)
+            self.assertIn("Ran 1 statements", result.output)
+
+    @patch('service.common.cli_commands.db')
+    def test_db_partition_requires_postgresql(self, db_mock):
+        """It should refuse to partition other databases"""
+        db_mock.engine.dialect.name = "sqlite"
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_partition)
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("requires PostgreSQL", result.output)
+
+    @patch('service.common.cli_commands.Product')
+    @patch('service.common.cli_commands.db')
+    def test_db_price_storage(self, db_mock, product_mock):
+        """It should call the db-price-storage command"""
+        db_mock.engine.dialect.name = "postgresql"
+        product_mock.migrate_price_storage.return_value = ["ALTER TABLE product", "ALTER TABLE product_archive"]
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_price_storage, ["--numeric"])
+            self.assertEqual(result.exit_code, 0)
+            product_mock.migrate_price_storage.assert_called_once_with(db_mock.engine, False, 2)
+            self.assertIn("Ran 2 statements", result.output)
+            product_mock.migrate_price_storage.side_effect = DataValidationError("3 prices in product")
+            result = self.runner.invoke(db_price_storage)
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("3 prices in product", result.output)
+
+    @patch('service.common.cli_commands.db')
+    def test_db_price_storage_requires_postgresql(self, db_mock):
+        """It should refuse to convert the prices of other databases"""
+        db_mock.engine.dialect.name = "sqlite"
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_price_storage)
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("requires PostgreSQL", result.output)
+
+    @patch('service.common.cli_commands.CategorySummary')
+    def test_db_stats_rebuild(self, summary_mock):
+        """It should call the db-stats-rebuild command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_stats_rebuild)
+            self.assertEqual(result.exit_code, 0)
+            summary_mock.rebuild.assert_called_once()
+
+    @patch('service.common.cli_commands.IdempotencyKey')
+    def test_db_idempotency_purge(self, key_mock):
+        """It should call the db-idempotency-purge command"""
+        key_mock.purge.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_idempotency_purge)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Purged 3", result.output)
+
+    @patch('service.common.cli_commands.ProductChange')
+    def test_db_changes_purge(self, change_mock):
+        """It should call the db-changes-purge command"""
+        change_mock.purge.return_value = 5
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_changes_purge, ["--days", "2"])
+            self.assertEqual(result.exit_code, 0)
+            change_mock.purge.assert_called_once_with(timedelta(days=2), 1000)
+            self.assertIn("Purged 5 Product changes", result.output)
+
+    @patch('service.common.cli_commands.Product')
+    def test_db_shards_rebalance(self, product_mock):
+        """It should call the db-shards-rebalance command"""
+        product_mock.rebalance.return_value = 4
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_shards_rebalance, ["--batch-size", "10"])
+            self.assertEqual(result.exit_code, 0)
+            product_mock.rebalance.assert_called_once_with(10)
+            self.assertIn("Moved 4 Products", result.output)
+
+    @patch('service.common.cli_commands.ProductArchive')
+    def test_db_archive(self, archive_mock):
+        """It should call the db-archive command"""
+        archive_mock.archive_unavailable.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_archive, ["--days", "30", "--batch-size", "10"])
+            self.assertEqual(result.exit_code, 0)
+            archive_mock.archive_unavailable.assert_called_once_with(timedelta(days=30), 10)
+            self.assertIn("Archived 3 Products", result.output)
+
+    @patch('service.common.cli_commands.snapshots')
+    def test_snapshot_build(self, snapshots_mock):
+        """It should call the snapshot-build command"""
+        snapshots_mock.build.return_value = True
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(snapshot_build)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Built catalog snapshot", result.output)
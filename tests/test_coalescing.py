@@ -0,0 +1,103 @@
+"""
+Request Coalescing Test Suite
+"""
+import threading
+from unittest import TestCase
+from service.common.coalescing import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+    """Test Cases for SingleFlight"""
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.runs = 0
+
+    def _slow(self, result="result"):
+        """A call that blocks until the test releases it"""
+        def call():
+            self.runs += 1
+            self.started.set()
+            self.release.wait(5)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return call
+
+    def _wait_for_followers(self, count):
+        """Waits until count callers are waiting for the flight in progress"""
+        with self.flights.joined:
+            if not self.flights.joined.wait_for(lambda: self.flights.waiting >= count, 5):
+                self.fail(f"{count} callers did not join the flight")
+
+    def _followers(self, key, count, call):
+        """Starts callers that join the flight in progress"""
+        results = []
+
+        def follow():
+            try:
+                results.append(self.flights.do(key, call))
+            except ValueError as error:
+                results.append(error)
+
+        threads = [threading.Thread(target=follow) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_coalesce_identical_calls(self):
+        """It should run identical concurrent calls once and share the result"""
+        threads, results = self._followers("key", 1, self._slow())
+        self.started.wait(5)
+        more, more_results = self._followers("key", 3, self._slow("other"))
+        self._wait_for_followers(3)
+        self.release.set()
+        for thread in threads + more:
+            thread.join()
+        self.assertEqual(results + more_results, ["result"] * 4)
+        self.assertEqual(self.runs, 1)
+        metrics = self.flights.metrics()
+        self.assertEqual(metrics["calls"], 4)
+        self.assertEqual(metrics["executed"], 1)
+        self.assertEqual(metrics["coalescing_ratio"], 0.75)
+        self.assertEqual((metrics["in_flight"], metrics["waiting"]), (0, 0))
+
+    def test_share_errors(self):
+        """It should raise the error of the call in every waiting caller"""
+        threads, results = self._followers("key", 1, self._slow(ValueError("boom")))
+        self.started.wait(5)
+        more, more_results = self._followers("key", 2, self._slow())
+        self._wait_for_followers(2)
+        self.release.set()
+        for thread in threads + more:
+            thread.join()
+        self.assertTrue(all(isinstance(result, ValueError) for result in results + more_results))
+        self.assertEqual(self.flights.do("key", lambda: "again"), "again")
+
+    def test_wait_timeout(self):
+        """It should run the call itself when the flight takes too long"""
+        self.flights.wait_seconds = 0.05
+        threads, results = self._followers("key", 1, self._slow())
+        self.started.wait(5)
+        self.assertEqual(self.flights.do("key", lambda: "own"), "own")
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["result"])
+        metrics = self.flights.metrics()
+        self.assertEqual((metrics["coalesced"], metrics["timed_out"]), (0, 1))
+        self.assertEqual((metrics["calls"], metrics["executed"]), (2, 2))
+
+    def test_different_keys(self):
+        """It should not coalesce calls with different keys"""
+        self.assertEqual(self.flights.do("a", lambda: 1), 1)
+        self.assertEqual(self.flights.do("b", lambda: 2), 2)
+        self.assertEqual(self.flights.metrics()["coalesced"], 0)
+
+    def test_disabled(self):
+        """It should run every call when disabled"""
+        self.flights.enabled = False
+        self.assertEqual(self.flights.do("a", lambda: 1), 1)
+        self.assertEqual(self.flights.metrics()["calls"], 0)
@@ -0,0 +1,93 @@
+"""
+Response Compression Test Suite
+"""
+import gzip
+import zlib
+from unittest import TestCase, skipUnless
+from flask import Flask, Response
+from service import config
+from service.common import status
+from service.common.compression import GzipCompressor, brotli, compress_stream, init_compression, zstandard
+
+
+class TestCompression(TestCase):
+    """Test Cases for response compression"""
+
+    def setUp(self):
+        """Creates an app with routes that return large and streamed bodies"""
+        self.app = Flask(__name__)
+        self.app.config.from_object(config)
+        self.app.config["TESTING"] = True
+        self.app.add_url_rule("/_test/large", "large", lambda: {"data": "x" * 4096})
+        self.app.add_url_rule("/_test/small", "small", lambda: {"data": "x"})
+        self.app.add_url_rule("/_test/tagged", "tagged", lambda: ({"data": "x" * 4096}, {"ETag": '"7"'}))
+        self.app.add_url_rule(
+            "/_test/stream",
+            "stream",
+            lambda: Response((f"{n}," for n in range(1000)), mimetype="application/json"),
+        )
+        init_compression(self.app)
+        self.client = self.app.test_client()
+
+    def test_gzip_large_response(self):
+        """It should gzip a large JSON response"""
+        response = self.client.get("/_test/large", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertIn(b"x" * 4096, gzip.decompress(response.data))
+
+    def test_etag_per_encoding(self):
+        """It should give a compressed response its own ETag"""
+        response = self.client.get("/_test/tagged", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["ETag"], '"7-gzip"')
+        response = self.client.get("/_test/tagged")
+        self.assertEqual(response.headers["ETag"], '"7"')
+
+    def test_small_response_not_compressed(self):
+        """It should not compress responses under the minimum size"""
+        response = self.client.get("/_test/small", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_not_accepted(self):
+        """It should not compress when the client does not accept it"""
+        response = self.client.get("/_test/large")
+        self.assertNotIn("Content-Encoding", response.headers)
+        response = self.client.get("/_test/large", headers={"Accept-Encoding": "gzip;q=0, identity"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_streamed_response(self):
+        """It should compress a streamed response chunk by chunk"""
+        response = self.client.get("/_test/stream", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", response.headers)
+        expected = "".join(f"{n}," for n in range(1000)).encode()
+        self.assertEqual(gzip.decompress(response.data), expected)
+
+    def test_compress_stream_flushes_every_chunk(self):
+        """It should emit decodable output for every chunk"""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = compress_stream(iter([b"first", "second"]), GzipCompressor(6))
+        self.assertEqual(decompressor.decompress(next(chunks)), b"first")
+        self.assertEqual(decompressor.decompress(next(chunks)), b"second")
+
+    def test_compression_disabled(self):
+        """It should leave responses alone when disabled"""
+        self.app.config["COMPRESSION_ENABLED"] = False
+        response = self.client.get("/_test/large", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    @skipUnless(brotli, "brotli is not installed")
+    def test_brotli_response(self):
+        """It should use brotli when the client prefers it"""
+        response = self.client.get("/_test/stream", headers={"Accept-Encoding": "gzip;q=0.5, br"})
+        self.assertEqual(response.headers["Content-Encoding"], "br")
+        self.assertEqual(brotli.decompress(response.data), "".join(f"{n}," for n in range(1000)).encode())
+
+    @skipUnless(zstandard, "zstandard is not installed")
+    def test_zstd_response(self):
+        """It should use zstd when the client accepts it"""
+        response = self.client.get("/_test/large", headers={"Accept-Encoding": "zstd"})
+        self.assertEqual(response.headers["Content-Encoding"], "zstd")
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(response.data)
+        self.assertIn(b"x" * 4096, data)
@@ -0,0 +1,112 @@
+"""
+Product Change Events Test Suite
+"""
+import json
+from unittest import TestCase, skipIf
+from service import app
+from service.common import status
+from service.common.events import broadcaster, format_event
+from service.models import Product, ProductChange, db
+from tests.factories import ProductFactory
+
+BASE_URL = "/products/events"
+
+
+class TestProductEvents(TestCase):
+    """Test Cases for GET /products/events"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Product).delete()
+        db.session.commit()
+        broadcaster.heartbeat = 0.2
+        broadcaster.poll_interval = 0.05
+
+    def tearDown(self):
+        """Runs after each test"""
+        broadcaster.stop()
+        db.session.remove()
+
+    def _create(self) -> Product:
+        product = ProductFactory()
+        product.create()
+        return product
+
+    @staticmethod
+    def _events(stream, count: int) -> list:
+        """Reads chunks until count events are parsed into (id, event, data)"""
+        parsed = []
+        while len(parsed) < count:
+            for block in next(stream).decode().strip().split("\n\n"):
+                if block.startswith(":"):
+                    continue
+                fields = dict(line.split(": ", 1) for line in block.split("\n"))
+                parsed.append((int(fields["id"]), fields["event"], json.loads(fields["data"])))
+        return parsed
+
+    @skipIf(":memory:" in app.config["SQLALCHEMY_DATABASE_URI"], "threads share the in-memory connection")
+    def test_resume_from_last_event_id(self):
+        """It should replay the changes after Last-Event-ID and then push new ones"""
+        start = db.session.query(db.func.max(ProductChange.seq)).scalar() or 0
+        first = self._create()
+        second = self._create()
+        response = self.client.get(BASE_URL, headers={"Last-Event-ID": str(start)}, buffered=False)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        stream = iter(response.response)
+        self.assertTrue(next(stream).startswith(b"retry: "))
+        events = self._events(stream, 2)
+        self.assertEqual([(event[1], event[2]["id"]) for event in events], [("upsert", first.id), ("upsert", second.id)])
+        self.assertEqual(events[1][2]["product"]["name"], second.name)
+
+        second.delete()
+        events = self._events(stream, 1)
+        self.assertEqual([(event[1], event[2]["id"]) for event in events], [("delete", second.id)])
+        self.assertIsNone(events[0][2]["product"])
+        response.close()
+        self.assertEqual(broadcaster.subscribers, 0)
+
+    def test_heartbeat(self):
+        """It should send keep-alive comments to idle subscribers"""
+        response = self.client.get(BASE_URL, buffered=False)
+        stream = iter(response.response)
+        next(stream)
+        self.assertEqual(next(stream), b": keep-alive\n\n")
+        response.close()
+
+    def test_bad_last_event_id(self):
+        """It should not stream from an invalid Last-Event-ID"""
+        response = self.client.get(BASE_URL, headers={"Last-Event-ID": "abc"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_too_many_subscribers(self):
+        """It should refuse subscribers over the limit"""
+        broadcaster.max_subscribers = 0
+        try:
+            response = self.client.get(BASE_URL)
+        finally:
+            broadcaster.max_subscribers = app.config["EVENTS_MAX_SUBSCRIBERS"]
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_streams_bounded_by_threads(self):
+        """It should keep a thread free of streams and give slots back on close"""
+        broadcaster.threads = 2
+        try:
+            first = self.client.get(BASE_URL, buffered=False)
+            self.assertEqual(first.status_code, status.HTTP_200_OK)
+            second = self.client.get(BASE_URL, buffered=False)
+            self.assertEqual(second.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            first.close()
+            third = self.client.get(BASE_URL, buffered=False)
+            self.assertEqual(third.status_code, status.HTTP_200_OK)
+            third.close()
+        finally:
+            broadcaster.threads = None
+        self.assertEqual(broadcaster.subscribers, 0)
+
+    def test_format_event(self):
+        """It should format a change as a Server-Sent Event"""
+        text = format_event({"seq": 7, "op": "delete", "id": 3, "product": None, "changed_at": "now"})
+        self.assertEqual(text, 'id: 7\nevent: delete\ndata: {"id": 3, "product": null, "changed_at": "now"}\n\n')
@@ -0,0 +1,139 @@
+"""
+Idempotency Key Test Suite
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+from service import app
+from service.common import status
+from service.common.idempotency import IdempotencyStore, fingerprint, store
+from service.models import IdempotencyKey, Product, db
+from tests.factories import ProductFactory
+
+BASE_URL = "/products"
+
+
+class TestIdempotency(TestCase):
+    """Test Cases for POST /products with an Idempotency-Key"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Product).delete()
+        db.session.query(IdempotencyKey).delete()
+        db.session.commit()
+        store.clear()
+
+    def tearDown(self):
+        """Runs after each test"""
+        db.session.remove()
+
+    def _post(self, data, key="key-1"):
+        return self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": key})
+
+    def test_replay_creation(self):
+        """It should create a Product once and replay the response"""
+        data = ProductFactory().serialize()
+        first = self._post(data)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        second = self._post(data)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(second.headers["Location"], first.headers["Location"])
+        self.assertEqual(len(Product.all()), 1)
+
+    def test_replay_from_database(self):
+        """It should replay from the table when the memory tier is empty"""
+        data = ProductFactory().serialize()
+        first = self._post(data)
+        store.clear()
+        with patch.object(Product, "create") as create:
+            second = self._post(data)
+            create.assert_not_called()
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(len(Product.all()), 1)
+
+    def test_key_reused_with_other_body(self):
+        """It should reject a key reused for a different request"""
+        self._post(ProductFactory().serialize())
+        response = self._post(ProductFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(len(Product.all()), 1)
+
+    def test_request_in_progress(self):
+        """It should return 409 while another request holds the key"""
+        now = datetime.utcnow()
+        db.session.add(IdempotencyKey(key="key-1", fingerprint="x", created_at=now, expires_at=now + timedelta(days=1)))
+        db.session.commit()
+        response = self._post(ProductFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Product.all(), [])
+
+    def test_take_over_abandoned_claim(self):
+        """It should take over a claim whose request died"""
+        then = datetime.utcnow() - timedelta(hours=1)
+        db.session.add(IdempotencyKey(key="key-1", fingerprint="x", created_at=then, expires_at=then + timedelta(days=1)))
+        db.session.commit()
+        response = self._post(ProductFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(Product.all()), 1)
+
+    def test_failed_request_releases_key(self):
+        """It should not keep the key of a request that failed"""
+        data = ProductFactory().serialize()
+        with patch.object(Product, "create", side_effect=RuntimeError("database down")):
+            self.assertRaises(RuntimeError, store.run, "key-1", data, Product(name="x").create, lambda: ({}, 201, {}))
+        self.assertEqual(IdempotencyKey.query.all(), [])
+        self.assertEqual(self._post(data).status_code, status.HTTP_201_CREATED)
+
+    def test_purge(self):
+        """It should purge expired keys"""
+        then = datetime.utcnow() - timedelta(days=2)
+        db.session.add(IdempotencyKey(key="old", fingerprint="x", created_at=then, expires_at=then + timedelta(days=1)))
+        db.session.commit()
+        self._post(ProductFactory().serialize())
+        self.assertEqual(IdempotencyKey.purge(), 1)
+        self.assertEqual([record.key for record in IdempotencyKey.query.all()], ["key-1"])
+
+
+class TestIdempotencyStore(TestCase):
+    """Test Cases for the in-memory tier"""
+
+    def test_collapse_concurrent_duplicates(self):
+        """It should run concurrent duplicates in a worker only once"""
+        local = IdempotencyStore()
+        calls = []
+        started = threading.Event()
+
+        def run_once(key, request_fingerprint, write, respond):
+            calls.append(key)
+            started.set()
+            time.sleep(0.2)
+            response = ('{"id": 1}', 201, {})
+            local._remember(key, request_fingerprint, response)  # pylint: disable=protected-access
+            return (*response, False)
+
+        results = []
+        with patch.object(local, "_run_once", side_effect=run_once):
+            leader = threading.Thread(target=lambda: results.append(local.run("k", {}, None, None)))
+            leader.start()
+            started.wait()
+            followers = [threading.Thread(target=lambda: results.append(local.run("k", {}, None, None))) for _ in range(3)]
+            for thread in followers:
+                thread.start()
+            for thread in [leader, *followers]:
+                thread.join()
+        self.assertEqual(calls, ["k"])
+        self.assertEqual(sorted(result[3] for result in results), [False, True, True, True])
+
+    def test_lru_bound(self):
+        """It should keep at most size responses"""
+        local = IdempotencyStore()
+        local.size = 2
+        for key in ("a", "b", "c"):
+            local._remember(key, fingerprint({}), ("{}", 201, {}))  # pylint: disable=protected-access
+        self.assertEqual(list(local.cache), ["b", "c"])
@@ -0,0 +1,251 @@
+"""
+Background Jobs Test Suite
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase, skipIf
+from unittest.mock import MagicMock, patch
+from service import app
+from service.common import status
+from service.common.jobs import JobInterrupted, JobProgress, runner
+from service.models import Category, Job, JobOutput, Product, db
+from tests.factories import ProductFactory
+
+BASE_URL = "/jobs"
+
+
+class ImmediateExecutor:
+    """Runs the submitted jobs right away in the calling thread
+
+    The in-memory test database is one connection shared by every thread,
+    so the jobs must not run beside the test.
+    """
+
+    def submit(self, function, *args):
+        function(*args)
+
+    def shutdown(self, wait=True, cancel_futures=False):  # pylint: disable=unused-argument
+        return None
+
+
+class TestJobs(TestCase):
+    """Test Cases for the /jobs endpoints"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Product).delete()
+        db.session.query(Job).delete()
+        db.session.query(JobOutput).delete()
+        db.session.commit()
+        self.executor = patch.object(runner, "_executor", return_value=ImmediateExecutor())
+        self.executor.start()
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.executor.stop()
+        runner.shutdown()
+        runner.max_pending = app.config["JOBS_MAX_PENDING"]
+        runner.kinds.pop("wait", None)
+        db.session.remove()
+
+    def _start(self, kind: str, params: dict = None) -> dict:
+        response = self.client.post(BASE_URL, json={"kind": kind, "params": params or {}})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn(f"{BASE_URL}/{response.get_json()['id']}", response.headers["Location"])
+        return response.get_json()
+
+    def _wait(self, job_id: int) -> dict:
+        """Polls the Job until it has finished"""
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            response = self.client.get(f"{BASE_URL}/{job_id}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            job = response.get_json()
+            if job["finished_at"]:
+                return job
+            time.sleep(0.02)
+        self.fail(f"Job {job_id} did not finish")
+
+    def _create(self, count: int, **kwargs) -> list:
+        products = ProductFactory.create_batch(count, **kwargs)
+        for product in products:
+            product.id = None
+            product.create()
+        return products
+
+    def test_import(self):
+        """It should import Products in the background and report the invalid ones"""
+        rows = [ProductFactory().serialize() for _ in range(3)]
+        rows.insert(1, {"name": "No price"})
+        runner.batch_size = 2
+        try:
+            job = self._start("import", {"products": rows})
+            self.assertEqual(job["status"], Job.QUEUED)
+            job = self._wait(job["id"])
+        finally:
+            runner.batch_size = app.config["JOBS_BATCH_SIZE"]
+        self.assertEqual(job["status"], Job.SUCCEEDED)
+        self.assertEqual(job["progress"], {"done": 4, "total": 4})
+        self.assertEqual(len(job["result"]["created"]), 3)
+        self.assertEqual(list(job["result"]["errors"]), ["1"])
+        self.assertEqual(len(Product.all()), 3)
+
+    def test_export(self):
+        """It should export every Product to the output of the Job"""
+        products = self._create(5)
+        runner.batch_size = 2
+        try:
+            job = self._wait(self._start("export")["id"])
+        finally:
+            runner.batch_size = app.config["JOBS_BATCH_SIZE"]
+        self.assertEqual(job["status"], Job.SUCCEEDED)
+        self.assertEqual(job["result"], {"exported": 5, "pages": 3})
+        self.assertEqual(job["progress"]["done"], 5)
+        response = self.client.get(f"{BASE_URL}/{job['id']}/output")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["id"] for row in response.get_json()], [product.id for product in products])
+
+    def test_export_empty_catalog(self):
+        """It should export an empty catalog as an empty array"""
+        job = self._wait(self._start("export")["id"])
+        self.assertEqual(job["result"], {"exported": 0, "pages": 1})
+        self.assertEqual(self.client.get(f"{BASE_URL}/{job['id']}/output").get_json(), [])
+
+    def test_output_of_unfinished_job(self):
+        """It should not return the output of a Job that has not succeeded"""
+        with patch.object(runner, "_executor", return_value=MagicMock()):
+            job = self._start("export")
+        response = self.client.get(f"{BASE_URL}/{job['id']}/output")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.client.get(f"{BASE_URL}/0/output").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_delete(self):
+        """It should delete the Products of a Category"""
+        self._create(3, category=Category.FOOD)
+        kept = self._create(2, category=Category.TOOLS)
+        job = self._wait(self._start("delete", {"category": "FOOD"})["id"])
+        self.assertEqual(job["status"], Job.SUCCEEDED)
+        self.assertEqual(job["result"], {"deleted": 3})
+        self.assertEqual({product.id for product in Product.all()}, {product.id for product in kept})
+        available = len([product for product in kept if product.available])
+        job = self._wait(self._start("delete", {"available": True})["id"])
+        self.assertEqual(job["result"], {"deleted": available})
+        self.assertEqual(len(Product.all()), 2 - available)
+
+    def test_archive(self):
+        """It should archive the unavailable Products"""
+        self._create(2, available=False)
+        job = self._wait(self._start("archive", {"days": 0})["id"])
+        self.assertEqual(job["status"], Job.SUCCEEDED)
+        self.assertEqual(job["result"], {"archived": 2})
+        self.assertEqual(Product.all(), [])
+
+    def test_failed_job(self):
+        """It should record why a Job failed"""
+        job = self._wait(self._start("delete")["id"])
+        self.assertEqual(job["status"], Job.FAILED)
+        self.assertIn("category or available", job["error"])
+        job = self._wait(self._start("archive", {"days": "soon"})["id"])
+        self.assertEqual(job["status"], Job.FAILED)
+
+    def test_cancel_running_job(self):
+        """It should stop a running Job at its next progress report"""
+        started = []
+
+        @runner.kind("wait")
+        def wait(progress, _params):
+            for done in range(500):
+                started.append(done)
+                if done == 3:
+                    Job.cancel(progress.job_id)
+                progress.report(done)
+            return {}
+
+        job = self._wait(self._start("wait")["id"])
+        self.assertEqual(job["status"], Job.CANCELLED)
+        self.assertTrue(job["cancel_requested"])
+        self.assertEqual(len(started), 4)
+
+    def test_cancel_request(self):
+        """It should ask a running Job to stop"""
+        job = Job.create("export", {}, "elsewhere", 10)
+        Job.start(job.id)
+        response = self.client.delete(f"{BASE_URL}/{job.id}")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.get_json()["status"], Job.RUNNING)
+        self.assertTrue(response.get_json()["cancel_requested"])
+
+    def test_cancel_queued_job(self):
+        """It should cancel a queued Job before it runs"""
+        with patch.object(runner, "_executor", return_value=MagicMock()):
+            job = self._start("export")
+        response = self.client.delete(f"{BASE_URL}/{job['id']}")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.get_json()["status"], Job.CANCELLED)
+        with app.app_context():
+            self.assertIsNone(Job.start(job["id"]))
+
+    def test_too_many_jobs(self):
+        """It should refuse a Job when too many are active in any worker"""
+        runner.max_pending = 1
+        Job.create("export", {}, "another worker", 10)
+        response = self.client.post(BASE_URL, json={"kind": "export"})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "5")
+
+    def test_stale_jobs(self):
+        """It should fail the Jobs of a worker that stopped sending heartbeats"""
+        running = Job.create("export", {}, "dead worker", 10)
+        Job.start(running.id)
+        queued = Job.create("export", {}, "dead worker", 10)
+        fresh = Job.create("export", {}, "live worker", 10)
+        stale = datetime.utcnow() - timedelta(seconds=runner.stale_seconds + 1)
+        db.session.query(Job).filter(Job.owner == "dead worker").update({"heartbeat_at": stale})
+        db.session.commit()
+        job = self.client.get(f"{BASE_URL}/{running.id}").get_json()
+        self.assertEqual(job["status"], Job.FAILED)
+        self.assertIn("stopped", job["error"])
+        self.assertEqual(Job.find(queued.id).status, Job.FAILED)
+        self.assertEqual(Job.find(fresh.id).status, Job.QUEUED)
+        # a late report from the stopped worker must not revive the Job
+        self.assertTrue(Job.report(running.id, 1))
+        Job.finish(running.id, Job.SUCCEEDED, {})
+        self.assertEqual(Job.find(running.id).status, Job.FAILED)
+
+    def test_shutdown(self):
+        """It should interrupt running Jobs and fail the others of the worker"""
+        stopping = threading.Event()
+        stopping.set()
+        self.assertRaises(JobInterrupted, JobProgress(0, stopping).report, 1)
+        mine = Job.create("export", {}, runner.owner(), 10)
+        other = Job.create("export", {}, "another worker", 10)
+        runner.executor, runner.pid = MagicMock(), os.getpid()
+        runner.shutdown()
+        self.assertTrue(runner.executor is None and not runner.stopping.is_set())
+        self.assertEqual(Job.find(mine.id).status, Job.FAILED)
+        self.assertEqual(Job.find(other.id).status, Job.QUEUED)
+
+    @skipIf(":memory:" in app.config["SQLALCHEMY_DATABASE_URI"], "threads share the in-memory connection")
+    def test_thread_pool(self):
+        """It should run the Jobs in the pool threads"""
+        self.executor.stop()
+        try:
+            self._create(3)
+            job = self._wait(self._start("export")["id"])
+            self.assertEqual(job["result"]["exported"], 3)
+        finally:
+            self.executor.start()
+
+    def test_bad_requests(self):
+        """It should refuse unknown kinds, bad params and missing Jobs"""
+        response = self.client.post(BASE_URL, json={"kind": "unknown"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(BASE_URL, json={"kind": "export", "params": []})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(BASE_URL, data="{}")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        self.assertEqual(self.client.get(f"{BASE_URL}/0").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.delete(f"{BASE_URL}/0").status_code, status.HTTP_404_NOT_FOUND)
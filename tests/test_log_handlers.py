@@ -0,0 +1,120 @@
+"""
+Log Handlers Test Suite
+"""
+import io
+import json
+import logging
+import threading
+from unittest import TestCase
+from flask import Flask
+from service import config
+from service.common import log_handlers
+
+
+class TestLogHandlers(TestCase):
+    """Test Cases for queued logging"""
+
+    def setUp(self):
+        """Creates an app with a fake gunicorn logger"""
+        self.stream = io.StringIO()
+        self.gunicorn_logger = logging.getLogger("test.gunicorn")
+        self.gunicorn_logger.handlers = [logging.StreamHandler(self.stream)]
+        self.gunicorn_logger.setLevel(logging.INFO)
+        self.app = Flask("logging_test")
+        self.app.config.from_object(config)
+
+    def tearDown(self):
+        """Stops the listener and detaches the model logger"""
+        log_handlers.stop_listener()
+        model_logger = logging.getLogger("flask.app")
+        model_logger.handlers = []
+        model_logger.propagate = True
+
+    def _lines(self) -> list:
+        """Flushes the queue and returns the written lines"""
+        log_handlers.stop_listener()
+        return self.stream.getvalue().splitlines()
+
+    def test_queued_logging(self):
+        """It should write records from the listener thread"""
+        threads = []
+
+        class ThreadRecorder(logging.Handler):
+            """Records the thread that emits"""
+
+            def emit(self, record):
+                threads.append(threading.current_thread())
+
+        self.gunicorn_logger.addHandler(ThreadRecorder())
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        self.assertIsInstance(self.app.logger.handlers[0], log_handlers.DeferredQueueHandler)
+        self.app.logger.info("Hello %s", "world")
+        logging.getLogger("flask.app").info("From the models")
+        lines = self._lines()
+        self.assertIn("Hello world", lines[-2])
+        self.assertIn("From the models", lines[-1])
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_json_format(self):
+        """It should write one JSON object per record"""
+        self.app.config["LOG_FORMAT"] = "json"
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        self.app.logger.warning("Payload %s", {"name": "x" * 10000})
+        entry = json.loads(self._lines()[-1])
+        self.assertEqual(entry["level"], "WARNING")
+        self.assertEqual(entry["logger"], "logging_test")
+        self.assertLess(len(entry["message"]), 1000)
+
+    def test_sampling(self):
+        """It should keep a fraction of INFO records but every warning"""
+        self.app.config["LOG_SAMPLE_RATES"] = {"logging_test": 0.25}
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        for number in range(8):
+            self.app.logger.info("info %d", number)
+        self.app.logger.warning("warning")
+        lines = self._lines()
+        self.assertEqual(len([line for line in lines if "info" in line]), 2)
+        self.assertIn("warning", lines[-1])
+
+    def test_merged_in_caller(self):
+        """It should merge the arguments before the caller can change them"""
+        self.app.config["LOG_MAX_PAYLOAD"] = 20
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        payload = {"name": "before"}
+        self.app.logger.info("Payload %s", payload)
+        payload["name"] = "after"
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            self.app.logger.exception("Failed on %s", "y" * 100)
+        lines = self._lines()
+        failed = next(index for index, line in enumerate(lines) if "Failed on" in line)
+        self.assertIn("'before'", lines[failed - 1])
+        self.assertIn("Failed on " + "y" * 20 + "...", lines[failed])
+        self.assertNotIn("y" * 21, lines[failed])
+        self.assertEqual(lines[failed + 1], "Traceback (most recent call last):")
+        self.assertEqual(lines[-1], "ValueError: boom")
+
+    def test_filters_not_stacked(self):
+        """It should replace the sampling filter when logging is set up again"""
+        for _ in range(3):
+            log_handlers.init_logging(self.app, "test.gunicorn")
+        filters = self.app.logger.handlers[0].filters
+        self.assertEqual(len([item for item in filters if isinstance(item, log_handlers.SamplingFilter)]), 1)
+
+    def test_restart_listener(self):
+        """It should keep the same queue handler when restarted"""
+        log_handlers.init_logging(self.app, "test.gunicorn")
+        handler = self.app.logger.handlers[0]
+        self.assertIs(log_handlers.start_listener(), handler)
+        self.app.logger.info("after restart")
+        self.assertIn("after restart", self._lines()[-1])
+
+    def test_truncate_payload(self):
+        """It should truncate large arguments"""
+        formatter = log_handlers.PayloadFormatter("%(message)s", max_payload=20)
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "%s %s %d", ("y" * 100, [1] * 100, 7), None)
+        message = formatter.format(record)
+        self.assertTrue(message.startswith("y" * 20 + "..."))
+        self.assertTrue(message.endswith(" 7"))
+        self.assertLess(len(message), 60)
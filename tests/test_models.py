@@ -4,8 +4,14 @@
 from service import app
 import unittest
 import logging
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
 from decimal import Decimal
-from service.models import Product, Category, db
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from service.models import (
+    Price, Product, Category, CategorySummary, DataValidationError, ProductArchive, ProductChange, db, product_schema
+)
 from tests.factories import ProductFactory
 
 app.config["TESTING"] = True
@@ -124,6 +130,102 @@ class TestProductModel(unittest.TestCase):
         product.delete()
         self.assertEqual(len(Product.all()), 0)
 
+    def test_change_log(self):
+        """It should log every change in the same transaction"""
+        start = max([change.seq for change in ProductChange.query.all()], default=0)
+        product = ProductFactory()
+        product.id = None
+        product.create()
+        product.description = "Changed"
+        product.update()
+        Product.patch(product.id, {"available": False})
+        product_id = product.id
+        product.delete()
+        changes = ProductChange.since(start, 10)
+        self.assertEqual([change.product_id for change in changes], [product_id] * 4)
+        self.assertEqual([change.deleted for change in changes], [False, False, False, True])
+        self.assertEqual(changes[1].serialize()["product"]["description"], "Changed")
+        self.assertFalse(changes[2].serialize()["product"]["available"])
+        self.assertEqual(changes[3].serialize()["op"], "delete")
+        self.assertIsNone(changes[3].serialize()["product"])
+        self.assertEqual(len(ProductChange.since(start, 2)), 2)
+        self.assertEqual(ProductChange.since(changes[-1].seq, 10), [])
+
+    def test_change_log_horizon(self):
+        """It should hold back the changes from the first one stamped after the horizon"""
+        start = ProductChange.latest()
+        for _ in range(3):
+            product = ProductFactory()
+            product.id = None
+            product.create()
+        changes = ProductChange.since(start, 10)
+        horizon = datetime.utcnow()
+        changes[1].changed_at = horizon + timedelta(seconds=1)
+        db.session.commit()
+        with patch.object(ProductChange, "horizon", return_value=horizon):
+            self.assertEqual(ProductChange.latest(), changes[0].seq)
+            self.assertEqual([change.seq for change in ProductChange.since(start, 10)], [changes[0].seq])
+        self.assertEqual(ProductChange.latest(), changes[2].seq)
+
+    def test_purge_change_log(self):
+        """It should delete the changes past their retention but the latest"""
+        products = ProductFactory.create_batch(3)
+        for product in products:
+            product.id = None
+            product.create()
+        latest = ProductChange.latest()
+        ProductChange.query.update({"changed_at": datetime.utcnow() - timedelta(days=10)})
+        db.session.commit()
+        fresh = ProductFactory()
+        fresh.id = None
+        fresh.create()
+        self.assertEqual(ProductChange.purge(timedelta(days=20), 1), 0)
+        ProductChange.purge(timedelta(days=5), 2)
+        self.assertEqual([change.seq for change in ProductChange.since(0, 10)], [ProductChange.latest()])
+        ProductChange.query.update({"changed_at": datetime.utcnow() - timedelta(days=10)})
+        db.session.commit()
+        self.assertEqual(ProductChange.purge(timedelta(days=5), 10), 0)
+        self.assertGreater(ProductChange.latest(), latest)
+
+    def test_find_many(self):
+        """It should find many Products in the requested order"""
+        products = ProductFactory.create_batch(3)
+        for product in products:
+            product.id = None
+            product.create()
+        ids = [products[2].id, 0, products[0].id, products[2].id]
+        db.session.remove()
+        found = Product.find_many(ids)
+        self.assertEqual([product.id if product else None for product in found], [ids[0], None, ids[2], ids[0]])
+        self.assertIs(found[0], found[3])
+        # loaded Products are taken from the session
+        self.assertIs(Product.find_many([ids[2]])[0], found[2])
+        self.assertEqual(Product.find_many([]), [])
+
+    def test_count(self):
+        """It should count the Products that match the filters"""
+        products = ProductFactory.create_batch(5)
+        for product in products:
+            product.id = None
+            product.create()
+        self.assertEqual(Product.count(), 5)
+        available = len([product for product in products if product.available])
+        self.assertEqual(Product.count(available=True), available)
+        self.assertEqual(Product.count(category=products[0].category, estimate=True), Product.count(
+            category=products[0].category
+        ))
+        self.assertEqual(Product.count(name=products[0].name, available=not products[0].available), 0)
+
+    def test_estimate(self):
+        """It should take the planner's row estimate on PostgreSQL"""
+        engine = MagicMock(dialect=postgresql.dialect())
+        connection = engine.connect.return_value.__enter__.return_value
+        connection.execute.return_value.scalar.return_value = [{"Plan": {"Plan Rows": 1234}}]
+        self.assertEqual(Product.estimate(engine, [Product.category == Category.FOOD]), 1234)
+        explain = str(connection.execute.call_args[0][0])
+        self.assertTrue(explain.startswith("EXPLAIN (FORMAT JSON) SELECT product.id"))
+        self.assertIn("WHERE product.category = 'FOOD'", explain)
+
     def test_list_all_products(self):
         """It should list all products"""
         products = Product.all()
@@ -147,7 +249,7 @@ class TestProductModel(unittest.TestCase):
             products.append(p)
 
         name_to_find = products[0].name
-        found = Product.find_by_name(name_to_find).all()  # <-- .all() added
+        found = Product.find_by_name(name_to_find)
         count = sum(1 for p in products if p.name == name_to_find)
         self.assertEqual(len(found), count)
         for p in found:
@@ -163,7 +265,7 @@ class TestProductModel(unittest.TestCase):
             products.append(p)
 
         avail = products[0].available
-        found = Product.find_by_availability(avail).all()  # <-- .all() added
+        found = Product.find_by_availability(avail)
         count = sum(1 for p in products if p.available == avail)
         self.assertEqual(len(found), count)
         for p in found:
@@ -179,8 +281,420 @@ class TestProductModel(unittest.TestCase):
             products.append(p)
 
         cat = products[0].category
-        found = Product.find_by_category(cat).all()  # <-- .all() added
+        found = Product.find_by_category(cat)
         count = sum(1 for p in products if p.category == cat)
         self.assertEqual(len(found), count)
         for p in found:
-            self.assertEqual(p.category, cat)
\ No newline at end of file
+            self.assertEqual(p.category, cat)
+
+
+######################################################################
+#  P R O D U C T   S C H E M A   T E S T   C A S E S
+######################################################################
+class TestProductSchema(unittest.TestCase):
+    """Test Cases for the compiled Product validator"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        Product.init_db(app)
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(Product).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_deserialize_a_product(self):
+        """It should deserialize a valid payload"""
+        data = ProductFactory().serialize()
+        product = Product().deserialize(data)
+        self.assertEqual(product.name, data["name"])
+        self.assertEqual(product.price, Decimal(data["price"]))
+        self.assertEqual(product.category.name, data["category"])
+
+    def test_deserialize_errors(self):
+        """It should keep the single item error messages"""
+        data = ProductFactory().serialize()
+        del data["name"]
+        self.assertRaisesRegex(DataValidationError, "missing name", Product().deserialize, data)
+        data = ProductFactory().serialize()
+        data["available"] = "yes"
+        self.assertRaisesRegex(DataValidationError, "boolean", Product().deserialize, data)
+        data = ProductFactory().serialize()
+        data["category"] = "PETS"
+        self.assertRaisesRegex(DataValidationError, "Invalid attribute: PETS", Product().deserialize, data)
+        data["category"] = 3
+        self.assertRaisesRegex(DataValidationError, "bad or no data", Product().deserialize, data)
+        data = ProductFactory().serialize()
+        data["price"] = "cheap"
+        self.assertRaises(DataValidationError, Product().deserialize, data)
+        self.assertRaises(DataValidationError, Product().deserialize, None)
+
+    def test_validate_many(self):
+        """It should collect every error for every row"""
+        good = ProductFactory().serialize()
+        bad = {"name": "Hat", "price": None, "available": "no", "category": "PETS"}
+        valid, errors = product_schema.validate_many([good, bad, "junk"])
+        self.assertEqual([index for index, _ in valid], [0])
+        self.assertEqual(len(errors[1]), 4)
+        self.assertEqual(len(errors[2]), 1)
+
+    def test_bulk_create(self):
+        """It should insert only the valid rows of a batch"""
+        rows = [ProductFactory().serialize() for _ in range(3)]
+        rows[1]["category"] = "PETS"
+        products, errors = Product.bulk_create(rows)
+        self.assertEqual(len(products), 2)
+        self.assertEqual(list(errors), [1])
+        self.assertTrue(all(product.id for product in products))
+        self.assertEqual(len(Product.all()), 2)
+
+    def test_bad_strings(self):
+        """It should report names and descriptions that do not fit their columns per row"""
+        rows = [ProductFactory().serialize() for _ in range(4)]
+        rows[1]["name"] = None
+        rows[2]["description"] = ["a", "list"]
+        rows[3]["name"] = "x" * 101
+        products, errors = Product.bulk_create(rows)
+        self.assertEqual(len(products), 1)
+        self.assertEqual(sorted(errors), [1, 2, 3])
+        self.assertIn("[name]", errors[1][0])
+        self.assertIn("[description]", errors[2][0])
+        self.assertIn("longer than 100", errors[3][0])
+        self.assertEqual(len(Product.all()), 1)
+        data = ProductFactory().serialize()
+        data["name"] = None
+        self.assertRaisesRegex(DataValidationError, "string", Product().deserialize, data)
+
+
+######################################################################
+#  C A T E G O R Y   S T A T I S T I C S   T E S T   C A S E S
+######################################################################
+class TestCategoryStatistics(unittest.TestCase):
+    """Test Cases for the category statistics"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        Product.init_db(app)
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(Product).delete()
+        db.session.query(CategorySummary).delete()
+        db.session.commit()
+        CategorySummary.enabled = False
+
+    def tearDown(self):
+        """This runs after each test"""
+        CategorySummary.enabled = False
+        db.session.remove()
+
+    def _create(self, category, price, available=True):
+        product = ProductFactory(category=category, price=Decimal(price), available=available)
+        product.create()
+        return product
+
+    def test_statistics_by_aggregate(self):
+        """It should aggregate statistics by category"""
+        self._create(Category.FOOD, "2.00")
+        self._create(Category.FOOD, "4.00", available=False)
+        self._create(Category.TOOLS, "10.00")
+        stats = Product.statistics()
+        self.assertEqual([row["category"] for row in stats], ["FOOD", "TOOLS"])
+        food = stats[0]
+        self.assertEqual(food["count"], 2)
+        self.assertEqual(food["available"], 1)
+        self.assertEqual(food["availability_ratio"], 0.5)
+        self.assertEqual(Decimal(food["price"]["min"]), Decimal("2.00"))
+        self.assertEqual(Decimal(food["price"]["avg"]), Decimal("3.00"))
+        self.assertEqual(Decimal(food["price"]["max"]), Decimal("4.00"))
+
+    def test_statistics_by_summary(self):
+        """It should maintain the summary table on every write"""
+        CategorySummary.enabled = True
+        cheap = self._create(Category.FOOD, "2.00")
+        dear = self._create(Category.FOOD, "4.00", available=False)
+        self._create(Category.TOOLS, "10.00")
+        Product.bulk_create([ProductFactory(category=Category.TOOLS, price=Decimal("1.00")).serialize()])
+        self.assertEqual(Product.statistics(), self._aggregate())
+
+        dear.price = Decimal("8.00")
+        dear.category = Category.TOOLS
+        dear.update()
+        self.assertEqual(Product.statistics(), self._aggregate())
+
+        cheap.delete()
+        self.assertEqual(Product.statistics(), self._aggregate())
+        self.assertEqual([row["category"] for row in Product.statistics()], ["TOOLS"])
+
+    def test_patch_keeps_summary(self):
+        """It should maintain the summary when patching"""
+        CategorySummary.enabled = True
+        product = self._create(Category.FOOD, "2.00")
+        self._create(Category.FOOD, "6.00")
+        patched = Product.patch(product.id, {"category": "TOOLS", "price": "3.00"})
+        self.assertEqual(patched.category, Category.TOOLS)
+        self.assertEqual(patched.version, 2)
+        self.assertEqual(Product.statistics(), self._aggregate())
+        self.assertIsNone(Product.patch(product.id, {"price": "4.00"}, versions={1}))
+        self.assertEqual(Product.find(product.id).price, Decimal("3.00"))
+
+    def test_summary_row_added_elsewhere(self):
+        """It should add to the row of a category that another transaction created"""
+        CategorySummary.enabled = True
+        db.session.execute(CategorySummary.__table__.insert().values(
+            category=Category.FOOD, count=1, available_count=1, price_total=Decimal("5.00")
+        ))
+        self._create(Category.FOOD, "2.00")
+        summary = db.session.get(CategorySummary, Category.FOOD)
+        self.assertEqual((summary.count, summary.available_count, summary.price_total), (2, 2, Decimal("7.00")))
+
+    def test_rebuild_summary(self):
+        """It should rebuild the summary from the products table"""
+        self._create(Category.FOOD, "2.00")
+        self._create(Category.CLOTHS, "3.50")
+        CategorySummary.enabled = True
+        CategorySummary.rebuild()
+        self.assertEqual(len(CategorySummary.query.all()), 2)
+        self.assertEqual(Product.statistics(), self._aggregate())
+
+    def _aggregate(self):
+        """Returns the statistics computed without the summary"""
+        CategorySummary.enabled = False
+        stats = Product.statistics()
+        CategorySummary.enabled = True
+        return stats
+
+
+class TestArchival(unittest.TestCase):
+    """Test Cases for archiving Products"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        Product.init_db(app)
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(Product).delete()
+        db.session.query(ProductArchive).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        ProductArchive.soft_delete = False
+        db.session.remove()
+
+    def _create(self, available, days_ago=0):
+        product = ProductFactory(available=available)
+        product.id = None
+        product.create()
+        if days_ago:
+            product.unavailable_since = datetime.utcnow() - timedelta(days=days_ago)
+            product.update()
+        return product
+
+    def test_unavailable_since(self):
+        """It should stamp when a Product became unavailable"""
+        product = self._create(available=False)
+        since = product.unavailable_since
+        self.assertIsNotNone(since)
+        product.description = "Still unavailable"
+        product.update()
+        self.assertEqual(product.unavailable_since, since)
+        product.available = True
+        product.update()
+        self.assertIsNone(product.unavailable_since)
+        self.assertIsNotNone(Product.patch(product.id, {"available": False}).unavailable_since)
+        self.assertIsNone(Product.patch(product.id, {"available": True}).unavailable_since)
+
+    def test_archive_unavailable(self):
+        """It should move the long unavailable Products to the archive in batches"""
+        old = [self._create(available=False, days_ago=40) for _ in range(3)]
+        recent = self._create(available=False, days_ago=10)
+        available = self._create(available=True)
+        old_ids = [product.id for product in old]
+        start = ProductChange.latest()
+
+        self.assertEqual(ProductArchive.archive_unavailable(timedelta(days=30), batch_size=2), 3)
+        self.assertEqual({product.id for product in Product.all()}, {recent.id, available.id})
+        for product_id in old_ids:
+            self.assertIsNone(Product.find(product_id))
+            found = Product.find(product_id, archived=True)
+            self.assertEqual(found.id, product_id)
+            self.assertFalse(found.available)
+        self.assertIsNone(Product.find(0, archived=True))
+        changes = ProductChange.since(start, 10)
+        self.assertEqual(sorted(change.product_id for change in changes), sorted(old_ids))
+        self.assertTrue(all(change.deleted for change in changes))
+        self.assertEqual(ProductArchive.archive_unavailable(timedelta(days=30)), 0)
+
+    def test_archive_unstamped(self):
+        """It should start the wait of Products unavailable before unavailable_since existed"""
+        products = [self._create(available=False) for _ in range(3)]
+        ids = [product.id for product in products]
+        db.session.execute(Product.__table__.update().values(unavailable_since=None))
+        db.session.commit()
+        self.assertEqual(ProductArchive.archive_unavailable(timedelta(days=30), batch_size=2), 0)
+        db.session.remove()
+        self.assertTrue(all(Product.find(product_id).unavailable_since for product_id in ids))
+        self.assertEqual(ProductArchive.archive_unavailable(timedelta(0), batch_size=2), 3)
+
+    def test_soft_delete(self):
+        """It should archive deleted Products when soft deletion is on"""
+        product = self._create(available=True)
+        product_id, name = product.id, product.name
+        ProductArchive.soft_delete = True
+        product.delete()
+        self.assertIsNone(Product.find(product_id))
+        entry = db.session.get(ProductArchive, product_id)
+        self.assertTrue(entry.deleted)
+        self.assertEqual(str(entry), f"<ProductArchive {name} id=[{product_id}]>")
+        self.assertEqual(Product.find(product_id, archived=True).name, name)
+
+    def test_hard_delete(self):
+        """It should drop deleted Products when soft deletion is off"""
+        product = self._create(available=True)
+        product_id = product.id
+        product.delete()
+        self.assertIsNone(Product.find(product_id, archived=True))
+
+
+class TestPriceStorage(unittest.TestCase):
+    """Test Cases for storing prices as integer minor units"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        Product.init_db(app)
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(Product).delete()
+        db.session.commit()
+        self.digits = Price.digits
+        Price.digits = 2
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.query(Product).delete()
+        db.session.commit()
+        Price.digits = self.digits
+        db.session.remove()
+
+    def _create(self, price: str, category: Category = Category.FOOD) -> Product:
+        product = ProductFactory(price=Decimal(price), category=category)
+        product.id = None
+        product.create()
+        return product
+
+    def test_round_trip(self):
+        """It should store minor units and read the same Decimal back"""
+        product = self._create("12.50")
+        stored = db.session.execute(text("SELECT price FROM product WHERE id = :id"), {"id": product.id}).scalar()
+        self.assertEqual(int(stored), 1250)
+        db.session.remove()
+        found = Product.find(product.id)
+        self.assertEqual(found.price, Decimal("12.50"))
+        self.assertEqual(found.serialize()["price"], "12.50")
+        self.assertEqual(Product.patch(product.id, {"price": "0.05"}).price, Decimal("0.05"))
+
+    def test_same_json_both_ways(self):
+        """It should serialize a price the same whether it is stored as NUMERIC or minor units"""
+        product_id = self._create("12").id
+        db.session.remove()
+        self.assertEqual(Product.find(product_id).serialize()["price"], "12.00")
+        # as NUMERIC gives them back: written scale, driver scale, minor units
+        for stored in ("12", "12.0000000000", "12.00"):
+            self.assertEqual(ProductFactory.build(price=Decimal(stored)).serialize()["price"], "12.00")
+        self.assertEqual(Price.text(Decimal("12.5")), "12.50")
+        self.assertEqual(Price.text(Decimal("100")), "100.00")
+        self.assertEqual(Price.text(Decimal("1.2345000")), "1.2345")
+
+    def test_find_by_price(self):
+        """It should compare prices as minor units"""
+        product = self._create("7.25")
+        self.assertEqual([found.id for found in Product.find_by_price("7.25")], [product.id])
+        self.assertEqual([found.id for found in Product.find_by_price(7.25)], [product.id])
+        self.assertEqual(list(Product.find_by_price("7.255")), [])
+
+    def test_aggregates(self):
+        """It should aggregate minor units back into prices"""
+        self._create("2.00")
+        self._create("4.50")
+        food = Product.statistics()[0]
+        self.assertEqual(food["price"], {"min": "2.00", "avg": "3.25", "max": "4.50"})
+        CategorySummary.enabled = True
+        try:
+            CategorySummary.rebuild()
+            self._create("1.25").delete()
+            self.assertEqual(Product.statistics()[0]["price"], {"min": "2.00", "avg": "3.25", "max": "4.50"})
+        finally:
+            CategorySummary.enabled = False
+            db.session.query(CategorySummary).delete()
+            db.session.commit()
+
+    def test_inexact_price(self):
+        """It should refuse a price with more decimal places than the minor unit"""
+        values, errors = product_schema.validate_partial({"price": "1.234"})
+        self.assertEqual(values, {})
+        self.assertIn("more than 2 decimal places", errors[0])
+        self.assertTrue(Price.exact(Decimal("1.2")))
+        Price.digits = None
+        self.assertTrue(Price.exact(Decimal("1.234")))
+
+    def test_price_storage_ddl(self):
+        """It should convert the price columns both ways"""
+        statements = Product.price_storage_ddl(True, 2)
+        self.assertEqual(len(statements), len(Product.PRICE_COLUMNS))
+        self.assertEqual(statements[0], "ALTER TABLE product ALTER COLUMN price TYPE BIGINT USING round(price * 100)::bigint")
+        self.assertIn(
+            "ALTER TABLE category_summary ALTER COLUMN price_min TYPE BIGINT USING round(price_min * 100)::bigint",
+            statements,
+        )
+        self.assertEqual(
+            Product.price_storage_ddl(False, 3, [("product", "price")]),
+            ["ALTER TABLE product ALTER COLUMN price TYPE NUMERIC USING round(price::numeric / 1000, 3)"],
+        )
+        # SQLite has no column type to check
+        Product.check_price_storage([db.engine])
+
+
+class TestPartitioning(unittest.TestCase):
+    """Test Cases for partitioning the products table by Category"""
+
+    def test_partition_ddl(self):
+        """It should migrate the table into one partition per Category"""
+        statements = Product.partition_ddl(False, set())
+        self.assertTrue(statements[1].startswith("CREATE TABLE product_partitioned (LIKE product"))
+        self.assertIn("PARTITION BY LIST (category)", statements[1])
+        for category in Category:
+            self.assertIn(
+                f"CREATE TABLE product_{category.name.lower()} PARTITION OF product_partitioned "
+                f"FOR VALUES IN ('{category.name}')",
+                statements,
+            )
+        self.assertIn("CREATE INDEX ix_product_partitioned_name ON product_partitioned (name)", statements)
+        self.assertIn("ALTER TABLE product_partitioned RENAME TO product", statements)
+        self.assertEqual(statements[-1], "ALTER INDEX ix_product_partitioned_unavailable_since "
+                                         "RENAME TO ix_product_unavailable_since")
+
+    def test_partition_ddl_index_names(self):
+        """It should not create indexes named like those of the old table"""
+        statements = Product.partition_ddl(False, set())
+        created = {statement.split()[2] for statement in statements if statement.startswith("CREATE INDEX")}
+        self.assertEqual(len(created), len(Product.PARTITION_INDEXES))
+        self.assertFalse(created & {index.name for index in Product.__table__.indexes})
+
+    def test_partition_ddl_new_categories(self):
+        """It should only add the missing partitions of a partitioned table"""
+        existing = {f"product_{category.name.lower()}" for category in Category if category != Category.TOOLS}
+        self.assertEqual(
+            Product.partition_ddl(True, existing),
+            ["CREATE TABLE product_tools PARTITION OF product FOR VALUES IN ('TOOLS')"],
+        )
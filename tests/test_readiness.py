@@ -0,0 +1,102 @@
+"""
+Readiness Probe Test Suite
+"""
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import create_engine
+from service import app
+from service.common import status
+from service.common.readiness import probe
+from service.common.sharding import shard_set
+
+
+class TestReadiness(TestCase):
+    """Test Cases for GET /ready"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        probe.init_app(app)
+
+    def tearDown(self):
+        """Runs after each test"""
+        probe.stop()
+        probe.init_app(app)
+
+    def test_ready(self):
+        """It should be ready once the background probe has reached the database"""
+        deadline = time.monotonic() + 5
+        response = self.client.get("/ready")
+        while response.status_code != status.HTTP_200_OK and time.monotonic() < deadline:
+            time.sleep(0.02)
+            response = self.client.get("/ready")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["status"], "ready")
+        self.assertTrue(data["database"]["ok"])
+        self.assertIsNone(data["database"]["error"])
+        self.assertFalse(data["warming_up"])
+        self.assertTrue(probe.thread.is_alive())
+
+    def test_warming_up(self):
+        """It should be unready before the first probe and during the warm-up"""
+        ready, report = probe.report()
+        self.assertFalse(ready)
+        self.assertEqual(report["status"], "warming_up")
+        probe.warmup = 60
+        probe.probe()
+        ready, report = probe.report()
+        self.assertFalse(ready)
+        self.assertTrue(report["database"]["ok"])
+        self.assertEqual(report["status"], "warming_up")
+
+    def test_warm_up_after_fork(self):
+        """It should warm up again in a worker forked after the master started"""
+        probe.warmup = 60
+        probe.started -= 120
+        probe.probe()
+        self.assertTrue(probe.report()[0])
+        probe.after_fork()
+        ready, report = probe.report()
+        self.assertFalse(ready)
+        self.assertIsNone(report["database"]["checked_at"])
+        probe.probe()
+        self.assertEqual(probe.report()[1]["status"], "warming_up")
+
+    def test_database_down(self):
+        """It should be unready when a database cannot be reached"""
+        broken = create_engine("sqlite:////nonexistent/folder/shard.db")
+        with patch.object(shard_set, "engines", [broken]):
+            probe.probe()
+        ready, report = probe.report()
+        self.assertFalse(ready)
+        self.assertEqual(report["status"], "unready")
+        self.assertFalse(report["database"]["ok"])
+        self.assertIn("unable to open database file", report["database"]["error"])
+        broken.dispose()
+
+    def test_stale_probe(self):
+        """It should be unready when the probe has not finished for a while"""
+        probe.probe()
+        self.assertTrue(probe.report()[0])
+        ok, latency, error, checked, checked_at = probe.result
+        probe.result = (ok, latency, error, checked - 4 * probe.interval, checked_at)
+        ready, report = probe.report()
+        self.assertFalse(ready)
+        self.assertEqual(report["database"]["error"], "probe is stale")
+
+    def test_overloaded(self):
+        """It should be unready when the pool or the in-flight requests are near their limits"""
+        probe.probe()
+        with patch("service.common.readiness.pool_saturation", return_value=0.9):
+            ready, report = probe.report()
+        self.assertFalse(ready)
+        self.assertEqual(report["status"], "overloaded")
+        self.assertEqual(report["pool_saturation"], 0.9)
+        limiter = app.extensions["admission"]
+        with patch.object(limiter, "limit", 10), patch.object(limiter, "inflight", 8):
+            response = self.client.get("/ready")
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.get_json()["inflight_ratio"], 0.8)
+        self.assertIn("Retry-After", response.headers)
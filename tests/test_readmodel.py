@@ -0,0 +1,148 @@
+"""
+In-Memory Read Model Test Suite
+"""
+import time
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from service import app
+from service.common import status
+from service.common.readmodel import ReadModel, catalog
+from service.models import Category, Product, ProductChange, db
+from tests.factories import ProductFactory
+
+BASE_URL = "/products"
+
+
+class TestReadModel(TestCase):
+    """Test Cases for the in-memory read model"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Product).delete()
+        db.session.commit()
+        app.config["READ_MODEL_ENABLED"] = True
+        # the tests refresh in their own thread, the in-memory database is one connection
+        self.start = patch.object(ReadModel, "start")
+        self.start.start()
+        catalog.init_app(app)
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.start.stop()
+        app.config["READ_MODEL_ENABLED"] = False
+        ProductChange.listeners.remove(catalog.mark)
+        catalog.init_app(app)
+        db.session.remove()
+
+    def _create(self, **kwargs) -> Product:
+        product = ProductFactory(**kwargs)
+        product.create()
+        return product
+
+    def _ids(self, rows) -> list:
+        return [row["id"] for row in rows]
+
+    def _search(self, **filters) -> list:
+        """Refreshes the read model like its thread does and searches it"""
+        catalog.refresh()
+        return catalog.search(**filters)
+
+    def test_search_matches_database(self):
+        """It should filter like the database finders"""
+        products = [self._create() for _ in range(10)]
+        target = products[3]
+        self.assertEqual(self._ids(self._search()), [product.id for product in products])
+        self.assertEqual(
+            self._ids(catalog.search(name=target.name)),
+            [product.id for product in Product.find_by_name(target.name)],
+        )
+        for category in Category:
+            self.assertEqual(
+                self._ids(catalog.search(category=category)),
+                [product.id for product in Product.find_by_category(category)],
+            )
+        for available in (True, False):
+            self.assertEqual(
+                self._ids(catalog.search(available=available)),
+                [product.id for product in Product.find_by_availability(available)],
+            )
+        self.assertEqual(catalog.search(category=target.category, available=target.available, name="missing"), [])
+
+    def test_apply_writes(self):
+        """It should apply the writes of this worker once it has refreshed"""
+        product = self._create(available=True, category=Category.FOOD)
+        self.assertIsNone(catalog.search(category=Category.FOOD))
+        self.assertEqual(self._search(category=Category.FOOD)[0]["name"], product.name)
+        product.category = Category.TOOLS
+        product.update()
+        self.assertEqual(self._search(category=Category.FOOD), [])
+        self.assertEqual(self._ids(catalog.search(category=Category.TOOLS)), [product.id])
+        Product.patch(product.id, {"available": False, "price": "12.50"})
+        self.assertEqual(self._search(available=True), [])
+        self.assertEqual(catalog.search(available=False)[0]["price"], "12.50")
+        product.delete()
+        self.assertEqual(self._search(), [])
+        self.assertEqual(catalog.by_category, {})
+
+    def test_catch_up_with_other_workers(self):
+        """It should apply the changes of other workers when it refreshes"""
+        ProductChange.listeners.remove(catalog.mark)
+        try:
+            product = self._create()
+        finally:
+            ProductChange.listeners.append(catalog.mark)
+        self.assertEqual(catalog.search(), [])
+        self.assertEqual(self._ids(self._search()), [product.id])
+
+    def test_deletes_leave_nothing_behind(self):
+        """It should drop a deleted Product from every index"""
+        products = [self._create(category=Category.FOOD) for _ in range(3)]
+        products[0].delete()
+        products[1].delete()
+        self.assertEqual(self._ids(self._search()), [products[2].id])
+        self.assertEqual(list(catalog.rows), [products[2].id])
+        self.assertEqual(catalog.by_category, {Category.FOOD.value: {products[2].id}})
+        self.assertEqual(sum(len(ids) for ids in catalog.by_name.values()), 1)
+
+    def test_out_of_order_ids(self):
+        """It should return Products in id order whatever order they arrive in"""
+        seq = catalog.seq
+        rows = [{"id": 9, "name": "b"}, {"id": 5, "name": "a"}]
+        catalog.apply(
+            [
+                {"seq": seq + index + 1, "op": "upsert", "id": row["id"], "product": dict(
+                    row, description="d", price="1", available=True, category="FOOD")}
+                for index, row in enumerate(rows)
+            ]
+        )
+        self.assertEqual(self._ids(catalog.search()), [5, 9])
+
+    def test_list_route(self):
+        """It should answer the list route from memory once it has refreshed"""
+        product = self._create(available=True)
+        product_id, name, category = product.id, product.name, product.category.name
+        response = self.client.get(BASE_URL)
+        self.assertEqual(self._ids(response.get_json()), [product_id])
+        catalog.refresh()
+        # rows removed behind the ORM's back are still served from memory
+        db.session.execute(Product.__table__.delete())
+        db.session.commit()
+        for query in ("", f"?name={name}", f"?category={category}", "?available=true"):
+            response = self.client.get(BASE_URL + query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(self._ids(response.get_json()), [product_id])
+
+    @skipIf(":memory:" in app.config["SQLALCHEMY_DATABASE_URI"], "threads share the in-memory connection")
+    def test_refresh_thread(self):
+        """It should follow the writes in the background"""
+        self.start.stop()
+        try:
+            product = self._create()
+            deadline = time.monotonic() + 5
+            while catalog.search() is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self._ids(catalog.search()), [product.id])
+        finally:
+            catalog.stop()
+            self.start.start()
@@ -0,0 +1,97 @@
+"""
+Read Replica Routing Test Suite
+"""
+import os
+import tempfile
+from unittest import TestCase
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from service import app
+from service.models import Product, Category, db
+from service.common.replicas import replica_set, use_primary
+from tests.factories import ProductFactory
+
+
+class TestReplicaRouting(TestCase):
+    """Test Cases for primary/replica routing with two database files"""
+
+    def setUp(self):
+        """Points the replica set at a second database file"""
+        Product.init_db(app)
+        db.session.query(Product).delete()
+        db.session.commit()
+        db.session.remove()
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.replica_uri = f"sqlite:///{os.path.join(self.folder.name, 'replica.db')}"
+        app.config["SQLALCHEMY_REPLICA_URIS"] = [self.replica_uri]
+        replica_set.init_app(app)
+        replica = replica_set.engines[0]
+        db.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(
+                insert(Product.__table__),
+                [{"name": "replicated", "description": "on the replica", "price": 1,
+                  "available": True, "category": Category.FOOD.name}],
+            )
+
+    def tearDown(self):
+        """Goes back to the primary only"""
+        db.session.remove()
+        app.config["SQLALCHEMY_REPLICA_URIS"] = []
+        replica_set.init_app(app)
+        self.folder.cleanup()
+
+    def test_reads_go_to_replica(self):
+        """It should read from the replica"""
+        names = [product.name for product in Product.all()]
+        self.assertEqual(names, ["replicated"])
+        self.assertEqual(len(Product.find_by_category(Category.FOOD)), 1)
+
+    def test_writes_go_to_primary_and_stick(self):
+        """It should write to the primary and then read from it"""
+        product = ProductFactory()
+        product.create()
+        names = [found.name for found in Product.all()]
+        self.assertEqual(names, [product.name])
+        db.session.remove()
+        self.assertEqual([found.name for found in Product.all()], ["replicated"])
+
+    def test_write_routes_read_primary(self):
+        """It should find the current Product in write requests"""
+        client = app.test_client()
+        product = ProductFactory(category=Category.TOOLS)
+        product.create()
+        product.name = "renamed"
+        product.update()
+        product_id, data = product.id, product.serialize()
+        db.session.remove()
+        data["name"] = "replaced"
+        response = client.put(f"/products/{product_id}", json=data, headers={"If-Match": '"2"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["ETag"], '"3"')
+        response = client.patch(f"/products/{product_id}", json={"name": "patched"}, headers={"If-Match": '"2"'})
+        self.assertEqual(response.status_code, 412)
+        response = client.delete(f"/products/{product_id}")
+        self.assertEqual(response.status_code, 204)
+
+    def test_use_primary(self):
+        """It should read from the primary when asked to"""
+        use_primary(db.session)
+        self.assertEqual(Product.all(), [])
+
+    def test_round_robin(self):
+        """It should rotate over the replicas"""
+        app.config["SQLALCHEMY_REPLICA_URIS"] = [self.replica_uri, self.replica_uri]
+        replica_set.init_app(app)
+        first, second = replica_set.choose(), replica_set.choose()
+        self.assertIsNot(first, second)
+        self.assertIs(replica_set.choose(), first)
+
+    def test_eject_unreachable_replica(self):
+        """It should eject a replica that cannot be reached"""
+        app.config["SQLALCHEMY_REPLICA_URIS"] = ["sqlite:////nonexistent/folder/replica.db"]
+        replica_set.init_app(app)
+        self.assertRaises(OperationalError, Product.all)
+        self.assertEqual(replica_set.healthy(), [])
+        db.session.remove()
+        self.assertEqual(Product.all(), [])
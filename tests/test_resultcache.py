@@ -0,0 +1,156 @@
+"""
+List Result Cache Test Suite
+"""
+import json
+from unittest import TestCase
+from service import app
+from service.common import status
+from service.common.resultcache import cache, entry_size
+from service.models import Category, Product, ProductChange, db
+from tests.factories import ProductFactory
+
+BASE_URL = "/products"
+
+
+class TestResultCache(TestCase):
+    """Test Cases for the list result cache"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Product).delete()
+        db.session.commit()
+        app.config.update(RESULT_CACHE_ENABLED=True, RESULT_CACHE_REFRESH_SECONDS=0)
+        cache.init_app(app)
+        self.calls = []
+
+    def tearDown(self):
+        """Runs after each test"""
+        app.config.update(RESULT_CACHE_ENABLED=False, RESULT_CACHE_REFRESH_SECONDS=1.0, RESULT_CACHE_SIZE=1000)
+        if cache.expire in ProductChange.listeners:
+            ProductChange.listeners.remove(cache.expire)
+        cache.init_app(app)
+        db.session.remove()
+
+    def _create(self, **kwargs) -> Product:
+        product = ProductFactory(**kwargs)
+        product.create()
+        return product
+
+    def _find(self, filters: dict) -> list:
+        """Finds the Products and remembers the call"""
+        self.calls.append(filters)
+        if "category" in filters:
+            products = Product.find_by_category(filters["category"])
+        else:
+            products = Product.all()
+        return [product.serialize() for product in products]
+
+    def _ids(self, filters: dict) -> list:
+        body, count = cache.fetch(filters, self._find)
+        products = json.loads(body)
+        self.assertEqual(len(products), count)
+        return sorted(product["id"] for product in products)
+
+    def test_fetch_is_cached(self):
+        """It should serialize a listing once until something changes"""
+        products = [self._create(category=Category.FOOD) for _ in range(3)]
+        ids = sorted(product.id for product in products)
+        self.assertEqual(self._ids({"category": Category.FOOD}), ids)
+        self.assertEqual(self._ids({"category": Category.FOOD}), ids)
+        self.assertEqual(self._ids({}), ids)
+        self.assertEqual(self._ids({}), ids)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(cache.bytes, sum(entry[4] for entry in cache.entries.values()))
+        category = cache.entries[(("category", Category.FOOD),)]
+        self.assertGreater(category[4], len(category[1]) + 3 * 28)
+        self.assertEqual(category[4], entry_size(category[1], category[3]))
+        self.assertEqual(cache.entries[()][4], len(cache.entries[()][1]))
+
+    def test_changes_expire_listings(self):
+        """It should expire the listings a create, update or delete changes"""
+        food = self._create(category=Category.FOOD)
+        self.assertEqual(self._ids({"category": Category.FOOD}), [food.id])
+        other = self._create(category=Category.FOOD)
+        self.assertEqual(self._ids({"category": Category.FOOD}), sorted([food.id, other.id]))
+        other.name = "renamed"
+        other.update()
+        self._ids({"category": Category.FOOD})
+        other.delete()
+        self.assertEqual(self._ids({"category": Category.FOOD}), [food.id])
+        self.assertEqual(len(self.calls), 4)
+
+    def test_other_categories_are_kept(self):
+        """It should keep a category listing when another category changes"""
+        food = self._create(category=Category.FOOD)
+        self._ids({"category": Category.FOOD})
+        self._ids({})
+        tools = self._create(category=Category.TOOLS)
+        self.assertEqual(self._ids({"category": Category.FOOD}), [food.id])
+        self.assertEqual(self._ids({}), sorted([food.id, tools.id]))
+        self.assertEqual(len(self.calls), 3)
+
+    def test_moving_out_of_a_category(self):
+        """It should expire the category a Product moved out of"""
+        food = self._create(category=Category.FOOD)
+        self.assertEqual(self._ids({"category": Category.FOOD}), [food.id])
+        food.category = Category.TOOLS
+        food.update()
+        self.assertEqual(self._ids({"category": Category.FOOD}), [])
+        self.assertEqual(self._ids({"category": Category.TOOLS}), [food.id])
+
+    def test_writes_of_other_workers(self):
+        """It should see changes in the log once the refresh is due"""
+        app.config["RESULT_CACHE_REFRESH_SECONDS"] = 3600
+        cache.init_app(app)
+        # another worker does not run this worker's listeners
+        ProductChange.listeners.remove(cache.expire)
+        self.assertEqual(self._ids({}), [])
+        product = self._create()
+        self.assertEqual(self._ids({}), [])
+        cache.due = 0.0
+        self.assertEqual(self._ids({}), [product.id])
+
+    def test_too_many_changes(self):
+        """It should drop everything when more changed than it can apply"""
+        app.config["RESULT_CACHE_MAX_CHANGES"] = 2
+        cache.init_app(app)
+        self._ids({"category": Category.FOOD})
+        for _ in range(3):
+            self._create(category=Category.TOOLS)
+        self.assertEqual(len(cache.entries), 1)
+        self._ids({"category": Category.FOOD})
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(cache.seq, ProductChange.latest())
+        app.config["RESULT_CACHE_MAX_CHANGES"] = 1000
+
+    def test_bounded(self):
+        """It should evict the least recently used listings over the limits"""
+        for category in (Category.FOOD, Category.TOOLS):
+            self._create(category=category)
+        app.config["RESULT_CACHE_SIZE"] = 2
+        cache.init_app(app)
+        self._ids({"category": Category.FOOD})
+        self._ids({"category": Category.TOOLS})
+        self._ids({"category": Category.FOOD})
+        self._ids({})
+        self.assertEqual(list(cache.entries), [(("category", Category.FOOD),), ()])
+        cache.max_bytes = cache.bytes
+        self._ids({"category": Category.TOOLS})
+        self.assertLessEqual(cache.bytes, cache.max_bytes)
+        self.assertNotIn((("category", Category.FOOD),), cache.entries)
+
+    def test_list_route(self):
+        """It should answer list requests from the cache"""
+        food = self._create(category=Category.FOOD, available=True)
+        response = self.client.get(BASE_URL, query_string="category=FOOD&count=exact")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), [food.serialize()])
+        self.assertEqual(response.headers["X-Total-Count"], "1")
+        self.assertEqual(len(cache.entries), 1)
+        food.available = False
+        food.update()
+        response = self.client.get(BASE_URL, query_string="category=FOOD")
+        self.assertFalse(response.get_json()[0]["available"])
+        response = self.client.get(BASE_URL, query_string="available=false")
+        self.assertEqual([product["id"] for product in response.get_json()], [food.id])
@@ -5,12 +5,15 @@
 Product API Service Test Suite
 """
 import os
+import gzip
 import logging
 from decimal import Decimal
 from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy.orm.exc import StaleDataError
 from service import app
-from service.common import status
-from service.models import db, init_db, Product
+from service.common import status, assets, coalescing
+from service.models import db, init_db, Product, ProductArchive, ProductChange
 from tests.factories import ProductFactory
 
 # Disable logging for tests
@@ -49,6 +52,7 @@ class TestProductRoutes(TestCase):
         """Runs before each test"""
         self.client = app.test_client()
         db.session.query(Product).delete()
+        db.session.query(ProductChange).delete()
         db.session.commit()
 
     def tearDown(self):
@@ -80,6 +84,41 @@ class TestProductRoutes(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn(b"Product Catalog Administration", response.data)
 
+    def test_index_references_fingerprinted_assets(self):
+        """It should point the index page at fingerprinted assets"""
+        response = self.client.get("/")
+        self.assertEqual(response.headers["Cache-Control"], "no-cache")
+        self.assertNotIn(b'"static/', response.data)
+        url = assets.pipeline.url_for("js/rest_api.js")
+        self.assertIn(url.encode(), response.data)
+        response = self.client.get("/", headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_get_asset(self):
+        """It should serve a fingerprinted asset with immutable caching"""
+        url = assets.pipeline.url_for("css/cerulean_bootstrap.min.css")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/css")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertNotIn("Content-Encoding", response.headers)
+
+        response = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        with open(os.path.join(app.static_folder, "css/cerulean_bootstrap.min.css"), "rb") as file:
+            self.assertEqual(gzip.decompress(response.data), file.read())
+
+        response = self.client.get(
+            url, headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.data, b"")
+
+    def test_get_asset_not_found(self):
+        """It should not serve assets that are not fingerprinted"""
+        response = self.client.get("/assets/css/cerulean_bootstrap.min.css")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_health(self):
         """It should be healthy"""
         response = self.client.get("/health")
@@ -103,6 +142,23 @@ class TestProductRoutes(TestCase):
         del new_product["name"]
         response = self.client.post(BASE_URL, json=new_product)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        new_product["name"] = None
+        response = self.client.post(BASE_URL, json=new_product)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ############################################################
+    # STATISTICS tests
+    ############################################################
+    def test_get_product_stats(self):
+        """It should return statistics per Category"""
+        products = self._create_products(5)
+        response = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(sum(row["count"] for row in data), len(products))
+        for row in data:
+            self.assertIn(row["category"], {product.category.name for product in products})
+            self.assertLessEqual(Decimal(row["price"]["min"]), Decimal(row["price"]["max"]))
 
     ############################################################
     # READ tests
@@ -159,6 +215,97 @@ class TestProductRoutes(TestCase):
         response = self.client.put(f"{BASE_URL}/0", json=updated_data)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_update_product_if_match(self):
+        """It should not Update a Product that changed since it was read"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+        data = response.get_json()
+        data["name"] = "First"
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        data["name"] = "Second"
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_update_product_lost_race(self):
+        """It should answer 412 to a lost race with If-Match and 409 without"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+        data = response.get_json()
+        with patch.object(Product, "update", side_effect=StaleDataError("version changed")):
+            response = self.client.put(f"{BASE_URL}/{test_product.id}", json=data, headers={"If-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+            response = self.client.put(f"{BASE_URL}/{test_product.id}", json=data)
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_list_product_changes(self):
+        """It should return the changes after a sequence number"""
+        products = self._create_products(2)
+        response = self.client.delete(f"{BASE_URL}/{products[0].id}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        response = self.client.get(f"{BASE_URL}/changes")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([change["op"] for change in data["changes"]], ["upsert", "upsert", "delete"])
+        self.assertEqual(data["changes"][1]["product"]["name"], products[1].name)
+        self.assertEqual(data["changes"][2]["id"], products[0].id)
+        self.assertEqual(data["next"], data["changes"][2]["seq"])
+
+        response = self.client.get(f"{BASE_URL}/changes?since={data['changes'][0]['seq']}&limit=1")
+        page = response.get_json()
+        self.assertEqual(page["changes"], data["changes"][1:2])
+        response = self.client.get(f"{BASE_URL}/changes?since={data['next']}")
+        self.assertEqual(response.get_json(), {"changes": [], "next": data["next"]})
+        response = self.client.get(f"{BASE_URL}/changes?limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ############################################################
+    # PATCH tests
+    ############################################################
+    def test_patch_product(self):
+        """It should Patch only the given fields of a Product"""
+        test_product = self._create_products(1)[0]
+        response = self.client.patch(f"{BASE_URL}/{test_product.id}", json={"price": "1.25", "available": False})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(Decimal(data["price"]), Decimal("1.25"))
+        self.assertFalse(data["available"])
+        self.assertEqual(data["name"], test_product.name)
+        self.assertEqual(data["category"], test_product.category.name)
+        self.assertEqual(response.headers["ETag"], '"2"')
+
+    def test_patch_product_if_match(self):
+        """It should Patch only when If-Match holds the current version"""
+        test_product = self._create_products(1)[0]
+        etag = self.client.get(f"{BASE_URL}/{test_product.id}").headers["ETag"]
+        url = f"{BASE_URL}/{test_product.id}"
+        response = self.client.patch(url, json={"name": "First"}, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.patch(url, json={"name": "Second"}, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.patch(url, json={"name": "Third"}, headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url).get_json()["name"], "Third")
+        # the ETag of a compressed response still names the version
+        response = self.client.patch(url, json={"name": "Fourth"}, headers={"If-Match": '"3-gzip"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_patch_product_bad_data(self):
+        """It should not Patch a Product with bad or unknown fields"""
+        test_product = self._create_products(1)[0]
+        url = f"{BASE_URL}/{test_product.id}"
+        self.assertEqual(self.client.patch(url, json={"color": "red"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.patch(url, json={"available": "no"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.patch(url, json={}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_patch_product_not_found(self):
+        """It should return 404 when patching a non-existent product"""
+        response = self.client.patch(f"{BASE_URL}/0", json={"name": "Nothing"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     ############################################################
     # DELETE tests
     ############################################################
@@ -174,6 +321,71 @@ class TestProductRoutes(TestCase):
         response = self.client.get(f"{BASE_URL}/{test_product.id}")
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_archived_product(self):
+        """It should Read a soft deleted Product from the archive when asked"""
+        test_product = self._create_products(1)[0]
+        ProductArchive.soft_delete = True
+        try:
+            response = self.client.delete(f"{BASE_URL}/{test_product.id}")
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        finally:
+            ProductArchive.soft_delete = False
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}?archived=true")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["name"], test_product.name)
+
+    def test_total_count(self):
+        """It should count the listed Products in the requested mode"""
+        products = self._create_products(4)
+        category = products[0].category.name
+        expected = len([product for product in products if product.category.name == category])
+        for mode in ("exact", "estimate", "cached"):
+            response = self.client.get(f"{BASE_URL}?category={category}&count={mode}")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.headers["X-Total-Count"], str(expected))
+            response = self.client.head(f"{BASE_URL}?category={category}&count={mode}")
+            self.assertEqual(response.headers["X-Total-Count"], str(expected))
+            self.assertEqual(response.data, b"")
+        self.assertNotIn("X-Total-Count", self.client.get(BASE_URL).headers)
+        self.assertEqual(self.client.head(BASE_URL).headers["X-Total-Count"], "4")
+        # the cached count is refreshed after a write
+        self.assertEqual(self.client.head(f"{BASE_URL}?count=cached").headers["X-Total-Count"], "4")
+        self.client.delete(f"{BASE_URL}/{products[0].id}")
+        self.assertEqual(self.client.head(f"{BASE_URL}?count=cached").headers["X-Total-Count"], "3")
+        response = self.client.get(f"{BASE_URL}?count=roughly")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_products_by_ids(self):
+        """It should Read many Products by id in the requested order"""
+        products = self._create_products(3)
+        ids = [products[2].id, 0, products[0].id, products[2].id]
+        response = self.client.get(f"{BASE_URL}?ids={','.join(map(str, ids))}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([row["id"] for row in data], ids)
+        self.assertEqual(data[0]["name"], products[2].name)
+        self.assertEqual(data[1], {"id": 0, "status": status.HTTP_404_NOT_FOUND, "error": "Not Found"})
+        self.assertEqual(data[3], data[0])
+        self.assertEqual(self.client.get(f"{BASE_URL}?ids=").status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(f"{BASE_URL}?ids=1,x").status_code, status.HTTP_400_BAD_REQUEST)
+        too_many = ",".join(["1"] * 101)
+        self.assertEqual(self.client.get(f"{BASE_URL}?ids={too_many}").status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_products(self):
+        """It should Read many Products by the ids posted"""
+        products = self._create_products(2)
+        ids = [products[1].id, products[0].id, 0]
+        response = self.client.post(f"{BASE_URL}/lookup", json={"ids": ids})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["id"] for row in response.get_json()], ids)
+        self.assertEqual(response.get_json()[2]["error"], "Not Found")
+        response = self.client.post(f"{BASE_URL}/lookup", json={"ids": "1,2"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/lookup", json={"ids": [True]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_delete_product_not_found(self):
         """It should return 404 when deleting non-existent product"""
         response = self.client.delete(f"{BASE_URL}/0")
@@ -208,6 +420,19 @@ class TestProductRoutes(TestCase):
         data = response.get_json()
         self.assertTrue(all(p["category"] == target_category for p in data))
 
+    def test_metrics(self):
+        """It should report the coalescing counters"""
+        coalescing.flights.reset()
+        product = self._create_products(1)[0]
+        self.client.get(f"{BASE_URL}/{product.id}")
+        self.client.get(f"{BASE_URL}?category={product.category.name}")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()["coalescing"]
+        self.assertEqual(data["calls"], 2)
+        self.assertEqual(data["executed"], 2)
+        self.assertEqual(data["coalescing_ratio"], 0.0)
+
     def test_list_products_by_availability(self):
         """It should filter Products by availability"""
         products = self._create_products(3)
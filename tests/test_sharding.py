@@ -0,0 +1,174 @@
+"""
+Sharded Product Storage Test Suite
+"""
+import os
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from unittest import TestCase
+from sqlalchemy import func, select
+from service import app
+from service.models import Category, Product, ProductArchive, ProductIdSequence, db
+from service.common.sharding import ShardingError, jump_hash, shard_set
+from tests.factories import ProductFactory
+
+
+class TestJumpHash(TestCase):
+    """Test Cases for the jump consistent hash"""
+
+    def test_range(self):
+        """It should map keys evenly to every bucket"""
+        counts = [0] * 4
+        for key in range(4000):
+            counts[jump_hash(key, 4)] += 1
+        self.assertTrue(all(800 < count < 1200 for count in counts))
+        self.assertEqual(jump_hash(12345, 1), 0)
+
+    def test_minimal_movement(self):
+        """It should only move keys to the new bucket when one is added"""
+        moved = [key for key in range(4000) if jump_hash(key, 4) != jump_hash(key, 5)]
+        self.assertTrue(all(jump_hash(key, 5) == 4 for key in moved))
+        self.assertLess(len(moved), 1200)
+
+
+class TestSharding(TestCase):
+    """Test Cases for Products sharded across several database files"""
+
+    def setUp(self):
+        """Starts with Products on the primary only"""
+        Product.init_db(app)
+        db.session.query(Product).delete()
+        db.session.query(ProductArchive).delete()
+        db.session.commit()
+        db.session.remove()
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+
+    def tearDown(self):
+        """Goes back to the primary only"""
+        db.session.remove()
+        app.config["SQLALCHEMY_SHARD_URIS"] = []
+        Product.init_db(app)
+        self.folder.cleanup()
+
+    def _shard(self, count: int):
+        """Spreads the Products across count database files"""
+        db.session.remove()
+        app.config["SQLALCHEMY_SHARD_URIS"] = [
+            f"sqlite:///{os.path.join(self.folder.name, f'shard{number}.db')}" for number in range(count)
+        ]
+        Product.init_db(app)
+
+    def _ids_on(self, shard: int) -> list:
+        """Returns the ids stored on a shard"""
+        with shard_set.engines[shard].connect() as connection:
+            return list(connection.execute(select(Product.id).order_by(Product.id)).scalars())
+
+    def _create(self, count: int) -> list:
+        products = ProductFactory.create_batch(count)
+        for product in products:
+            product.create()
+        return products
+
+    def test_create_and_find(self):
+        """It should store a Product on the shard of its id and find it there"""
+        self._shard(3)
+        products = self._create(12)
+        ids = [product.id for product in products]
+        self.assertEqual(len(set(ids)), 12)
+        for product in products:
+            self.assertIn(product.id, self._ids_on(shard_set.shard_for(product.id)))
+        self.assertEqual(sum(len(self._ids_on(shard)) for shard in range(3)), 12)
+        db.session.remove()
+        found = Product.find(ids[5])
+        self.assertEqual(found.name, products[5].name)
+        self.assertEqual(ProductIdSequence.query.count(), 0)
+
+    def test_ids_continue_after_advance(self):
+        """It should allocate ids above the highest one once sharded"""
+        self._shard(2)
+        highest = Product.highest_id()
+        ProductIdSequence.advance(highest + 100)
+        ProductIdSequence.advance(highest + 50)
+        self.assertEqual(self._create(1)[0].id, highest + 101)
+        self.assertEqual(ProductIdSequence.query.count(), 0)
+
+    def test_scatter_gather(self):
+        """It should gather lists from every shard in id order"""
+        self._shard(3)
+        products = self._create(10)
+        ids = sorted(product.id for product in products)
+        self.assertEqual([product.id for product in Product.all()], ids)
+        self.assertEqual([product.id for product in Product.gather(limit=3, offset=4)], ids[4:7])
+        self.assertEqual([product.id for product in Product.gather(limit=5, offset=8)], ids[8:])
+        for category in Category:
+            expected = sorted(product.id for product in products if product.category == category)
+            self.assertEqual([product.id for product in Product.find_by_category(category)], expected)
+        expected = sorted(product.id for product in products if product.available)
+        self.assertEqual([product.id for product in Product.find_by_availability(True)], expected)
+
+    def test_update_and_delete(self):
+        """It should update, patch and delete on the shard of the Product"""
+        self._shard(2)
+        product = self._create(1)[0]
+        db.session.remove()
+        product = Product.find(product.id)
+        product.name = "Updated"
+        product.update()
+        patched = Product.patch(product.id, {"available": False})
+        self.assertEqual(patched.version, 3)
+        db.session.remove()
+        found = Product.find(product.id)
+        self.assertEqual((found.name, found.available), ("Updated", False))
+        found.delete()
+        db.session.remove()
+        self.assertIsNone(Product.find(product.id))
+
+    def test_bulk_create_and_statistics(self):
+        """It should insert batches across shards and merge the statistics"""
+        self._shard(3)
+        rows = [ProductFactory(category=Category.FOOD, price=price).serialize() for price in (1, 5, 9, 20)]
+        products, errors = Product.bulk_create(rows)
+        self.assertEqual(errors, {})
+        self.assertEqual(len(Product.all()), 4)
+        stats = Product.statistics()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["count"], 4)
+        self.assertEqual(Decimal(stats[0]["price"]["min"]), min(product.price for product in products))
+        self.assertEqual(Product.highest_id(), max(product.id for product in products))
+
+    def test_no_shard_chosen(self):
+        """It should refuse to query a sharded table without a shard"""
+        self._shard(2)
+        self.assertRaises(ShardingError, Product.query.all)
+
+    def test_archive_unavailable(self):
+        """It should archive the unavailable Products of every shard on that shard"""
+        self._shard(2)
+        products = ProductFactory.create_batch(10, available=False)
+        for product in products:
+            product.create()
+        self.assertEqual(ProductArchive.archive_unavailable(timedelta(0), batch_size=3), 10)
+        db.session.remove()
+        self.assertEqual(Product.all(), [])
+        for product in products:
+            self.assertIsNone(Product.find(product.id))
+            self.assertEqual(Product.find(product.id, archived=True).name, product.name)
+
+    def test_rebalance(self):
+        """It should move the Products of the primary and then between shards"""
+        products = self._create(20)
+        ids = sorted(product.id for product in products)
+        self._shard(2)
+        self.assertEqual(Product.all(), [])
+        self.assertEqual(Product.rebalance(batch_size=7), 20)
+        self.assertEqual(db.session.execute(select(func.count(Product.id)), bind_arguments={"bind": db.engine}).scalar(), 0)
+        self.assertEqual([product.id for product in Product.all()], ids)
+        # ids allocated after sharding do not collide with the moved ones
+        self.assertGreater(self._create(1)[0].id, ids[-1])
+
+        self._shard(3)
+        moved = Product.rebalance()
+        self.assertEqual(moved, len(self._ids_on(2)))
+        self.assertLess(moved, 21)
+        self.assertEqual(len(Product.all()), 21)
+        self.assertEqual(Product.rebalance(), 0)
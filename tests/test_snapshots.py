@@ -0,0 +1,167 @@
+"""
+Shared Catalog Snapshot Test Suite
+"""
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from service import app
+from service.common import status
+from service.common.snapshots import HEADER, Snapshot, SnapshotStore, build, store
+from service.models import Category, Product, ProductChange, db
+from tests.factories import ProductFactory
+
+BASE_URL = "/products"
+
+
+class TestSnapshot(TestCase):
+    """Test Cases for the shared catalog snapshot"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Product).delete()
+        db.session.commit()
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.folder.name, "catalog.snap")
+        app.config.update(SNAPSHOT_ENABLED=True, SNAPSHOT_PATH=self.path)
+        # the tests refresh in their own thread, the in-memory database is one connection
+        self.start = patch.object(SnapshotStore, "start")
+        self.start.start()
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.start.stop()
+        app.config["SNAPSHOT_ENABLED"] = False
+        if store.mark in ProductChange.listeners:
+            ProductChange.listeners.remove(store.mark)
+        store.init_app(app)
+        self.folder.cleanup()
+        db.session.remove()
+
+    def _create(self, count: int, **kwargs) -> list:
+        products = []
+        for _ in range(count):
+            product = ProductFactory(**kwargs)
+            product.create()
+            products.append(product)
+        return products
+
+    def test_layout(self):
+        """It should write the Products sorted by id with their JSON bodies"""
+        products = self._create(5)
+        self.assertTrue(build(app, self.path))
+        snapshot = Snapshot(self.path)
+        self.assertEqual(snapshot.count, 5)
+        self.assertEqual(snapshot.seq, ProductChange.latest())
+        self.assertEqual(len(snapshot.map), os.path.getsize(self.path))
+        for product in products:
+            record = snapshot.find(product.id)
+            self.assertEqual(record[1], product.version)
+            self.assertEqual(json.loads(snapshot.body(record)), product.serialize())
+        self.assertIsNone(snapshot.find(0))
+        self.assertIsNone(snapshot.find(products[-1].id + 1))
+
+    def test_not_a_snapshot(self):
+        """It should refuse to map another file"""
+        with open(self.path, "wb") as file:
+            file.write(b"\0" * HEADER.size)
+        self.assertRaises(ValueError, Snapshot, self.path)
+
+    def test_routes(self):
+        """It should serve GET by id and lists from the snapshot"""
+        products = self._create(4, category=Category.FOOD, available=True)
+        store.init_app(app)
+        self.assertEqual(store.snapshot.count, 4)
+        # rows removed behind the ORM's back are still served from the snapshot
+        product_id = products[0].id
+        db.session.execute(Product.__table__.delete().where(Product.id == product_id))
+        db.session.commit()
+        response = self.client.get(f"{BASE_URL}/{product_id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["id"], product_id)
+        self.assertEqual(response.headers["ETag"], '"1"')
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 4)
+        self.assertEqual(len(self.client.get(f"{BASE_URL}?category=FOOD").get_json()), 4)
+        self.assertEqual(self.client.get(f"{BASE_URL}?category=TOOLS").get_json(), [])
+        self.assertEqual(self.client.get(f"{BASE_URL}?available=false").get_json(), [])
+        response = self.client.get(f"{BASE_URL}/{products[-1].id + 100}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_changes_since_snapshot(self):
+        """It should read the Products changed after the snapshot from the database"""
+        products = self._create(2)
+        store.init_app(app)
+        products[0].delete()
+        products[1].name = "Renamed"
+        products[1].update()
+        new = self._create(1)[0]
+        # until the refresh has read its own writes the worker reads the database
+        self.assertIsNone(store.view())
+        store.refresh()
+        self.assertEqual(store.view().changed, {products[0].id, products[1].id, new.id})
+        response = self.client.get(f"{BASE_URL}/{products[1].id}")
+        self.assertEqual(response.get_json()["name"], "Renamed")
+        self.assertEqual(response.headers["ETag"], '"2"')
+        response = self.client.get(f"{BASE_URL}/{products[0].id}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        data = self.client.get(BASE_URL).get_json()
+        self.assertEqual([(row["id"], row["name"]) for row in data], [(products[1].id, "Renamed"), (new.id, new.name)])
+
+    def test_products_by_ids(self):
+        """It should serve a batch GET from the snapshot and the database"""
+        products = self._create(3)
+        store.init_app(app)
+        products[1].name = "Renamed"
+        products[1].update()
+        ids = [products[1].id, products[0].id, products[2].id + 100]
+        name = products[0].name
+        # rows removed behind the ORM's back are still served from the snapshot
+        db.session.execute(Product.__table__.delete().where(Product.id == ids[1]))
+        db.session.commit()
+        store.refresh()
+        data = self.client.get(f"{BASE_URL}?ids={','.join(map(str, ids))}").get_json()
+        self.assertEqual([row["id"] for row in data], ids)
+        self.assertEqual(data[0]["name"], "Renamed")
+        self.assertEqual(data[1]["name"], name)
+        self.assertEqual(data[2]["status"], status.HTTP_404_NOT_FOUND)
+
+    @skipIf(":memory:" in app.config["SQLALCHEMY_DATABASE_URI"], "threads share the in-memory connection")
+    def test_refresh_thread(self):
+        """It should read the changes of a local commit in the background"""
+        self.start.stop()
+        try:
+            self._create(1)
+            store.init_app(app)
+            store.mark()
+            self.assertNotEqual(store.applied, store.marked)
+            deadline = time.monotonic() + 5
+            while store.view() is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertIsNotNone(store.view())
+            self.assertTrue(store.thread.is_alive())
+        finally:
+            store.stop()
+            self.start.start()
+
+    def test_generation_swap(self):
+        """It should map a new generation once there are too many changes"""
+        self._create(1)
+        store.init_app(app)
+        other = SnapshotStore()  # another worker mapping the same file
+        other.init_app(app)
+        first = store.snapshot
+        store.max_changes = 1
+        self._create(2)
+        store.refresh()
+        self.assertIsNot(store.snapshot, first)
+        self.assertEqual(store.snapshot.count, 3)
+        self.assertEqual(store.changed, set())
+        # the old mapping stays readable while it is referenced
+        self.assertEqual(first.count, 1)
+        other.refresh()
+        self.assertEqual(other.snapshot.generation, store.snapshot.generation)
+        other.stop()
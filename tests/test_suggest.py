@@ -0,0 +1,143 @@
+"""
+Name Suggestion Test Suite
+"""
+import time
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from service import app
+from service.common import status
+from service.common.suggest import SuggestIndex, index
+from service.models import Category, Product, ProductChange, db
+from tests.factories import ProductFactory
+
+BASE_URL = "/products/suggest"
+
+
+class TestSuggestIndex(TestCase):
+    """Test Cases for the name suggestion index"""
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Product).delete()
+        db.session.commit()
+        app.config["SUGGEST_ENABLED"] = True
+        # the tests refresh in their own thread, the in-memory database is one connection
+        self.start = patch.object(SuggestIndex, "start")
+        self.start.start()
+        index.init_app(app)
+
+    def tearDown(self):
+        """Runs after each test"""
+        self.start.stop()
+        app.config["SUGGEST_ENABLED"] = True
+        if index.mark in ProductChange.listeners:
+            ProductChange.listeners.remove(index.mark)
+        index.init_app(app)
+        db.session.remove()
+
+    def _create(self, name: str, **kwargs) -> Product:
+        product = ProductFactory(name=name, **kwargs)
+        product.create()
+        return product
+
+    def _names(self, prefix: str, **kwargs) -> list:
+        """Refreshes the index like its thread does and returns the suggested names"""
+        index.refresh()
+        return [product["name"] for product in index.suggest(prefix, **kwargs)]
+
+    def test_prefix(self):
+        """It should suggest the names that start with the prefix"""
+        for name in ("Hammer", "hat", "Hamper", "Saw", "H"):
+            self._create(name, available=True, category=Category.TOOLS)
+        self.assertEqual(self._names("ha"), ["hat", "Hammer", "Hamper"])
+        self.assertEqual(self._names("HAM"), ["Hammer", "Hamper"])
+        self.assertEqual(self._names("x"), [])
+        self.assertEqual(self._names("h", limit=2), ["H", "hat"])
+        run = index.runs[(True, "TOOLS")]
+        self.assertEqual(run, sorted(run))
+
+    def test_ranking(self):
+        """It should rank available Products first, then the browsed category"""
+        self._create("Apple pie", available=False, category=Category.FOOD)
+        self._create("Apple", available=False, category=Category.TOOLS)
+        self._create("Apple juice", available=True, category=Category.FOOD)
+        self.assertEqual(self._names("apple"), ["Apple juice", "Apple", "Apple pie"])
+        self.assertEqual(self._names("apple", category="FOOD"), ["Apple juice", "Apple pie", "Apple"])
+
+    def test_max_scan(self):
+        """It should rank at most SUGGEST_MAX_SCAN names of each availability and category"""
+        for number in range(5):
+            self._create(f"bolt {number}", available=number == 4, category=Category.TOOLS)
+        index.max_scan = 3
+        self.assertEqual(self._names("bolt"), ["bolt 4", "bolt 0", "bolt 1", "bolt 2"])
+        self.assertEqual(self._names("bolt", limit=1), ["bolt 4"])
+
+    def test_follows_writes(self):
+        """It should apply creates, renames and deletes"""
+        self.assertEqual(self._names("c"), [])
+        chair = self._create("Chair")
+        self.assertEqual(self._names("c"), ["Chair"])
+        chair.name = "Stool"
+        chair.update()
+        self.assertEqual(self._names("c"), [])
+        self.assertEqual(self._names("s"), ["Stool"])
+        chair.delete()
+        self.assertEqual(self._names("s"), [])
+        self.assertEqual(index.runs, {})
+
+    def test_database_until_loaded(self):
+        """It should answer from the database until the index is loaded, or when it is disabled"""
+        self._create("Drill", available=False, category=Category.TOOLS)
+        self._create("drain", available=True, category=Category.HOUSEWARES)
+        self._create("Dr", available=False, category=Category.FOOD)
+        expected = ["drain", "Dr", "Drill"]
+        self.assertFalse(index.loaded)
+        self.assertEqual([product["name"] for product in index.suggest("DR")], expected)
+        self.assertEqual([product["name"] for product in index.suggest("dr", "TOOLS")], ["drain", "Drill", "Dr"])
+        self.assertEqual([product["name"] for product in index.suggest("d_")], [])
+        self.assertEqual(self._names("dr"), expected)
+        app.config["SUGGEST_ENABLED"] = False
+        ProductChange.listeners.remove(index.mark)
+        index.init_app(app)
+        self.assertNotIn(index.mark, ProductChange.listeners)
+        self.assertEqual([product["name"] for product in index.suggest("dr")], expected)
+        self.assertFalse(index.loaded)
+
+    @skipIf(":memory:" in app.config["SQLALCHEMY_DATABASE_URI"], "threads share the in-memory connection")
+    def test_refresh_thread(self):
+        """It should load and follow the writes in the background"""
+        self.start.stop()
+        try:
+            self._create("Lamp")
+            self.assertEqual(index.suggest("la")[0]["name"], "Lamp")
+            deadline = time.monotonic() + 5
+            while not index.loaded and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(index.loaded)
+            self._create("Ladder")
+            while len(index.products) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(sorted(product["name"] for product in index.suggest("la")), ["Ladder", "Lamp"])
+        finally:
+            index.stop()
+            self.start.start()
+
+    def test_suggest_route(self):
+        """It should suggest names over HTTP"""
+        product = self._create("Kettle", available=True, category=Category.HOUSEWARES)
+        index.refresh()
+        response = self.client.get(BASE_URL, query_string={"prefix": "ket", "category": "housewares"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(),
+            [{"id": product.id, "name": "Kettle", "category": "HOUSEWARES", "available": True}],
+        )
+        self.assertTrue(response.headers["Server-Timing"].startswith("suggest;dur="))
+
+    def test_suggest_bad_request(self):
+        """It should reject a missing prefix, a bad limit or category"""
+        for query in ({}, {"prefix": " "}, {"prefix": "a", "limit": 0},
+                      {"prefix": "a", "limit": 51}, {"prefix": "a", "category": "nope"}):
+            response = self.client.get(BASE_URL, query_string=query)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)